@@ -3,7 +3,7 @@ from typing import Union
 import itsdangerous
 import random
 import redis
-from flask_init import app, api, basic_auth
+from flask_init import app, api, basic_auth, db
 import models
 from sqlalchemy import and_
 import utils
@@ -372,4 +372,7 @@ def verify_password(username: str, password: str) -> bool:
     if not user or not user.verify_password(password):
         return False
 
+    if db.session.is_modified(user):
+        db.session.commit()  # rehashed at the current cost
+
     return True
@@ -38,6 +38,28 @@ class BaseConfig(object):
     REDIS_PORT = get_env_variable("REDIS_PORT")
     SMTP_HOST = get_env_variable("SMTP_HOST")
     SMTP_PORT = get_env_variable("SMTP_PORT")
+    # Password hashing (see hashing.py), per worker: pool processes (0 to
+    # hash in the request thread), operations running or waiting beyond
+    # which requests get a 503 (one per process plus a small backlog, below
+    # WSGI_THREADS so that threads are left for /token), seconds to wait
+    # for one
+    PASSWORD_HASH_PROCESSES = 2
+    PASSWORD_HASH_QUEUE_SIZE = PASSWORD_HASH_PROCESSES + 1
+    PASSWORD_HASH_TIMEOUT = 10
+    # sha512_crypt cost, passwords hashed with another one are rehashed on
+    # login
+    PASSWORD_HASH_ROUNDS = 535000
+    # Production serving mode (gunicorn, see gunicorn_config.py)
+    WSGI_BIND = '0.0.0.0:5000'
+    WSGI_WORKERS = 2
+    WSGI_THREADS = 4
+    WSGI_TIMEOUT = 30  # Seconds before a silent worker is restarted
+    WSGI_GRACEFUL_TIMEOUT = 30
+    WSGI_KEEPALIVE = 5
+    WSGI_MAX_REQUESTS = 10000  # Recycle workers, bounding memory growth
+    WSGI_MAX_REQUESTS_JITTER = 1000
+    # Metrics of the workers are aggregated through the files in here
+    METRICS_MULTIPROC_DIR = '/tmp/prometheus_multiproc'
 
 
 class DevConfig(BaseConfig):
@@ -48,13 +70,34 @@ class DevConfig(BaseConfig):
 class TestConfig(BaseConfig):
     DEBUG = True
     TESTING = True
+    PASSWORD_HASH_PROCESSES = 0
+    PASSWORD_HASH_ROUNDS = 1000  # The minimum, cheap
 
 
 class StageConfig(BaseConfig):
     DEBUG = False
     TESTING = False
+    # Per worker: one connection per thread, plus background work
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': BaseConfig.WSGI_THREADS,
+        'max_overflow': 2,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    }
 
 
 class ProdConfig(BaseConfig):
     DEBUG = False
     TESTING = False
+    WSGI_WORKERS = (os.cpu_count() or 1) + 1
+    WSGI_THREADS = 8
+    # Together about one hashing process per CPU
+    PASSWORD_HASH_PROCESSES = 1
+    PASSWORD_HASH_QUEUE_SIZE = PASSWORD_HASH_PROCESSES + 2
+    # Per worker: one connection per thread, plus background work
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': WSGI_THREADS,
+        'max_overflow': 2,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    }
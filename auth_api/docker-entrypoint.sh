@@ -0,0 +1,11 @@
+#!/bin/sh
+
+# Pre-forking WSGI server in stage/prod, development server otherwise
+case "$APP_SETTINGS" in
+    config.StageConfig|config.ProdConfig)
+        exec gunicorn --config gunicorn_config.py wsgi:app
+        ;;
+    *)
+        exec python app.py
+        ;;
+esac
@@ -1,8 +1,18 @@
 import os
 import flask_restful
+import flask_sqlalchemy
 from flask import Flask, g
 from flask_httpauth import HTTPBasicAuth
-from flask_sqlalchemy import SQLAlchemy
+import service_metrics
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def apply_pool_defaults(self, app, options):
+        super().apply_pool_defaults(app, options)
+        # Driver specific pools (sqlite) and SQLALCHEMY_ENGINE_OPTIONS
+        # still take precedence
+        options['poolclass'] = service_metrics.TimedQueuePool
+
 
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
@@ -12,3 +22,5 @@ api = flask_restful.Api(app)
 db = SQLAlchemy(app)
 
 basic_auth = HTTPBasicAuth()
+
+service_metrics.init_app(app)
@@ -0,0 +1,45 @@
+"""
+Gunicorn settings of the production serving mode, read from the WSGI_*
+settings of the APP_SETTINGS config.
+"""
+import os
+import shutil
+import werkzeug.utils
+
+settings = werkzeug.utils.import_string(os.environ['APP_SETTINGS'])
+
+# Set before the app (and prometheus_client) is imported, emptied so that
+# no values of a previous run are aggregated
+multiproc_dir = os.environ.setdefault(
+    'prometheus_multiproc_dir', settings.METRICS_MULTIPROC_DIR)
+shutil.rmtree(multiproc_dir, ignore_errors=True)
+os.makedirs(multiproc_dir)
+
+bind = settings.WSGI_BIND
+workers = settings.WSGI_WORKERS
+worker_class = 'gthread'
+threads = settings.WSGI_THREADS
+timeout = settings.WSGI_TIMEOUT
+graceful_timeout = settings.WSGI_GRACEFUL_TIMEOUT
+keepalive = settings.WSGI_KEEPALIVE
+max_requests = settings.WSGI_MAX_REQUESTS
+max_requests_jitter = settings.WSGI_MAX_REQUESTS_JITTER
+
+# Import the app once in the master, workers are forked from it
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Database connections must not be shared across processes: every
+    # worker opens its own pool
+    import flask_init
+    flask_init.db.engine.dispose()
+
+
+def child_exit(server, worker):
+    # Drops the live gauges (in-flight requests) of the dead worker
+    import prometheus_client.multiprocess
+    prometheus_client.multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,130 @@
+"""
+Password hashing on a bounded process pool, off the request threads.
+Kept free of the app, so that running a task only imports this module and
+passlib. Spawned processes still import the main module of the parent
+first: the gunicorn launcher in production, but the whole app under
+`python app.py`.
+"""
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import threading
+import werkzeug.exceptions
+from passlib.context import CryptContext
+
+
+class PasswordHasherBusy(werkzeug.exceptions.ServiceUnavailable):
+    description = 'Too many logins in progress, retry later'
+
+    def get_headers(self, *args, **kwargs):
+        return super().get_headers(*args, **kwargs) + [('Retry-After', '1')]
+
+
+def crypt_context(rounds: int) -> CryptContext:
+    """
+    sha512_crypt at exactly `rounds` rounds: hashes of any other cost (or
+    of the older sha256_crypt) verify, but need an update.
+    """
+    return CryptContext(
+        schemes=['sha512_crypt', 'sha256_crypt'],
+        default='sha512_crypt',
+        deprecated=['sha256_crypt'],
+        sha512_crypt__default_rounds=rounds,
+        sha512_crypt__min_rounds=rounds,
+        sha512_crypt__max_rounds=rounds)
+
+
+# Context of the current process, see _init_process
+_context = None
+
+
+def _init_process(rounds: int):
+    global _context
+    _context = crypt_context(rounds)
+
+
+def _call(method: str, *args):
+    return getattr(_context, method)(*args)
+
+
+class PasswordHasher():
+    """
+    Hashes and verifies passwords on a pool of `processes` processes (in
+    the calling thread if 0). At most `queue_size` operations are running
+    or waiting per process using the hasher, the next ones are rejected
+    with PasswordHasherBusy (503) rather than tying up request threads.
+    """
+    def __init__(
+            self, processes: int, queue_size: int, timeout: float,
+            rounds: int):
+        self._processes = processes
+        self._timeout = timeout
+        self._rounds = rounds
+        self._slots = threading.BoundedSemaphore(queue_size)
+        # Own context when hashing inline, the process one may have another
+        # cost
+        self._context = None if processes else crypt_context(rounds)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Created on first use, so that forked workers get their own pool.
+        # Spawned: forking a process running threads can deadlock the child
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_process,
+                    initargs=(self._rounds,))
+            return self._executor
+
+    def _run(self, method: str, *args):
+        # Runs the CryptContext method
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        if not self._processes:
+            try:
+                return getattr(self._context, method)(*args)
+            finally:
+                self._slots.release()
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(_call, method, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._slots.release()
+            self._drop_executor(executor)
+            raise PasswordHasherBusy()
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # The slot is held until the operation is done, timed out or not
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self._timeout)
+        except concurrent.futures.TimeoutError:
+            raise PasswordHasherBusy()
+        except concurrent.futures.process.BrokenProcessPool:
+            self._drop_executor(executor)
+            raise PasswordHasherBusy()
+
+    def _drop_executor(self, executor):
+        # A pool process died, the next operation starts a new pool
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def hash(self, password: str) -> str:
+        return self._run('hash', password)
+
+    def verify_and_update(self, password: str, password_hash: str) -> tuple:
+        """
+        (whether the password matches, its new hash if the hash was made
+        with another cost and must be replaced, else None)
+        """
+        if not password_hash:
+            return False, None
+        return self._run('verify_and_update', password, password_hash)
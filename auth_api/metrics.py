@@ -0,0 +1,23 @@
+"""
+Metrics of the service on top of the shared ones (see service_metrics),
+exposed on the same /metrics endpoint.
+"""
+import prometheus_client
+import redis
+
+REDIS_COMMAND_DURATION = prometheus_client.Histogram(
+    'redis_command_duration_seconds', 'Redis command latency', ['command'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .5, 1,
+             float('inf')))
+SMTP_SEND_DURATION = prometheus_client.Histogram(
+    'smtp_send_duration_seconds', 'Duration of sending an e-mail',
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, float('inf')))
+
+
+class TimedRedis(redis.Redis):
+    """
+    Redis client reporting the latency of every command.
+    """
+    def execute_command(self, *args, **options):
+        with REDIS_COMMAND_DURATION.labels(args[0]).time():
+            return super().execute_command(*args, **options)
@@ -1,6 +1,6 @@
 from sqlalchemy.sql import func
-from passlib.apps import custom_app_context as pwd_context
 from flask_init import app, db, basic_auth
+import utils
 
 
 class User(db.Model):
@@ -15,7 +15,15 @@ class User(db.Model):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
     def hash_password(self, password: str):
-        self.password_hash = pwd_context.hash(password)
+        self.password_hash = utils.password_hasher.hash(password)
 
     def verify_password(self, password: str):
-        return pwd_context.verify(password, self.password_hash)
+        """
+        Replaces the hash (not committed) when it was made with another
+        cost than PASSWORD_HASH_ROUNDS.
+        """
+        valid, new_hash = utils.password_hasher.verify_and_update(
+            password, self.password_hash)
+        if new_hash is not None:
+            self.password_hash = new_hash
+        return valid
@@ -0,0 +1,159 @@
+import concurrent.futures
+import pytest
+import flask_init
+import auth
+import hashing
+import models
+
+
+class TestPasswordHasher():
+    def setup(self):
+        self.executor_future = concurrent.futures.Future()
+
+    def _pooled_hasher(self, mocker, queue_size: int = 1):
+        executor_mock = mocker.patch.object(
+            hashing.concurrent.futures, "ProcessPoolExecutor")
+        executor_mock.return_value.submit.return_value = self.executor_future
+        hasher = hashing.PasswordHasher(
+            processes=1, queue_size=queue_size, timeout=0.01, rounds=1000)
+        return hasher, executor_mock.return_value
+
+    def test_hash_and_verify(self):
+        # GIVEN
+        hasher = hashing.PasswordHasher(
+            processes=0, queue_size=1, timeout=1, rounds=1000)
+
+        # WHEN
+        password_hash = hasher.hash('password')
+
+        # THEN
+        assert hasher.verify_and_update('password', password_hash) == \
+            (True, None)
+        assert hasher.verify_and_update('wrong', password_hash) == \
+            (False, None)
+        assert hasher.verify_and_update('password', None) == (False, None)
+
+    def test_hash_pool(self):
+        # GIVEN
+        hasher = hashing.PasswordHasher(
+            processes=1, queue_size=1, timeout=30, rounds=1000)
+
+        # WHEN
+        password_hash = hasher.hash('password')
+
+        # THEN
+        assert hashing.crypt_context(1000).verify('password', password_hash)
+
+    def test_timeout(self, mocker):
+        # GIVEN
+        hasher, executor_mock = self._pooled_hasher(mocker)
+
+        # WHEN
+        with pytest.raises(hashing.PasswordHasherBusy) as busy:
+            hasher.hash('password')
+
+        # THEN
+        executor_mock.submit.assert_called_once_with(
+            hashing._call, 'hash', 'password')
+        assert busy.value.code == 503
+
+    def test_busy(self, mocker):
+        # GIVEN
+        hasher, executor_mock = self._pooled_hasher(mocker)
+        with pytest.raises(hashing.PasswordHasherBusy):
+            hasher.hash('password')  # Timed out, still holding the slot
+
+        # WHEN
+        with pytest.raises(hashing.PasswordHasherBusy) as busy:
+            hasher.hash('password')
+
+        # THEN
+        executor_mock.submit.assert_called_once()
+        assert busy.value.code == 503
+        assert ('Retry-After', '1') in busy.value.get_headers()
+
+    def test_slot_released_when_done(self, mocker):
+        # GIVEN
+        hasher, executor_mock = self._pooled_hasher(mocker)
+        with pytest.raises(hashing.PasswordHasherBusy):
+            hasher.hash('password')
+
+        # WHEN
+        self.executor_future.set_result('hash')
+        actual = hasher.hash('password')
+
+        # THEN
+        assert executor_mock.submit.call_count == 2
+        assert actual == 'hash'
+
+    def test_broken_pool(self, mocker):
+        # GIVEN
+        hasher, executor_mock = self._pooled_hasher(mocker)
+        self.executor_future.set_exception(
+            concurrent.futures.process.BrokenProcessPool())
+
+        # WHEN
+        with pytest.raises(hashing.PasswordHasherBusy):
+            hasher.hash('password')
+        with pytest.raises(hashing.PasswordHasherBusy):
+            hasher.hash('password')
+
+        # THEN
+        # The pool is replaced, and the slots are released
+        assert hashing.concurrent.futures.ProcessPoolExecutor.call_count == 2
+        assert executor_mock.submit.call_count == 2
+
+    def test_rehash_other_cost(self):
+        # GIVEN
+        old_hash = hashing.crypt_context(1000).hash('password')
+        hasher = hashing.PasswordHasher(
+            processes=0, queue_size=1, timeout=1, rounds=2000)
+
+        # WHEN
+        valid, new_hash = hasher.verify_and_update('password', old_hash)
+
+        # THEN
+        assert valid
+        assert new_hash is not None
+        assert hashing.crypt_context(2000).verify('password', new_hash)
+        assert not hashing.crypt_context(2000).needs_update(new_hash)
+
+
+class TestVerifyPassword():
+    def test_rehash_on_login(self, mocker):
+        # GIVEN
+        user = models.User(
+            username='user',
+            password_hash=hashing.crypt_context(2000).hash('password'))
+        query_mock = mocker.patch.object(models.User, "query")
+        query_mock.filter_by.return_value.first.return_value = user
+        commit_mock = mocker.patch.object(flask_init.db.session, "commit")
+
+        # WHEN
+        actual = auth.verify_password('user', 'password')
+
+        # THEN
+        assert actual
+        assert hashing.crypt_context(
+            flask_init.app.config['PASSWORD_HASH_ROUNDS']) \
+            .verify('password', user.password_hash)
+        assert not hashing.crypt_context(
+            flask_init.app.config['PASSWORD_HASH_ROUNDS']) \
+            .needs_update(user.password_hash)
+        commit_mock.assert_called_once()
+
+    def test_wrong_password(self, mocker):
+        # GIVEN
+        user = models.User(
+            username='user',
+            password_hash=hashing.crypt_context(2000).hash('password'))
+        query_mock = mocker.patch.object(models.User, "query")
+        query_mock.filter_by.return_value.first.return_value = user
+        commit_mock = mocker.patch.object(flask_init.db.session, "commit")
+
+        # WHEN
+        actual = auth.verify_password('user', 'wrong')
+
+        # THEN
+        assert not actual
+        commit_mock.assert_not_called()
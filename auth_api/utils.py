@@ -1,18 +1,26 @@
 import smtplib
 from email.message import EmailMessage
-import redis
 from flask_init import app
+import hashing
+import metrics
 
 
 class Redis():
     @staticmethod
     def get_connection():
-        return redis.Redis(
+        return metrics.TimedRedis(
             host=app.config['REDIS_HOST'],
             port=app.config['REDIS_PORT'],
             db=0)
 
 
+password_hasher = hashing.PasswordHasher(
+    processes=app.config['PASSWORD_HASH_PROCESSES'],
+    queue_size=app.config['PASSWORD_HASH_QUEUE_SIZE'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+    rounds=app.config['PASSWORD_HASH_ROUNDS'])
+
+
 class Mail():
     @staticmethod
     def build_message(
@@ -32,7 +40,8 @@ class Mail():
             message: str, smtp_host: str = app.config['SMTP_HOST'],
             smtp_port: str = app.config['SMTP_PORT']) -> bool:
         try:
-            with smtplib.SMTP(host=smtp_host, port=smtp_port) as smtp:
+            with metrics.SMTP_SEND_DURATION.time(), \
+                    smtplib.SMTP(host=smtp_host, port=smtp_port) as smtp:
                 smtp.send_message(message)
         except smtplib.SMTPException as exception:
             app.logger.error(f'Error while sending e-mail: {exception}')
@@ -0,0 +1,5 @@
+import flask_init
+import models
+import resources
+
+app = flask_init.app
@@ -0,0 +1,384 @@
+"""
+End-to-end load benchmark of the web_api and auth_api routes.
+
+Every scenario sends --requests requests to one route from --concurrency
+threads and reports throughput, latency percentiles and the error rate
+(exceptions and unexpected status codes). Runs against the docker-compose
+stack by default, or any local stand-ins given by --web-url/--auth-url.
+
+The benchmark user must exist and be able to log in. Its post, comment and
+subcomment are created before and deleted after the run; the write
+scenarios create and then delete their own rows, and user_patch writes the
+user's own first name back, so runs leave the data as they found it.
+register only runs when named in --scenarios: it sends e-mails (keep it to
+a catch-all SMTP server such as the docker-compose maildev), its pending
+registrations are deleted from --redis-url after the run.
+
+Usage:
+    python benchmark/load_benchmark.py --username <un> --password <pw>
+        [--concurrency 8] [--requests 200] [--scenarios post_all,login]
+        [--redis-url redis://localhost:6379/0]
+        [--save-baseline baselines/local.json]
+        [--baseline baselines/local.json] [--tolerance 0.2]
+
+Exits with 1 when a result regressed against --baseline.
+"""
+import argparse
+import base64
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+import redis
+import requests
+
+# 1x1 transparent PNG, the media of the benchmark posts
+PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhf'
+    'DwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+
+class Client():
+    """
+    Per-thread keep-alive sessions to both services, with the benchmark
+    user's tokens.
+    """
+    def __init__(self, web_url: str, auth_url: str, timeout: float):
+        self.web_url = web_url.rstrip('/')
+        self.auth_url = auth_url.rstrip('/')
+        self.timeout = timeout
+        self.refresh_token = None
+        self.access_token = None
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def login(self, username: str, password: str) -> requests.Response:
+        return self.session.get(
+            f'{self.auth_url}/login', auth=(username, password),
+            timeout=self.timeout)
+
+    def auth(self, method: str, path: str, **kwargs) -> requests.Response:
+        return self.session.request(
+            method, f'{self.auth_url}{path}', timeout=self.timeout, **kwargs)
+
+    def web(self, method: str, path: str, headers: dict = None,
+            **kwargs) -> requests.Response:
+        headers = dict(headers or {}, Authorization=self.access_token)
+        return self.session.request(
+            method, f'{self.web_url}{path}', headers=headers,
+            timeout=self.timeout, **kwargs)
+
+
+class Fixtures():
+    """
+    Rows the scenarios read: the benchmark user, its post, comment and
+    subcomment, the ids created by write scenarios for the matching
+    delete scenarios and the e-mails of the started registrations.
+    """
+    def __init__(
+            self, client: Client, username: str, password: str,
+            redis_url: str):
+        self.client = client
+        self.username = username
+        self.password = password
+        self.redis_url = redis_url
+        self.created = {'post': queue.Queue(), 'comment': queue.Queue()}
+        self.registered = queue.Queue()
+
+    def set_up(self):
+        response = self.client.login(self.username, self.password)
+        response.raise_for_status()
+        self.client.refresh_token = response.json()['refresh_token']
+        self.client.access_token = response.json()['access_token']
+
+        response = self.client.web('GET', '/user')
+        response.raise_for_status()
+        self.user_id = response.json()['user']['id']
+        self.first_name = response.json()['user']['first_name']
+        if self.first_name is None:
+            print('The benchmark user has no first name, user_patch sets it')
+
+        self.post_id = create_post(self.client)
+        self.comment_id = self.client.web(
+            'POST', f'/post/{self.post_id}/comment',
+            data={'text': 'Benchmark'}).json()['comment']['id']
+        self.client.web(
+            'POST', f'/post/comment/{self.comment_id}/subcomment',
+            data={'text': 'Benchmark'}).raise_for_status()
+
+        response = self.client.web('GET', f'/post/{self.post_id}')
+        self.post_etag = response.headers.get('ETag')
+        response = self.client.web('GET', '/post/all?limit=1')
+        self.next_cursor = response.json().get('next_cursor') or ''
+
+    def tear_down(self):
+        # Rows of create scenarios run without their delete scenario
+        for kind, path in (
+                ('comment', '/post/comment/{}'), ('post', '/post/{}')):
+            for row_id in iter(lambda: _pop_created(self, kind), None):
+                self.client.web('DELETE', path.format(row_id))
+        # Deletes the comment and subcomment as well
+        self.client.web('DELETE', f'/post/{self.post_id}')
+
+        emails = list(iter(lambda: _pop_queued(self.registered), None))
+        if emails:
+            # Pending registrations are keyed by e-mail
+            redis.Redis.from_url(self.redis_url).delete(*emails)
+
+
+def create_post(client: Client) -> int:
+    response = client.web(
+        'POST', '/post', data={'description': 'Benchmark'},
+        files={'file': ('benchmark.png', PNG, 'image/png')})
+    response.raise_for_status()
+    return response.json()['post']['id']
+
+
+def _pop_queued(values: queue.Queue):
+    try:
+        return values.get_nowait()
+    except queue.Empty:
+        return None
+
+
+def _pop_created(fixtures: Fixtures, kind: str):
+    return _pop_queued(fixtures.created[kind])
+
+
+def _registered(fixtures: Fixtures) -> str:
+    email = f'benchmark-{uuid.uuid4().hex}@example.com'
+    fixtures.registered.put(email)
+    return email
+
+
+def _created(kind: str, response: requests.Response, fixtures: Fixtures):
+    if response.ok:
+        fixtures.created[kind].put(response.json()[kind]['id'])
+    return response
+
+
+# name -> (expected status codes, request(client, fixtures)); run in this
+# order, deletes after the matching creates
+SCENARIOS = {
+    'login': ({200}, lambda c, f: c.login(f.username, f.password)),
+    'token_refresh': ({200}, lambda c, f: c.auth(
+        'GET', '/token', headers={'Authorization': c.refresh_token})),
+    # Only the first steps, the others need the e-mailed codes
+    'register': ({201}, lambda c, f: c.auth(
+        'POST', '/register', json={'email': _registered(f)})),
+    'recover_password': ({400}, lambda c, f: c.auth(
+        'PATCH', '/recover_password',
+        json={'email': f'benchmark-{uuid.uuid4().hex}@example.com'})),
+    'user': ({200}, lambda c, f: c.web('GET', '/user')),
+    'post_all': ({200}, lambda c, f: c.web('GET', '/post/all')),
+    'post_all_next_page': ({200}, lambda c, f: c.web(
+        'GET', f'/post/all?cursor={f.next_cursor}')),
+    'post_all_stream': ({200}, lambda c, f: c.web(
+        'GET', '/post/all?stream=true&limit=200')),
+    'post_single': ({200}, lambda c, f: c.web(
+        'GET', f'/post/{f.post_id}')),
+    'post_single_not_modified': ({304}, lambda c, f: c.web(
+        'GET', f'/post/{f.post_id}',
+        headers={'If-None-Match': f.post_etag})),
+    'post_batch': ({200}, lambda c, f: c.web(
+        'GET', f'/post/batch?ids={f.post_id},{f.post_id + 1}')),
+    'posts_by_user_id': ({200}, lambda c, f: c.web(
+        'GET', f'/post/user/{f.user_id}')),
+    'posts_by_username': ({200}, lambda c, f: c.web(
+        'GET', f'/post/user/username/{f.username}')),
+    'comments': ({200}, lambda c, f: c.web(
+        'GET', f'/post/{f.post_id}/comment')),
+    'subcomments': ({200}, lambda c, f: c.web(
+        'GET', f'/post/comment/{f.comment_id}/subcomment')),
+    'user_patch': ({200}, lambda c, f: c.web(
+        'PATCH', '/user', data={'first_name': f.first_name or 'Benchmark'})),
+    'post_patch': ({200, 202}, lambda c, f: c.web(
+        'PATCH', f'/post/{f.post_id}', data={'description': 'Benchmark'})),
+    'post_create': ({201, 202}, lambda c, f: _created(
+        'post', c.web(
+            'POST', '/post', data={'description': 'Benchmark'},
+            files={'file': ('benchmark.png', PNG, 'image/png')}), f)),
+    'comment_create': ({201}, lambda c, f: _created(
+        'comment', c.web(
+            'POST', f'/post/{f.post_id}/comment',
+            data={'text': 'Benchmark'}), f)),
+    'subcomment_create': ({201}, lambda c, f: c.web(
+        'POST', f'/post/comment/{f.comment_id}/subcomment',
+        data={'text': 'Benchmark'})),
+    'comment_delete': ({200}, lambda c, f: c.web(
+        'DELETE', f'/post/comment/{_pop_created(f, "comment")}')),
+    'post_delete': ({200}, lambda c, f: c.web(
+        'DELETE', f'/post/{_pop_created(f, "post")}')),
+}
+# Only run when named in --scenarios, they send e-mails
+OPT_IN_SCENARIOS = {'register'}
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """
+    Nearest-rank percentile of an ascending list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent * len(sorted_values) / 100), 1)
+    return sorted_values[rank - 1]
+
+
+def run_scenario(
+        name: str, client: Client, fixtures: Fixtures, requests_count: int,
+        concurrency: int) -> dict:
+    expected_statuses, send = SCENARIOS[name]
+
+    def timed_request(_):
+        start = time.perf_counter()
+        try:
+            response = send(client, fixtures)
+            response.content  # streamed bodies are read to the end
+            ok = response.status_code in expected_statuses
+        except (requests.RequestException, ValueError, KeyError):
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, range(requests_count)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+
+    return {
+        'requests': requests_count,
+        'throughput': requests_count / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'error_rate': errors / requests_count,
+    }
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Scenarios slower (p95, p99, throughput) than the baseline by more than
+    the tolerance, or with more errors.
+    """
+    found = []
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+
+        for key in ('p95_ms', 'p99_ms'):
+            if result[key] > previous[key] * (1 + tolerance):
+                found.append(
+                    f'{name}: {key} {result[key]:.1f} > '
+                    f'{previous[key]:.1f}')
+        if result['throughput'] < previous['throughput'] * (1 - tolerance):
+            found.append(
+                f'{name}: throughput {result["throughput"]:.1f} < '
+                f'{previous["throughput"]:.1f}')
+        if result['error_rate'] > previous['error_rate']:
+            found.append(
+                f'{name}: error rate {result["error_rate"]:.2%} > '
+                f'{previous["error_rate"]:.2%}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--web-url', default=os.environ.get(
+            'BENCHMARK_WEB_URL', 'http://localhost:5000'))
+    parser.add_argument(
+        '--auth-url', default=os.environ.get(
+            'BENCHMARK_AUTH_URL', 'http://localhost:5001'))
+    parser.add_argument(
+        '--username', default=os.environ.get('BENCHMARK_USERNAME'))
+    parser.add_argument(
+        '--password', default=os.environ.get('BENCHMARK_PASSWORD'))
+    parser.add_argument(
+        '--redis-url', default=os.environ.get(
+            'BENCHMARK_REDIS_URL', 'redis://localhost:6379/0'),
+        help='Redis of auth_api, where register leaves its registrations')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument(
+        '--scenarios', default=','.join(
+            name for name in SCENARIOS if name not in OPT_IN_SCENARIOS),
+        help='Comma separated, run in the order of SCENARIOS')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--baseline')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='Allowed relative slowdown against the baseline')
+    args = parser.parse_args()
+
+    if not args.username or not args.password:
+        parser.error('--username and --password are required')
+
+    selected = set(args.scenarios.split(','))
+    unknown = selected - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+    client = Client(args.web_url, args.auth_url, args.timeout)
+    fixtures = Fixtures(
+        client, args.username, args.password, args.redis_url)
+    fixtures.set_up()
+
+    results = {}
+    print(f'{args.requests} requests per scenario, '
+          f'concurrency {args.concurrency}')
+    print(f'{"scenario":<26} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8} {"errors":>7}')
+    try:
+        for name in SCENARIOS:
+            if name not in selected:
+                continue
+            result = results[name] = run_scenario(
+                name, client, fixtures, args.requests, args.concurrency)
+            print(f'{name:<26} {result["throughput"]:8.1f} '
+                  f'{result["p50_ms"]:8.1f} {result["p95_ms"]:8.1f} '
+                  f'{result["p99_ms"]:8.1f} {result["error_rate"]:7.2%}')
+    finally:
+        fixtures.tear_down()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({
+                'created': datetime.datetime.now(
+                    datetime.timezone.utc).isoformat(),
+                'web_url': args.web_url,
+                'auth_url': args.auth_url,
+                'concurrency': args.concurrency,
+                'results': results,
+            }, baseline_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['concurrency'] != args.concurrency:
+            print(f'Baseline was run at concurrency '
+                  f'{baseline["concurrency"]}')
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Prometheus metrics shared by the Flask services: requests, their SQL
+queries and the SQLAlchemy pool, exposed on /metrics. Under gunicorn
+every worker writes its values to the prometheus_multiproc_dir directory
+and /metrics aggregates them (see the services' gunicorn_config.py).
+"""
+import os
+import time
+import flask
+import prometheus_client
+import prometheus_client.multiprocess
+import sqlalchemy
+
+REQUESTS = prometheus_client.Counter(
+    'http_requests_total', 'HTTP requests',
+    ['method', 'route', 'status'])
+REQUEST_LATENCY = prometheus_client.Histogram(
+    'http_request_duration_seconds', 'HTTP request latency',
+    ['method', 'route'])
+REQUESTS_IN_PROGRESS = prometheus_client.Gauge(
+    'http_requests_in_progress', 'HTTP requests being handled',
+    multiprocess_mode='livesum')
+SQL_QUERIES = prometheus_client.Histogram(
+    'http_request_sql_queries', 'SQL queries issued by a request',
+    ['route'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100, float('inf')))
+SQL_DURATION = prometheus_client.Histogram(
+    'http_request_sql_duration_seconds',
+    'Time a request spent in SQL queries', ['route'])
+POOL_CHECKOUT_WAIT = prometheus_client.Histogram(
+    'sqlalchemy_pool_checkout_wait_seconds',
+    'Time waited for a connection from the SQLAlchemy pool',
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30, float('inf')))
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """
+    The default pool, reporting how long checkouts wait for a connection.
+    """
+    def _do_get(self):
+        with POOL_CHECKOUT_WAIT.time():
+            return super()._do_get()
+
+
+def _route() -> str:
+    url_rule = flask.request.url_rule
+    return url_rule.rule if url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    flask.g.metrics_start = time.perf_counter()
+    REQUESTS_IN_PROGRESS.inc()
+
+
+def _after_request(response):
+    flask.g.metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exception):
+    # Runs after streamed bodies too, so their queries are counted
+    start = flask.g.pop('metrics_start', None)
+    if start is None:
+        return
+
+    route = _route()
+    method = flask.request.method
+    status = flask.g.pop('metrics_status', 500)
+
+    REQUEST_LATENCY.labels(method, route).observe(time.perf_counter() - start)
+    REQUESTS.labels(method, route, status).inc()
+    SQL_QUERIES.labels(route).observe(flask.g.pop('metrics_sql_queries', 0))
+    SQL_DURATION.labels(route).observe(
+        flask.g.pop('metrics_sql_duration', 0.0))
+    REQUESTS_IN_PROGRESS.dec()
+
+
+def _before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(
+        time.perf_counter())
+
+
+def _after_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['metrics_query_start'].pop()
+    if flask.has_request_context():
+        g = flask.g
+        g.metrics_sql_queries = g.get('metrics_sql_queries', 0) + 1
+        g.metrics_sql_duration = \
+            g.get('metrics_sql_duration', 0.0) + time.perf_counter() - start
+
+
+def _metrics():
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    return flask.Response(
+        prometheus_client.generate_latest(registry),
+        content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def init_app(app: flask.Flask):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', _metrics)
+
+    sqlalchemy.event.listen(
+        sqlalchemy.engine.Engine, 'before_cursor_execute',
+        _before_cursor_execute)
+    sqlalchemy.event.listen(
+        sqlalchemy.engine.Engine, 'after_cursor_execute',
+        _after_cursor_execute)
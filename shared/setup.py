@@ -0,0 +1,9 @@
+from setuptools import setup
+
+setup(
+    name='service_metrics',
+    version='1.0.0',
+    description='Prometheus metrics shared by the Flask services',
+    py_modules=['service_metrics'],
+    install_requires=['flask', 'prometheus_client', 'sqlalchemy'],
+)
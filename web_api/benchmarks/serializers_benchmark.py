@@ -0,0 +1,120 @@
+"""
+Microbenchmark of the feed serialization paths.
+
+Compares the output* model methods with the compiled serializers on an
+in-memory post graph (no database needed).
+
+Usage:
+    python benchmarks/serializers_benchmark.py [--posts 200] [--repeat 5]
+"""
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+# Inserting path to the main app's files
+app_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, app_path + '/../')
+
+import models
+import serializers
+
+
+def build_feed(post_count: int, user_count: int, comment_count: int,
+               subcomment_count: int):
+    created = datetime.datetime(
+        2020, 1, 1, tzinfo=datetime.timezone.utc)
+    users = [
+        models.User(
+            id=user_id,
+            email=f'user{user_id}@email.com',
+            username=f'user{user_id}',
+            first_name='Jimmy',
+            last_name='Jensson',
+            birthday=datetime.date(1991, 5, 5),
+            profile_image=f'user{user_id}.jpg',
+            created=created)
+        for user_id in range(user_count)
+    ]
+
+    posts = []
+    for post_id in range(post_count):
+        post = models.Post(
+            id=post_id, user_id=post_id % user_count,
+            resource=f'post{post_id}.jpg', description='Test image',
+            created=created)
+        post.user = users[post.user_id]
+
+        comments = []
+        for comment_id in range(comment_count):
+            comment = models.Comment(
+                id=comment_id, post_id=post_id,
+                user_id=(post_id + comment_id) % user_count,
+                text='Test text', created=created)
+            comment.user = users[comment.user_id]
+
+            subcomments = []
+            for subcomment_id in range(subcomment_count):
+                subcomment = models.SubComment(
+                    id=subcomment_id, comment_id=comment_id,
+                    user_id=(post_id + subcomment_id) % user_count,
+                    text='Test text', created=created)
+                subcomment.user = users[subcomment.user_id]
+                subcomments.append(subcomment)
+
+            comment.subcomments = subcomments
+            comments.append(comment)
+
+        post.comments = comments
+        posts.append(post)
+
+    return users[0], posts
+
+
+def reflective_as_dict(instance):
+    return {c.name: getattr(instance, c.name)
+            for c in instance.__table__.columns}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--comments', type=int, default=10)
+    parser.add_argument('--subcomments', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    auth_user, posts = build_feed(
+        args.posts, args.users, args.comments, args.subcomments)
+
+    def output_methods():
+        return [post.output_with_permissions_and_users(auth_user)
+                for post in posts]
+
+    def feed_serializer():
+        serializer = serializers.FeedSerializer(auth_user)
+        return [serializer.post(post) for post in posts]
+
+    post_columns = serializers.ColumnSerializer.for_model(models.Post)
+
+    cases = [
+        ('Post.output_with_permissions_and_users', output_methods),
+        ('FeedSerializer.post', feed_serializer),
+        ('as_dict (reflective)',
+            lambda: [reflective_as_dict(post) for post in posts]),
+        ('ColumnSerializer',
+            lambda: [post_columns(post) for post in posts]),
+    ]
+
+    print(f'{args.posts} posts, {args.users} users, '
+          f'{args.comments} comments/post, '
+          f'{args.subcomments} subcomments/comment')
+    for name, function in cases:
+        best = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print(f'{name:<42} {best * 1000:10.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
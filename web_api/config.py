@@ -16,6 +16,14 @@ class BaseConfig(object):
     ENV = get_env_variable('ENV')
     SECRET_KEY = get_env_variable('SECRET_KEY')
     SECRET_KEY_EXPIRATION = 604800  # Expiration in seconds - 1 week
+    AUTH_TOKEN_CACHE_SIZE = 10000
+    # In seconds, capped by the token exp. Bounds how long other processes
+    # may serve a renamed user on reads (writes read the user again)
+    AUTH_TOKEN_CACHE_TTL = 60
+    USERNAME_CACHE_SIZE = 10000
+    # In seconds, bounds how long other processes may serve a renamed or
+    # deleted username
+    USERNAME_CACHE_TTL = 60
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # Silence the deprecation warning
     SQLALCHEMY_DATABASE_URI = 'postgresql+psycopg2://{user}:{pw}@{url}/{db}' \
@@ -27,6 +35,57 @@ class BaseConfig(object):
     MEDIA_ALLOWED_EXTENSIONS = {
         'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'
     }
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
+    MEDIA_UPLOAD_URL = (
+        'http://static-file-server:25478/upload?token=f9403fc5f537b4ab332d')
+    MEDIA_EXISTS_URL = (
+        'http://static-file-server:25478/files/'
+        '{file_name}?token=f9403fc5f537b4ab332d')
+    MEDIA_UPLOAD_TIMEOUT = (3.05, 30)  # (connect, read) in seconds
+    MEDIA_UPLOAD_CHUNK_SIZE = 64 * 1024
+    MEDIA_UPLOAD_POOL_SIZE = 10
+    MEDIA_UPLOAD_ASYNC = False  # Spool uploads and ship them in background
+    MEDIA_SPOOL_FOLDER = '/tmp/media-spool'
+    MEDIA_UPLOAD_WORKERS = 4
+    MEDIA_UPLOAD_RETRIES = 5
+    MEDIA_UPLOAD_BACKOFF = 1  # Seconds, doubled after every failed attempt
+    MEDIA_DERIVATIVES = {  # Longest edge in pixels
+        'thumbnail': 160,
+        'small': 480,
+        'medium': 1080
+    }
+    MEDIA_DERIVATIVE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    MEDIA_DERIVATIVE_WORKERS = 2
+    POST_PAGE_DEFAULT_LIMIT = 20
+    POST_PAGE_MAX_LIMIT = 100
+    POST_STREAM_MAX_LIMIT = 10000
+    POST_STREAM_BATCH_SIZE = 100
+    POST_MULTI_GET_MAX_IDS = 100
+    # Text search configuration of the search_vector triggers (migration
+    # 9c5b3e7a2d48), queries must use the same one
+    SEARCH_TEXT_CONFIG = 'english'
+    SEARCH_QUERY_MAX_LENGTH = 256
+    COMMENT_PAGE_DEFAULT_LIMIT = 20
+    COMMENT_PAGE_MAX_LIMIT = 100
+    EMBEDDED_COMMENT_LIMIT = 3  # First page of comments embedded in posts
+    EMBEDDED_SUBCOMMENT_LIMIT = 3
+    REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+    REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+    FEED_INDEX_ENABLED = False  # Page /post/all from the Redis feed index
+    FEED_INDEX_REDIS_DB = 1  # db 0 belongs to auth_api
+    FEED_INDEX_KEY = 'feed:posts'
+    FEED_INDEX_TIMEOUT = 0.5  # Seconds, then the database is used instead
+    # Production serving mode (gunicorn, see gunicorn_config.py)
+    WSGI_BIND = '0.0.0.0:5000'
+    WSGI_WORKERS = 2
+    WSGI_THREADS = 4
+    WSGI_TIMEOUT = 30  # Seconds before a silent worker is restarted
+    WSGI_GRACEFUL_TIMEOUT = 30
+    WSGI_KEEPALIVE = 5
+    WSGI_MAX_REQUESTS = 10000  # Recycle workers, bounding memory growth
+    WSGI_MAX_REQUESTS_JITTER = 1000
+    # Metrics of the workers are aggregated through the files in here
+    METRICS_MULTIPROC_DIR = '/tmp/prometheus_multiproc'
 
 
 class DevConfig(BaseConfig):
@@ -51,8 +110,28 @@ class TestConfig(BaseConfig):
 class StageConfig(BaseConfig):
     DEBUG = False
     TESTING = False
+    MEDIA_UPLOAD_ASYNC = True
+    FEED_INDEX_ENABLED = True
+    # Per worker: one connection per thread, plus background work
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': BaseConfig.WSGI_THREADS,
+        'max_overflow': 2,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    }
 
 
 class ProdConfig(BaseConfig):
     DEBUG = False
     TESTING = False
+    MEDIA_UPLOAD_ASYNC = True
+    FEED_INDEX_ENABLED = True
+    WSGI_WORKERS = (os.cpu_count() or 1) + 1
+    WSGI_THREADS = 8
+    # Per worker: one connection per thread, plus background work
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': WSGI_THREADS,
+        'max_overflow': 2,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    }
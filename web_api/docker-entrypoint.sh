@@ -10,4 +10,12 @@
 
 # python manage.py db upgrade
 
-python app.py
\ No newline at end of file
+# Pre-forking WSGI server in stage/prod, development server otherwise
+case "$APP_SETTINGS" in
+    config.StageConfig|config.ProdConfig)
+        exec gunicorn --config gunicorn_config.py wsgi:app
+        ;;
+    *)
+        exec python app.py
+        ;;
+esac
@@ -1,7 +1,17 @@
 import os
 import flask_restful
+import flask_sqlalchemy
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+import service_metrics
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def apply_pool_defaults(self, app, options):
+        super().apply_pool_defaults(app, options)
+        # Driver specific pools (sqlite) and SQLALCHEMY_ENGINE_OPTIONS
+        # still take precedence
+        options['poolclass'] = service_metrics.TimedQueuePool
+
 
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
@@ -9,3 +19,5 @@ app.config.from_object(os.environ['APP_SETTINGS'])
 api = flask_restful.Api(app)
 
 db = SQLAlchemy(app)
+
+service_metrics.init_app(app)
@@ -0,0 +1,70 @@
+"""
+Gunicorn settings of the production serving mode, read from the WSGI_*
+settings of the APP_SETTINGS config.
+"""
+import os
+import shutil
+import threading
+import time
+import werkzeug.utils
+
+settings = werkzeug.utils.import_string(os.environ['APP_SETTINGS'])
+
+# Set before the app (and prometheus_client) is imported, emptied so that
+# no values of a previous run are aggregated
+multiproc_dir = os.environ.setdefault(
+    'prometheus_multiproc_dir', settings.METRICS_MULTIPROC_DIR)
+shutil.rmtree(multiproc_dir, ignore_errors=True)
+os.makedirs(multiproc_dir)
+
+# Media uploads spooled before the server started were left pending by its
+# previous run
+started = time.time()
+
+bind = settings.WSGI_BIND
+workers = settings.WSGI_WORKERS
+worker_class = 'gthread'
+threads = settings.WSGI_THREADS
+timeout = settings.WSGI_TIMEOUT
+graceful_timeout = settings.WSGI_GRACEFUL_TIMEOUT
+keepalive = settings.WSGI_KEEPALIVE
+max_requests = settings.WSGI_MAX_REQUESTS
+max_requests_jitter = settings.WSGI_MAX_REQUESTS_JITTER
+
+# Import the app once in the master, workers are forked from it
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Database connections must not be shared across processes: every
+    # worker opens its own pool
+    import flask_init
+    flask_init.db.engine.dispose()
+
+    # The first worker takes over the pending media uploads, in background
+    # so as not to delay its boot
+    if settings.MEDIA_UPLOAD_ASYNC and worker.age == 1:
+        threading.Thread(target=resume_media_uploads, daemon=True).start()
+
+
+def resume_media_uploads():
+    import flask_init
+    import models
+    app = flask_init.app
+    with app.app_context():
+        try:
+            count = models.Post.resume_media_uploads(spooled_before=started)
+            app.logger.info(f'Resumed the media uploads of {count} posts')
+        except Exception:
+            app.logger.exception('Resuming the media uploads failed')
+        finally:
+            flask_init.db.session.remove()
+
+
+def child_exit(server, worker):
+    # Drops the live gauges (in-flight requests) of the dead worker
+    import prometheus_client.multiprocess
+    prometheus_client.multiprocess.mark_process_dead(worker.pid)
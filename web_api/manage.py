@@ -1,13 +1,105 @@
+import time
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from flask_init import app, db
 import models
+import seeder
+import utils
 
 migrate = Migrate(app, db)
 
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def reconcile_counters():
+    """
+    Recounts the POST/COMMENT comment and subcomment counters
+    """
+    comments_fixed = models.Comment.reconcile_counters()
+    posts_fixed = models.Post.reconcile_counters()
+    db.session.commit()
+
+    print(f'Reconciled counters of {comments_fixed} comments '
+          f'and {posts_fixed} posts')
+
+
+@manager.command
+def rebuild_feed_index():
+    """
+    Reindexes all the posts into the Redis feed index
+    """
+    count = utils.feed_index.rebuild()
+
+    print(f'Indexed {count} posts')
+
+
+@manager.command
+def backfill_media_variants():
+    """
+    Records the variants the file server already has for the media stored
+    before variants were recorded
+    """
+    filenames = {
+        filename for filename, in db.session.query(models.Post.resource)
+        .filter(models.Post.resource_variant_names.is_(None)).distinct()
+    } | {
+        filename for filename, in db.session.query(models.User.profile_image)
+        .filter(
+            models.User.profile_image.isnot(None),
+            models.User.profile_image_variant_names.is_(None)).distinct()
+    }
+
+    count = 0
+    for filename in filenames:
+        variants = [
+            variant for variant, variant_name
+            in utils.File.variant_names(filename).items()
+            if utils.File.exists(variant_name)
+        ]
+        if variants:
+            models.record_media_variants(filename, variants)
+            count += 1
+
+    print(f'Recorded the variants of {count} of {len(filenames)} media files')
+
+
+@manager.option('--users', type=int, default=10000)
+@manager.option('--posts', type=int, default=100000)
+@manager.option('--comments-per-post', type=float, default=10)
+@manager.option('--subcomments-per-comment', type=float, default=2)
+@manager.option('--seed', type=int, default=0)
+@manager.option('--chunk-size', type=int, default=10000)
+@manager.option('--password', default='seed_password')
+def seed(users, posts, comments_per_post, subcomments_per_comment, seed,
+         chunk_size, password):
+    """
+    Bulk inserts synthetic users (seed_user_<id>, all with the same
+    password), posts, comments and subcomments with power-law authors and
+    viral posts. The same seed gives the same data.
+    """
+    data_seeder = seeder.Seeder(
+        seed=seed, chunk_size=chunk_size, password=password)
+    start = time.perf_counter()
+
+    user_ids = data_seeder.seed_users(users)
+    data_seeder.seed_posts(
+        user_ids, posts=posts, comments_per_post=comments_per_post,
+        subcomments_per_comment=subcomments_per_comment)
+    data_seeder.finish()
+
+    elapsed = time.perf_counter() - start
+    total = 0
+    for table, (rows, rows_per_second) in data_seeder.report.items():
+        total += rows
+        print(f'{table:<12} {rows:>12,} rows {rows_per_second:>12,.0f} rows/s')
+    print(f'{"total":<12} {total:>12,} rows {total / elapsed:>12,.0f} rows/s '
+          f'({elapsed:.1f} s)')
+    if app.config['FEED_INDEX_ENABLED']:
+        print('Run rebuild_feed_index to index the new posts')
+
+
 if __name__ == '__main__':
     manager.run()
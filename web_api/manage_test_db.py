@@ -1,14 +1,61 @@
+import datetime
 from flask_init import app, db
 import models
 
-def test_db_init():
-    # TODO: Populate db for integration testing
-    user = models.User()
-    user.username = 'test_username'
 
-    db.session.add(user)
+def populate(
+        users: int = 10, posts_per_user: int = 5, comments_per_post: int = 5,
+        subcomments_per_comment: int = 2):
+    """
+    Fills the database with users, posts, comments and subcomments, with
+    maintained counters and distinct creation times. Ids start at 1; the
+    users are user_1, user_2, ...
+    """
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def created(row_id: int) -> datetime.datetime:
+        return start + datetime.timedelta(minutes=row_id)
+
+    posts = users * posts_per_user
+    comments = posts * comments_per_post
+    subcomments = comments * subcomments_per_comment
+
+    db.session.execute(models.User.__table__.insert(), [
+        {'id': user_id, 'username': f'user_{user_id}',
+         'email': f'user_{user_id}@email.com', 'profile_image': 'img.jpg',
+         'created': created(user_id)}
+        for user_id in range(1, users + 1)])
+    db.session.execute(models.Post.__table__.insert(), [
+        {'id': post_id, 'user_id': (post_id - 1) % users + 1,
+         'resource': 'img.jpg', 'created': created(post_id),
+         'comment_count': comments_per_post,
+         'subcomment_count': comments_per_post * subcomments_per_comment}
+        for post_id in range(1, posts + 1)])
+    db.session.execute(models.Comment.__table__.insert(), [
+        {'id': comment_id,
+         'post_id': (comment_id - 1) // comments_per_post + 1,
+         'user_id': (comment_id - 1) % users + 1, 'text': 'Test text',
+         'created': created(comment_id),
+         'subcomment_count': subcomments_per_comment}
+        for comment_id in range(1, comments + 1)])
+    db.session.execute(models.SubComment.__table__.insert(), [
+        {'id': subcomment_id,
+         'comment_id': (subcomment_id - 1) // subcomments_per_comment + 1,
+         'user_id': (subcomment_id - 1) % users + 1, 'text': 'Test text',
+         'created': created(subcomment_id)}
+        for subcomment_id in range(1, subcomments + 1)])
+
+    if db.engine.dialect.name == 'postgresql':
+        # Ids were given explicitly, move the sequences past them
+        for model in (
+                models.User, models.Post, models.Comment, models.SubComment):
+            table = model.__tablename__
+            db.session.execute(
+                f'SELECT setval(pg_get_serial_sequence(\'"{table}"\', '
+                f'\'id\'), (SELECT max(id) FROM "{table}"))')
     db.session.commit()
 
 
 if __name__ == '__main__':
-    test_db_init()
+    with app.app_context():
+        populate()
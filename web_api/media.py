@@ -0,0 +1,45 @@
+"""
+Image processing of the media pipeline, run in pool processes. Kept free
+of the app, so that running a task only imports this module and PIL.
+Spawned processes still import the main module of the parent first: the
+gunicorn launcher in production, but the whole app under `python app.py`.
+"""
+import collections
+import os
+import uuid
+import PIL.Image
+
+SpooledUpload = collections.namedtuple(
+    'SpooledUpload', ['path', 'filename', 'content_type'])
+
+
+def variant_name(filename: str, variant: str) -> str:
+    """
+    Storage name of a resized variant of an image.
+    """
+    name, extension = os.path.splitext(filename)
+    return f'{name}_{variant}{extension}'
+
+
+def render_derivatives(
+        spooled_upload: SpooledUpload, variants: dict,
+        spool_folder: str) -> list:
+    """
+    Writes a downscaled copy of the image for every variant (longest edge in
+    pixels) next to it. Runs in a worker process.
+    """
+    derivatives = []
+
+    with PIL.Image.open(spooled_upload.path) as image:
+        image_format = image.format
+        for variant, size in variants.items():
+            derivative = image.copy()
+            derivative.thumbnail((size, size))
+            path = os.path.join(spool_folder, uuid.uuid4().hex)
+            derivative.save(path, format=image_format)
+            derivatives.append(SpooledUpload(
+                path=path,
+                filename=variant_name(spooled_upload.filename, variant),
+                content_type=spooled_upload.content_type))
+
+    return derivatives
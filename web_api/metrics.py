@@ -0,0 +1,10 @@
+"""
+Metrics of the service on top of the shared ones (see service_metrics),
+exposed on the same /metrics endpoint.
+"""
+import prometheus_client
+
+MEDIA_UPLOAD_DURATION = prometheus_client.Histogram(
+    'media_upload_duration_seconds',
+    'Duration of media uploads to the static file server',
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, float('inf')))
@@ -0,0 +1,28 @@
+"""Add POST/USER write counters for conditional GETs
+
+Revision ID: 2c9e7d4a6f03
+Revises: 8b3f0c6d2e14
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c9e7d4a6f03'
+down_revision = '8b3f0c6d2e14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('POST', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('USER', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('USER', 'version')
+    op.drop_column('POST', 'version')
@@ -0,0 +1,33 @@
+"""Record the stored media variants
+
+Revision ID: 3b8e5f1d7a62
+Revises: 6f2d8a4c1e59
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e5f1d7a62'
+down_revision = '6f2d8a4c1e59'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('POST', sa.Column(
+        'resource_variant_names', sa.String(length=64), nullable=True))
+    op.add_column('USER', sa.Column(
+        'profile_image_variant_names', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_POST_resource'), 'POST', ['resource'])
+    op.create_index(
+        op.f('ix_USER_profile_image'), 'USER', ['profile_image'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_USER_profile_image'), table_name='USER')
+    op.drop_index(op.f('ix_POST_resource'), table_name='POST')
+    op.drop_column('USER', 'profile_image_variant_names')
+    op.drop_column('POST', 'resource_variant_names')
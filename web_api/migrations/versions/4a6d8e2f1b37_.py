@@ -0,0 +1,44 @@
+"""Indexes for foreign keys and keyset ordering columns
+
+Revision ID: 4a6d8e2f1b37
+Revises: 7e4a1b9c3d25
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a6d8e2f1b37'
+down_revision = '7e4a1b9c3d25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_POST_created_id', 'POST',
+        [sa.text('created DESC'), sa.text('id DESC')])
+    op.create_index(
+        'ix_POST_user_id_created_id', 'POST',
+        ['user_id', sa.text('created DESC'), sa.text('id DESC')])
+    op.create_index(
+        'ix_COMMENT_post_id_created_id', 'COMMENT',
+        ['post_id', sa.text('created DESC'), sa.text('id DESC')])
+    op.create_index(op.f('ix_COMMENT_user_id'), 'COMMENT', ['user_id'])
+    op.create_index(
+        'ix_SUBCOMMENT_comment_id_created_id', 'SUBCOMMENT',
+        ['comment_id', sa.text('created DESC'), sa.text('id DESC')])
+    op.create_index(
+        op.f('ix_SUBCOMMENT_user_id'), 'SUBCOMMENT', ['user_id'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_SUBCOMMENT_user_id'), table_name='SUBCOMMENT')
+    op.drop_index(
+        'ix_SUBCOMMENT_comment_id_created_id', table_name='SUBCOMMENT')
+    op.drop_index(op.f('ix_COMMENT_user_id'), table_name='COMMENT')
+    op.drop_index('ix_COMMENT_post_id_created_id', table_name='COMMENT')
+    op.drop_index('ix_POST_user_id_created_id', table_name='POST')
+    op.drop_index('ix_POST_created_id', table_name='POST')
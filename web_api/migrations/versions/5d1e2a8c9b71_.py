@@ -0,0 +1,26 @@
+"""Add POST.media_state for asynchronous media uploads
+
+Revision ID: 5d1e2a8c9b71
+Revises: cf2a5166b744
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1e2a8c9b71'
+down_revision = 'cf2a5166b744'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('POST', sa.Column(
+        'media_state', sa.String(length=16), server_default='ready',
+        nullable=False))
+
+
+def downgrade():
+    op.drop_column('POST', 'media_state')
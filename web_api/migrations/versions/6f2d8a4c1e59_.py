@@ -0,0 +1,25 @@
+"""Add POST edit counter for conditional PATCH
+
+Revision ID: 6f2d8a4c1e59
+Revises: 9c5b3e7a2d48
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f2d8a4c1e59'
+down_revision = '9c5b3e7a2d48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('POST', sa.Column(
+        'revision', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('POST', 'revision')
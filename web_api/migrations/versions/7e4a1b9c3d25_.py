@@ -0,0 +1,42 @@
+"""ON DELETE CASCADE foreign keys for users, posts and comments
+
+Revision ID: 7e4a1b9c3d25
+Revises: 2c9e7d4a6f03
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e4a1b9c3d25'
+down_revision = '2c9e7d4a6f03'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table), named by the PostgreSQL convention
+FOREIGN_KEYS = [
+    ('POST', 'user_id', 'USER'),
+    ('COMMENT', 'post_id', 'POST'),
+    ('COMMENT', 'user_id', 'USER'),
+    ('SUBCOMMENT', 'comment_id', 'COMMENT'),
+    ('SUBCOMMENT', 'user_id', 'USER'),
+]
+
+
+def _replace_foreign_keys(ondelete):
+    for table, column, referred_table in FOREIGN_KEYS:
+        name = f'{table}_{column}_fkey'
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(
+            name, table, referred_table, [column], ['id'],
+            ondelete=ondelete)
+
+
+def upgrade():
+    _replace_foreign_keys(ondelete='CASCADE')
+
+
+def downgrade():
+    _replace_foreign_keys(ondelete=None)
@@ -0,0 +1,46 @@
+"""Add POST/COMMENT engagement counters
+
+Revision ID: 8b3f0c6d2e14
+Revises: 5d1e2a8c9b71
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b3f0c6d2e14'
+down_revision = '5d1e2a8c9b71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('POST', sa.Column(
+        'comment_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('POST', sa.Column(
+        'subcomment_count', sa.Integer(), server_default='0',
+        nullable=False))
+    op.add_column('COMMENT', sa.Column(
+        'subcomment_count', sa.Integer(), server_default='0',
+        nullable=False))
+
+    # Backfill, same as `manage.py reconcile_counters`
+    op.execute(
+        'UPDATE "COMMENT" SET subcomment_count = ('
+        'SELECT count(*) FROM "SUBCOMMENT" '
+        'WHERE "SUBCOMMENT".comment_id = "COMMENT".id)')
+    op.execute(
+        'UPDATE "POST" SET comment_count = ('
+        'SELECT count(*) FROM "COMMENT" '
+        'WHERE "COMMENT".post_id = "POST".id), '
+        'subcomment_count = ('
+        'SELECT coalesce(sum(subcomment_count), 0) FROM "COMMENT" '
+        'WHERE "COMMENT".post_id = "POST".id)')
+
+
+def downgrade():
+    op.drop_column('COMMENT', 'subcomment_count')
+    op.drop_column('POST', 'subcomment_count')
+    op.drop_column('POST', 'comment_count')
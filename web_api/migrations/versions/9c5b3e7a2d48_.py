@@ -0,0 +1,53 @@
+"""Full-text search vectors of post descriptions and comments
+
+Revision ID: 9c5b3e7a2d48
+Revises: 4a6d8e2f1b37
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9c5b3e7a2d48'
+down_revision = '4a6d8e2f1b37'
+branch_labels = None
+depends_on = None
+
+# Must match SEARCH_TEXT_CONFIG
+TEXT_CONFIG = 'pg_catalog.english'
+
+# table -> searched column
+SEARCHED_COLUMNS = {'POST': 'description', 'COMMENT': 'text'}
+
+
+def upgrade():
+    for table, column in SEARCHED_COLUMNS.items():
+        op.add_column(
+            table,
+            sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+
+        # Kept in sync on every write of the searched column
+        op.execute(
+            f'CREATE TRIGGER "{table}_search_vector_update" '
+            f'BEFORE INSERT OR UPDATE OF "{column}" ON "{table}" '
+            f'FOR EACH ROW EXECUTE PROCEDURE '
+            f'tsvector_update_trigger(search_vector, \'{TEXT_CONFIG}\', '
+            f'{column})')
+        op.execute(
+            f'UPDATE "{table}" SET search_vector = '
+            f'to_tsvector(\'{TEXT_CONFIG}\', coalesce("{column}", \'\'))')
+
+        op.create_index(
+            f'ix_{table}_search_vector', table, ['search_vector'],
+            postgresql_using='gin')
+
+
+def downgrade():
+    for table in SEARCHED_COLUMNS:
+        op.drop_index(f'ix_{table}_search_vector', table_name=table)
+        op.execute(
+            f'DROP TRIGGER "{table}_search_vector_update" ON "{table}"')
+        op.drop_column(table, 'search_vector')
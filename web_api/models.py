@@ -1,38 +1,204 @@
 import os
+import functools
 import json
 import werkzeug
 from passlib.apps import custom_app_context as pwd_context
 import itsdangerous
 import sqlalchemy
 from flask_init import app, db
+import serializers
 import utils
 
 
+def _search_vector(model):
+    """
+    The search_vector column of a table (see Post.search_page).
+    """
+    return sqlalchemy.literal_column(f'"{model.__tablename__}".search_vector')
+
+
+class VersionConflict(Exception):
+    """
+    The row was edited since the version the client based its edit on.
+    """
+
+
 class Base(db.Model):
     __abstract__ = True
 
     def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
-
-    def update_attrs(self, data: dict, ignore_attrs: set) -> bool:
-        changed_flag = False
-        column_mapper = sqlalchemy.inspect(self)
-
-        for column in column_mapper.attrs:
-            if column.key in ignore_attrs:
-                continue
-            input_data = data.get(column.key)
-            if input_data is not None:
-                if input_data != getattr(self, column.key):
-                    setattr(self, column.key, data[column.key])
-                    changed_flag = True
+        return serializers.ColumnSerializer.for_model(type(self))(self)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Session bound instance of a row read with a Core statement, without
+        querying the database again.
+        """
+        instance = cls(**dict(row))
+        sqlalchemy.orm.make_transient_to_detached(instance)
+        return db.session.merge(instance, load=False)
+
+    @classmethod
+    def row_exists(cls, row_id: int) -> bool:
+        return db.session.query(
+            db.session.query(cls.id).filter_by(id=row_id).exists()).scalar()
+
+    @classmethod
+    def update_values(cls, data: dict, ignore_attrs: set) -> dict:
+        """
+        Column values given in data, the ignored columns and the missing
+        (None) values left out.
+        """
+        return {
+            column.name: data[column.name]
+            for column in cls.__table__.columns
+            if column.name not in ignore_attrs and
+            data.get(column.name) is not None
+        }
+
+    @classmethod
+    def update_returning(
+            cls, row_id: int, values: dict, edit_counter: str,
+            expected: int = None):
+        """
+        Updates the row in a single UPDATE ... RETURNING, bumping its
+        version and edit_counter columns, as long as its edit counter is
+        still `expected` (whatever it is if None). Committed. Returns the
+        updated row as a session bound instance, None if no row matched.
+        """
+        table = cls.__table__
+        values = dict(values)
+        values['version'] = table.c.version + 1
+        values[edit_counter] = table.c[edit_counter] + 1
+
+        statement = table.update().where(table.c.id == row_id).values(values)
+        if expected is not None:
+            statement = statement.where(table.c[edit_counter] == expected)
+
+        connection = db.session.connection()
+        if connection.dialect.name == 'postgresql':
+            row = connection.execute(
+                statement.returning(*table.columns)).first()
+        elif connection.execute(statement).rowcount == 1:
+            # No RETURNING, the row is read back
+            row = connection.execute(
+                table.select().where(table.c.id == row_id)).first()
+        else:
+            row = None
+        db.session.commit()
 
-        return changed_flag
+        if row is None:
+            return None
+        return cls.from_row(row)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
 
+    @classmethod
+    def page_query(cls):
+        """
+        Query which loads the row users in one batched (IN) query.
+        """
+        return cls.query.options(sqlalchemy.orm.selectinload(cls.user))
+
+    @classmethod
+    def keyset_query(cls, query, limit: int, after: tuple = None):
+        """
+        Rows ordered by (created, id) descending, starting right after the
+        (created, id) key of the previous page's last row. One extra row is
+        selected to tell whether a next page exists.
+        """
+        if after is not None:
+            query = query.filter(
+                sqlalchemy.tuple_(cls.created, cls.id) <
+                sqlalchemy.tuple_(*after))
+
+        return query.order_by(cls.created.desc(), cls.id.desc()) \
+            .limit(limit + 1)
+
+    @classmethod
+    def keyset_page(cls, query, limit: int, after: tuple = None):
+        """
+        Returns the page of rows and the key for the next page (None on the
+        last page).
+        """
+        rows = cls.keyset_query(query=query, limit=limit, after=after).all()
+        return cls._split_page(rows, limit)
+
+    @staticmethod
+    def _split_page(rows: list, limit: int):
+        if len(rows) <= limit:
+            return rows, None
+
+        rows = rows[:limit]
+        return rows, (rows[-1].created, rows[-1].id)
+
+    @classmethod
+    def first_pages(cls, parent_column, parent_ids: list, limit: int) -> dict:
+        """
+        First keyset page of rows for each of the parents, with their users,
+        in a fixed number of queries. Returns {parent_id: (rows, next_key)}.
+        """
+        if not parent_ids:
+            return {}
+
+        if db.session.connection().dialect.name == 'postgresql':
+            page_ids = cls._first_page_ids_lateral(
+                parent_column, parent_ids, limit)
+        else:
+            page_ids = cls._first_page_ids_ranked(
+                parent_column, parent_ids, limit)
+
+        rows = cls.page_query() \
+            .join(page_ids, cls.id == page_ids.c.id) \
+            .order_by(cls.created.desc(), cls.id.desc()) \
+            .all()
+
+        rows_by_parent = {}
+        for row in rows:
+            rows_by_parent.setdefault(
+                getattr(row, parent_column.key), []).append(row)
+
+        return {
+            parent_id: cls._split_page(parent_rows, limit)
+            for parent_id, parent_rows in rows_by_parent.items()
+        }
+
+    @classmethod
+    def _first_page_ids_lateral(
+            cls, parent_column, parent_ids: list, limit: int):
+        # Per parent, only the first limit + 1 entries of the (parent,
+        # created, id) index are read
+        parent_id = next(iter(parent_column.expression.foreign_keys)).column
+        page = db.session.query(cls.id) \
+            .filter(parent_column == parent_id) \
+            .order_by(cls.created.desc(), cls.id.desc()) \
+            .limit(limit + 1) \
+            .correlate(parent_id.table) \
+            .subquery() \
+            .lateral()
+        return db.session.query(page.c.id) \
+            .select_from(parent_id.table) \
+            .join(page, sqlalchemy.true()) \
+            .filter(parent_id.in_(parent_ids)) \
+            .subquery()
+
+    @classmethod
+    def _first_page_ids_ranked(
+            cls, parent_column, parent_ids: list, limit: int):
+        # No LATERAL (SQLite): every row of the parents is ranked
+        row_number = sqlalchemy.func.row_number().over(
+            partition_by=parent_column,
+            order_by=(cls.created.desc(), cls.id.desc())).label('row_number')
+        ranked = db.session.query(cls.id, row_number) \
+            .filter(parent_column.in_(parent_ids)).subquery()
+        return db.session.query(ranked.c.id) \
+            .filter(ranked.c.row_number <= limit + 1) \
+            .subquery()
+
+
 class User(Base):
     __tablename__ = 'USER'
     id = db.Column(db.Integer, primary_key=True)
@@ -42,52 +208,116 @@ class User(Base):
     birthday = db.Column(db.Date)
     username = db.Column(db.String(32), index=True, unique=True)
     password_hash = db.Column(db.String(250))
-    profile_image = db.Column(db.String(256))
+    profile_image = db.Column(db.String(256), index=True)
+    # Variants of the profile image stored so far, see record_media_variants
+    profile_image_variant_names = db.Column(db.String(64))
     created = db.Column(
         db.DateTime(timezone=True),
         default=sqlalchemy.sql.func.now())
+    # Write counter, part of the ETag of the posts showing the user
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
 
+    # Children are deleted by the database (ON DELETE CASCADE), without
+    # being loaded
     post = db.relationship(
-        'Post', cascade="all,delete", back_populates='user', lazy=True)
-    comments = db.relationship('Comment', cascade="all,delete")
-    subwcomments = db.relationship('SubComment', cascade="all,delete")
+        'Post', cascade="all,delete", back_populates='user', lazy=True,
+        passive_deletes=True)
+    comments = db.relationship(
+        'Comment', cascade="all,delete", passive_deletes=True)
+    subwcomments = db.relationship(
+        'SubComment', cascade="all,delete", passive_deletes=True)
 
-    _IGNORE_ATTRS_ON_UPDATE = {'id', 'password_hash', 'created', 'email'}
-    _IGNORE_ATTRS_ON_OUTPUT = {'id', 'password_hash'}
+    _IGNORE_ATTRS_ON_UPDATE = {
+        'id', 'password_hash', 'created', 'email', 'version',
+        'profile_image_variant_names'}
+    _IGNORE_ATTRS_ON_OUTPUT = frozenset({
+        'id', 'password_hash', 'profile_image_variant_names'})
+    _IGNORE_ATTRS_ON_SNAPSHOT = frozenset({'password_hash'})
 
     def output(self):
-        output = self.as_dict()
-
-        for field in self._IGNORE_ATTRS_ON_OUTPUT:
-            del output[field]
+        output = serializers.ColumnSerializer.for_model(
+            User, exclude=self._IGNORE_ATTRS_ON_OUTPUT)(self)
+        output['profile_image_variants'] = serializers.media_variant_urls(
+            output['profile_image'], self.profile_image_variant_names)
         output['profile_image'] = app.config['MEDIA_BASE_URL'] \
             .format(file_name=output['profile_image'])
         return output
 
+    def snapshot(self) -> dict:
+        return {
+            column.name: getattr(self, column.name)
+            for column in self.__table__.columns
+            if column.name not in self._IGNORE_ATTRS_ON_SNAPSHOT
+        }
+
+    @staticmethod
+    def from_snapshot(snapshot: dict):
+        """
+        Rebuilds a session bound User from a snapshot without querying the
+        database. Attributes missing from the snapshot are loaded on access.
+        """
+        user = User(**snapshot)
+        sqlalchemy.orm.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def hash_password(self, password):
         self.password_hash = pwd_context.hash(password)
 
     def verify_password(self, password):
         return pwd_context.verify(password, self.password_hash)
 
-    def update(self, data: dict, file: werkzeug.datastructures.FileStorage):
+    @staticmethod
+    def id_by_username(username: str):
+        """
+        Id of the user with that username, None if there is none. Cached,
+        see utils.username_cache.
+        """
+        user_id = utils.username_cache.get(username)
+        if user_id is None:
+            user_id = db.session.query(User.id) \
+                .filter_by(username=username).scalar()
+            if user_id is not None:
+                utils.username_cache.set(username, user_id)
+        return user_id
 
-        self.update_attrs(data=data, ignore_attrs=self._IGNORE_ATTRS_ON_UPDATE)
+    def update(
+            self, data: dict, file: werkzeug.datastructures.FileStorage,
+            version: int = None):
+        """
+        Edits the user in a single statement, see Base.update_returning.
+        Raises VersionConflict if the user was edited since `version`.
+        None if the file is not allowed.
+        """
+        values = User.update_values(
+            data=data, ignore_attrs=self._IGNORE_ATTRS_ON_UPDATE)
 
         if file is not None:
-            if not self._allowed_file(file.filename):
+            if not utils.File.is_allowed(file):
                 return None
-            # TODO: Create a util that generates unique (random) image names
-            filename = werkzeug.utils.secure_filename(file.filename)
-
-            response = utils.File.upload(file=file, filename=filename)
-            self.profile_image = filename
-            changed_flag = True
+            values['profile_image'] = utils.File.store(file)
+            values['profile_image_variant_names'] = stored_media_variants(
+                values['profile_image'])
+
+        if not values:
+            return self
+
+        user_id, username = self.id, self.username
+        if values.get('username', username) != username:
+            Post.bump_versions_commented_by(user_id)
+        user = User.update_returning(
+            row_id=user_id, values=values, edit_counter='version',
+            expected=version)
+        if user is None:
+            if version is not None:
+                raise VersionConflict()
+            return None
 
-        if changed_flag is True:
-            db.session.commit()
+        utils.Auth.token_cache.evict_user(user_id)
+        if user.username != username:
+            utils.username_cache.invalidate(username)
 
-        return self
+        return user
 
     def update_password(self, old_password: str, new_password: str):
         if not self.verify_password(old_password):
@@ -98,12 +328,65 @@ class User(Base):
 
         return self
 
+    def _recount_engagement_without_user(self):
+        """
+        Sets the counters of the other users' comments and posts to what
+        they will be once the comments and subcomments of this user are
+        deleted. Set-based, to run right before the delete. Not committed.
+        """
+        kept_subcomment_count = db.session.query(
+            sqlalchemy.func.count(SubComment.id)) \
+            .filter(
+                SubComment.comment_id == Comment.id,
+                SubComment.user_id != self.id) \
+            .correlate(Comment).as_scalar()
+        Comment.query.filter(
+            Comment.user_id != self.id,
+            Comment.id.in_(
+                db.session.query(SubComment.comment_id)
+                .filter(SubComment.user_id == self.id))) \
+            .update({Comment.subcomment_count: kept_subcomment_count},
+                    synchronize_session=False)
+
+        kept_comments = db.session.query(Comment) \
+            .filter(Comment.post_id == Post.id, Comment.user_id != self.id) \
+            .correlate(Post)
+        Post.query.filter(
+            Post.user_id != self.id,
+            sqlalchemy.or_(
+                Post.id.in_(
+                    db.session.query(Comment.post_id)
+                    .filter(Comment.user_id == self.id)),
+                Post.id.in_(
+                    db.session.query(Comment.post_id)
+                    .join(SubComment, SubComment.comment_id == Comment.id)
+                    .filter(SubComment.user_id == self.id)))) \
+            .update({
+                Post.comment_count: kept_comments.with_entities(
+                    sqlalchemy.func.count(Comment.id)).as_scalar(),
+                Post.subcomment_count: kept_comments.with_entities(
+                    sqlalchemy.func.coalesce(
+                        sqlalchemy.func.sum(Comment.subcomment_count), 0))
+                .as_scalar(),
+                Post.version: Post.version + 1
+            }, synchronize_session=False)
+
+    def delete(self):
+        # The user's posts are deleted along: out of the feed index first,
+        # while their ids can still be streamed
+        utils.feed_index.remove_query(
+            db.session.query(Post.id).filter_by(user_id=self.id))
+        self._recount_engagement_without_user()
+        super().delete()
+        utils.Auth.token_cache.evict_user(self.id)
+        utils.username_cache.invalidate(self.username)
+
     @staticmethod
-    def verify_auth_token(token):
+    def verify_auth_token(token, return_header: bool = False):
         serializer = itsdangerous.TimedJSONWebSignatureSerializer(
             app.config['SECRET_KEY'])
         try:
-            data = serializer.loads(token)
+            data = serializer.loads(token, return_header=return_header)
         except itsdangerous.SignatureExpired:
             return None    # valid token, but expired
         except itsdangerous.BadSignature:
@@ -111,33 +394,246 @@ class User(Base):
 
         return data
 
-    @staticmethod
-    def _allowed_file(filename):
-        return '.' in filename and \
-            filename.rsplit('.', 1)[1].lower() \
-            in app.config['MEDIA_ALLOWED_EXTENSIONS']
+
+@sqlalchemy.event.listens_for(User, 'load')
+def _cache_username(user, context):
+    # Every loaded user fills the username cache, the users of a feed page
+    # included
+    utils.username_cache.set(user.username, user.id)
 
 
 class Post(Base):
     __tablename__ = 'POST'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(
-        db.Integer, db.ForeignKey('USER.id'), nullable=False)
-    resource = db.Column(db.String(256), nullable=False)
+        db.Integer, db.ForeignKey('USER.id', ondelete='CASCADE'),
+        nullable=False)
+    resource = db.Column(db.String(256), nullable=False, index=True)
+    # Variants of the resource stored so far, see record_media_variants
+    resource_variant_names = db.Column(db.String(64))
     description = db.Column(db.String(500))
     created = db.Column(
         db.DateTime(timezone=True), default=sqlalchemy.sql.func.now())
+    media_state = db.Column(
+        db.String(16), nullable=False, default='ready',
+        server_default='ready')
+    comment_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    subcomment_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    # Write counter, bumped on every change of the post, its comments,
+    # subcomments and the usernames of their authors. Part of the ETag of
+    # the post and of the feed pages.
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+    # Edit counter, bumped only when the post itself is edited, against
+    # which edits are checked (see Post.update)
+    revision = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+
+    # Keyset pages of the global feed and of the per-user listings
+    __table_args__ = (
+        db.Index('ix_POST_created_id', created.desc(), id.desc()),
+        db.Index(
+            'ix_POST_user_id_created_id',
+            user_id, created.desc(), id.desc()),
+    )
 
     user = db.relationship('User', back_populates='post', lazy=True)
     comments = db.relationship(
         'Comment', cascade="all,delete", back_populates='post', lazy=True,
-        order_by='Comment.created.desc()'
+        order_by='Comment.created.desc()', passive_deletes=True
     )
 
-    _IGNORE_ATTRS_ON_UPDATE = {'id', 'created', 'user_id'}
+    _IGNORE_ATTRS_ON_UPDATE = {
+        'id', 'created', 'user_id', 'media_state', 'comment_count',
+        'subcomment_count', 'version', 'revision', 'resource_variant_names'}
+    _IGNORE_ATTRS_ON_OUTPUT = frozenset({'resource_variant_names'})
+
+    MEDIA_STATE_READY = 'ready'
+    MEDIA_STATE_PENDING = 'pending'
+    MEDIA_STATE_FAILED = 'failed'
+
+    @staticmethod
+    def feed_query():
+        """
+        Post query which loads the post users in one batched (IN) query,
+        regardless of the number of posts. Comments are embedded separately,
+        see embedded_comment_pages.
+        """
+        return Post.page_query()
+
+    @staticmethod
+    def user_feed_query(username: str):
+        """
+        feed_query of the posts of the user with that username, filtered by
+        the cached user id or else joined on the username, so that the
+        user is not looked up first.
+        """
+        user_id = utils.username_cache.get(username)
+        if user_id is not None:
+            return Post.feed_query().filter_by(user_id=user_id)
+
+        return Post.feed_query() \
+            .join(User, Post.user_id == User.id) \
+            .filter(User.username == username)
+
+    @staticmethod
+    def embedded_comment_pages(posts: list):
+        """
+        First page of comments of every post and first page of subcomments
+        of every such comment, with their users, in a fixed number of
+        queries.
+        Returns ({post_id: (comments, next_key)},
+        {comment_id: (subcomments, next_key)}).
+        """
+        comment_pages = Comment.first_pages(
+            parent_column=Comment.post_id,
+            parent_ids=[post.id for post in posts],
+            limit=app.config['EMBEDDED_COMMENT_LIMIT'])
+
+        subcomment_pages = Comment.embedded_subcomment_pages(
+            [comment
+             for comments, _ in comment_pages.values()
+             for comment in comments])
+
+        return comment_pages, subcomment_pages
+
+    @staticmethod
+    def by_ids(post_ids: list) -> dict:
+        """
+        Posts (with their users) by id, in a single IN query.
+        """
+        if not post_ids:
+            return {}
+        posts = Post.feed_query().filter(Post.id.in_(post_ids)).all()
+        return {post.id: post for post in posts}
+
+    @staticmethod
+    def search_page(terms: str, limit: int, after: tuple = None):
+        """
+        Ids of the posts whose description or comments match the search
+        terms (web search syntax), best match first, and the (rank, id)
+        key of the next page (None on the last one). A post ranks as its
+        best matching description or comment.
+        PostgreSQL only: the search_vector columns are maintained by
+        triggers (migration 9c5b3e7a2d48) and not mapped.
+        """
+        query = sqlalchemy.func.websearch_to_tsquery(
+            app.config['SEARCH_TEXT_CONFIG'], terms)
+
+        matches = sqlalchemy.union_all(*(
+            sqlalchemy.select([
+                post_id.label('post_id'),
+                sqlalchemy.cast(
+                    sqlalchemy.func.ts_rank(search_vector, query),
+                    sqlalchemy.Float).label('rank')
+            ]).where(search_vector.op('@@')(query))
+            for post_id, search_vector in (
+                (Post.id, _search_vector(Post)),
+                (Comment.post_id, _search_vector(Comment)))
+        )).alias('matches')
+
+        ranked = db.session.query(
+            matches.c.post_id,
+            sqlalchemy.func.max(matches.c.rank).label('rank')) \
+            .group_by(matches.c.post_id) \
+            .subquery()
+
+        page_query = db.session.query(ranked.c.rank, ranked.c.post_id)
+        if after is not None:
+            page_query = page_query.filter(
+                sqlalchemy.tuple_(ranked.c.rank, ranked.c.post_id) < after)
+        rows = page_query \
+            .order_by(ranked.c.rank.desc(), ranked.c.post_id.desc()) \
+            .limit(limit + 1) \
+            .all()
+
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = tuple(rows[-1])
+        return [post_id for _, post_id in rows], next_key
+
+    @staticmethod
+    def page_versions(query, limit: int, after: tuple = None) -> list:
+        """
+        (id, version, user version) of the posts of a keyset page, which
+        is all the page ETag depends on, without loading the posts.
+        """
+        user_version = db.session.query(User.version) \
+            .filter(User.id == Post.user_id) \
+            .correlate(Post).as_scalar()
+        return Post.keyset_query(query=query, limit=limit, after=after) \
+            .with_entities(Post.id, Post.version, user_version) \
+            .all()
+
+    @staticmethod
+    def version_key(post_id: int):
+        """
+        (version, user version) of a post, None if it does not exist.
+        """
+        return db.session.query(Post.version, User.version) \
+            .join(User, Post.user_id == User.id) \
+            .filter(Post.id == post_id) \
+            .first()
+
+    @staticmethod
+    def bump_versions_commented_by(user_id: int):
+        """
+        Bumps the version of the posts the user commented or subcommented
+        on, whose pages embed the username. Not committed.
+        """
+        commented = db.session.query(Comment.post_id) \
+            .filter(Comment.user_id == user_id)
+        subcommented = db.session.query(Comment.post_id) \
+            .join(SubComment, SubComment.comment_id == Comment.id) \
+            .filter(SubComment.user_id == user_id)
+        Post.query.filter(Post.id.in_(commented.union(subcommented))).update(
+            {Post.version: Post.version + 1}, synchronize_session=False)
+
+    @staticmethod
+    def increment_counters(
+            post_id, comment_count=0, subcomment_count=0):
+        """
+        Atomically adds to the counters of a post and bumps its version
+        (single UPDATE, no read-modify-write). Counts may be SQL
+        expressions. Not committed.
+        """
+        Post.query.filter_by(id=post_id).update({
+            Post.comment_count: Post.comment_count + comment_count,
+            Post.subcomment_count: Post.subcomment_count + subcomment_count,
+            Post.version: Post.version + 1
+        }, synchronize_session=False)
+
+    @staticmethod
+    def reconcile_counters() -> int:
+        """
+        Recounts comment_count and subcomment_count of every post whose
+        counters drifted, from the COMMENT table (so
+        Comment.reconcile_counters has to run first). Not committed.
+        Returns the number of fixed posts.
+        """
+        comment_count = db.session.query(sqlalchemy.func.count(Comment.id)) \
+            .filter(Comment.post_id == Post.id).as_scalar()
+        subcomment_count = db.session.query(
+            sqlalchemy.func.coalesce(
+                sqlalchemy.func.sum(Comment.subcomment_count), 0)) \
+            .filter(Comment.post_id == Post.id).as_scalar()
+
+        return Post.query.filter(sqlalchemy.or_(
+            Post.comment_count != comment_count,
+            Post.subcomment_count != subcomment_count)) \
+            .update({
+                Post.comment_count: comment_count,
+                Post.subcomment_count: subcomment_count
+            }, synchronize_session=False)
 
     def output(self):
-        output = self.as_dict()
+        output = serializers.ColumnSerializer.for_model(
+            type(self), exclude=self._IGNORE_ATTRS_ON_OUTPUT)(self)
+        output['resource_variants'] = serializers.media_variant_urls(
+            output['resource'], self.resource_variant_names)
         output['resource'] = app.config['MEDIA_BASE_URL'] \
             .format(file_name=output['resource'])
         return output
@@ -157,75 +653,216 @@ class Post(Base):
         ]
         return output
 
+    def is_media_pending(self) -> bool:
+        return self.media_state == self.MEDIA_STATE_PENDING
+
+    @staticmethod
+    def _store_media(file: werkzeug.datastructures.FileStorage):
+        """
+        Uploads the file right away or, in the asynchronous upload mode,
+        spools it to local disk with the post media marked as pending.
+        Returns the media column values and the spooled upload, to be
+        queued once the post is committed.
+        """
+        if not app.config['MEDIA_UPLOAD_ASYNC']:
+            resource = utils.File.store(file)
+            return {
+                'resource': resource,
+                'resource_variant_names': stored_media_variants(resource),
+                'media_state': Post.MEDIA_STATE_READY
+            }, None
+
+        spooled_upload = utils.upload_queue.spool(file)
+        return {
+            'resource': spooled_upload.filename,
+            'resource_variant_names': stored_media_variants(
+                spooled_upload.filename),
+            'media_state': Post.MEDIA_STATE_PENDING
+        }, spooled_upload
+
+    def _queue_media(self, spooled_upload):
+        if spooled_upload is None:
+            return
+        utils.upload_queue.submit(
+            spooled_upload=spooled_upload,
+            on_done=functools.partial(Post.finish_media_upload, self.id))
+
+    @staticmethod
+    def finish_media_upload(post_id: int, uploaded: bool):
+        Post.finish_media_uploads([post_id], uploaded)
+
+    @staticmethod
+    def finish_media_uploads(post_ids: list, uploaded: bool):
+        media_state = Post.MEDIA_STATE_READY if uploaded \
+            else Post.MEDIA_STATE_FAILED
+        Post.query.filter(Post.id.in_(post_ids)).update({
+            Post.media_state: media_state,
+            Post.version: Post.version + 1
+        }, synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def resume_media_uploads(spooled_before: float) -> int:
+        """
+        Queues again the uploads spooled before the timestamp by a previous
+        run of the app, which left their posts pending. The posts are marked
+        as failed if the spooled file is gone. Returns the number of posts.
+        """
+        count = 0
+        for spooled_upload in utils.upload_queue.left_over(spooled_before):
+            post_ids = [
+                post_id for post_id, in db.session.query(Post.id).filter_by(
+                    resource=spooled_upload.filename,
+                    media_state=Post.MEDIA_STATE_PENDING)
+            ]
+            count += len(post_ids)
+            if post_ids and os.path.exists(spooled_upload.path):
+                utils.upload_queue.submit(
+                    spooled_upload=spooled_upload,
+                    on_done=functools.partial(
+                        Post.finish_media_uploads, post_ids))
+                continue
+
+            utils.upload_queue.discard(spooled_upload)
+            if post_ids:
+                Post.finish_media_uploads(post_ids, uploaded=False)
+        return count
+
     def save(
             self, form_data: dict, file: werkzeug.datastructures.FileStorage,
             user: User):
 
-        if not self._allowed_file(file.filename):
+        if not utils.File.is_allowed(file):
             return None
 
-        # TODO: Create a util that generates unique (random) image names
-        filename = werkzeug.utils.secure_filename(file.filename)
-
-        response = utils.File.upload(file=file, filename=filename)
-
-        # TODO: validate response
+        media_values, spooled_upload = self._store_media(file)
+        for key, value in media_values.items():
+            setattr(self, key, value)
 
         self.user_id = user.id
-        self.resource = filename
         self.description = form_data.get('description')
 
         db.session.add(self)
         db.session.commit()
 
+        utils.feed_index.add(self)
+        self._queue_media(spooled_upload)
+
         return self
 
+    @staticmethod
     def update(
-            self, form_data: dict, file: werkzeug.datastructures.FileStorage,
-            user: User):
-        
-        self.update_attrs(
-            data=form_data, ignore_attrs=self._IGNORE_ATTRS_ON_UPDATE)
-
+            post_id: int, form_data: dict,
+            file: werkzeug.datastructures.FileStorage, user: User,
+            revision: int = None):
+        """
+        Edits the post in a single statement, see Base.update_returning.
+        Raises VersionConflict if the post was edited since `revision`.
+        None if the post does not exist or the file is not allowed.
+        """
+        values = Post.update_values(
+            data=form_data, ignore_attrs=Post._IGNORE_ATTRS_ON_UPDATE)
+
+        spooled_upload = None
         if file is not None:
-            if not self._allowed_file(file.filename):
+            if not utils.File.is_allowed(file):
                 return None
-            # TODO: Create a util that generates unique (random) image names
-            filename = werkzeug.utils.secure_filename(file.filename)
-
-            response = utils.File.upload(file=file, filename=filename)
-            self.resource = filename
-            changed_flag = True
+            media_values, spooled_upload = Post._store_media(file)
+            values.update(media_values)
+
+        if not values:
+            return Post.query.filter_by(id=post_id).first()
+
+        post = Post.update_returning(
+            row_id=post_id, values=values, edit_counter='revision',
+            expected=revision)
+        if post is None:
+            if spooled_upload is not None:
+                utils.upload_queue.discard(spooled_upload)
+            if revision is not None and Post.query.filter_by(
+                    id=post_id).count():
+                raise VersionConflict()
+            return None
 
-        if changed_flag is True:
-            db.session.commit()
+        post._queue_media(spooled_upload)
 
-        return self
+        return post
 
-    @staticmethod
-    def _allowed_file(filename):
-        return '.' in filename and \
-            filename.rsplit('.', 1)[1].lower() \
-            in app.config['MEDIA_ALLOWED_EXTENSIONS']
+    def delete(self):
+        super().delete()
+        utils.feed_index.remove(self.id)
 
 
 class Comment(Base):
     __tablename__ = 'COMMENT'
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(
-        db.Integer, db.ForeignKey('POST.id'), nullable=False)
+        db.Integer, db.ForeignKey('POST.id', ondelete='CASCADE'),
+        nullable=False)
     user_id = db.Column(
-        db.Integer, db.ForeignKey('USER.id'), nullable=False)
+        db.Integer, db.ForeignKey('USER.id', ondelete='CASCADE'),
+        nullable=False, index=True)
     text = db.Column(db.String(300), nullable=False)
     created = db.Column(
         db.DateTime(timezone=True), default=sqlalchemy.sql.func.now(),
         nullable=False)
+    subcomment_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    # Keyset pages of the comments of a post
+    __table_args__ = (
+        db.Index(
+            'ix_COMMENT_post_id_created_id',
+            post_id, created.desc(), id.desc()),
+    )
 
     post = db.relationship('Post', back_populates='comments', lazy=True)
     user = db.relationship('User')
     subcomments = db.relationship(
         'SubComment', cascade="all,delete", back_populates='comments',
-        lazy=True, order_by='SubComment.created.desc()')
+        lazy=True, order_by='SubComment.created.desc()',
+        passive_deletes=True)
+
+    @staticmethod
+    def embedded_subcomment_pages(comments: list) -> dict:
+        """
+        First page of subcomments of every comment, with their users.
+        Returns {comment_id: (subcomments, next_key)}.
+        """
+        return SubComment.first_pages(
+            parent_column=SubComment.comment_id,
+            parent_ids=[comment.id for comment in comments],
+            limit=app.config['EMBEDDED_SUBCOMMENT_LIMIT'])
+
+    @staticmethod
+    def increment_counters(comment_id, subcomment_count: int):
+        """
+        Atomically adds to the subcomment counter of a comment and of its
+        post. Not committed.
+        """
+        post_id = db.session.query(Comment.post_id) \
+            .filter(Comment.id == comment_id).as_scalar()
+        Post.increment_counters(
+            post_id=post_id, subcomment_count=subcomment_count)
+        Comment.query.filter_by(id=comment_id).update({
+            Comment.subcomment_count:
+                Comment.subcomment_count + subcomment_count
+        }, synchronize_session=False)
+
+    @staticmethod
+    def reconcile_counters() -> int:
+        """
+        Recounts subcomment_count of every comment whose counter drifted.
+        Not committed. Returns the number of fixed comments.
+        """
+        subcomment_count = db.session.query(
+            sqlalchemy.func.count(SubComment.id)) \
+            .filter(SubComment.comment_id == Comment.id).as_scalar()
+
+        return Comment.query \
+            .filter(Comment.subcomment_count != subcomment_count) \
+            .update({Comment.subcomment_count: subcomment_count},
+                    synchronize_session=False)
 
     def output(self):
         output = self.as_dict()
@@ -248,23 +885,42 @@ class Comment(Base):
         self.user = user
 
         db.session.add(self)
+        Post.increment_counters(post_id=post.id, comment_count=1)
         db.session.commit()
 
         return self
 
+    def delete(self):
+        # Subcomments are deleted along, their count is read in the UPDATE
+        subcomment_count = db.session.query(Comment.subcomment_count) \
+            .filter(Comment.id == self.id).as_scalar()
+        Post.increment_counters(
+            post_id=self.post_id, comment_count=-1,
+            subcomment_count=-subcomment_count)
+        super().delete()
+
 
 class SubComment(Base):
     __tablename__ = 'SUBCOMMENT'
     id = db.Column(db.Integer, primary_key=True)
     comment_id = db.Column(
-        db.Integer, db.ForeignKey('COMMENT.id'), nullable=False)
+        db.Integer, db.ForeignKey('COMMENT.id', ondelete='CASCADE'),
+        nullable=False)
     user_id = db.Column(
-        db.Integer, db.ForeignKey('USER.id'), nullable=False)
+        db.Integer, db.ForeignKey('USER.id', ondelete='CASCADE'),
+        nullable=False, index=True)
     text = db.Column(db.String(300), nullable=False)
     created = db.Column(
         db.DateTime(timezone=True), default=sqlalchemy.sql.func.now(),
         nullable=False)
 
+    # Keyset pages of the subcomments of a comment
+    __table_args__ = (
+        db.Index(
+            'ix_SUBCOMMENT_comment_id_created_id',
+            comment_id, created.desc(), id.desc()),
+    )
+
     comments = db.relationship(
         'Comment', back_populates='subcomments', lazy=True)
     user = db.relationship('User')
@@ -279,7 +935,7 @@ class SubComment(Base):
         output['edit_allowed'] = True \
             if self.user_id == auth_user.id else False
         return output
-   
+
     def save(self, form_data: dict, comment: Comment, user: User):
         self.comment_id = comment.id
         self.user_id = user.id
@@ -287,6 +943,44 @@ class SubComment(Base):
         self.user = user
 
         db.session.add(self)
+        Comment.increment_counters(comment_id=comment.id, subcomment_count=1)
         db.session.commit()
 
         return self
+
+    def delete(self):
+        Comment.increment_counters(
+            comment_id=self.comment_id, subcomment_count=-1)
+        super().delete()
+
+
+def record_media_variants(filename: str, variants: list):
+    """
+    Records the variants of an image stored by the derivative pipeline on
+    the posts and users showing it, and commits. The posts' version is
+    bumped so that cached feed pages pick the variants up; the users' is
+    left alone, being their edit counter, so that profile images fall back
+    to the original until the users are otherwise written.
+    """
+    variant_names = ','.join(sorted(variants))
+    Post.query.filter_by(resource=filename).update({
+        Post.resource_variant_names: variant_names,
+        Post.version: Post.version + 1
+    }, synchronize_session=False)
+    User.query.filter_by(profile_image=filename).update({
+        User.profile_image_variant_names: variant_names
+    }, synchronize_session=False)
+    db.session.commit()
+
+
+def stored_media_variants(filename: str):
+    """
+    Variants already recorded for a file, shared by every row storing the
+    same content (see File.store). None if unknown.
+    """
+    return db.session.query(Post.resource_variant_names).filter(
+        Post.resource == filename,
+        Post.resource_variant_names.isnot(None)).limit(1).scalar() \
+        or db.session.query(User.profile_image_variant_names).filter(
+            User.profile_image == filename,
+            User.profile_image_variant_names.isnot(None)).limit(1).scalar()
@@ -1,11 +1,29 @@
+import itertools
 from flask_restful import Resource
-from flask import abort, request, jsonify, url_for, make_response
+from flask import (
+    abort, request, jsonify, json, url_for, make_response, Response,
+    stream_with_context)
 
-from flask_init import api, db
+from flask_init import app, api, db
 import models
+import serializers
 import utils
 
 
+def _get_edited_version(form_data, key: str):
+    """
+    The version (counter `key`) the client based its edit on, None if not
+    given. Aborts on an invalid one.
+    """
+    if form_data.get(key) is None:
+        return None
+
+    version = form_data.get(key, type=int)
+    if version is None:
+        abort(400)
+    return version
+
+
 class User(Resource):
     URL_RULE_USER = '/user'
     URL_RULE_USER_BY_ID = '/user/<int:user_id>'
@@ -46,8 +64,17 @@ class User(Resource):
                 }, 400)
 
         else:
-            user = user.update(
-                data=request.form, file=request.files.get('file'))
+            try:
+                user = user.update(
+                    data=request.form, file=request.files.get('file'),
+                    version=_get_edited_version(request.form, 'version'))
+            except models.VersionConflict:
+                return make_response({
+                    'message': 'User was changed meanwhile, reload it'
+                }, 409)
+
+            if user is None:
+                abort(400)
 
         return make_response(user.output(), 200)
 
@@ -66,9 +93,45 @@ class User(Resource):
         return make_response(jsonify(response_message), 200)
 
 
-class Post(Resource):
+class PaginatedResource(Resource):
+    @staticmethod
+    def _get_page_args(
+            default_limit: int, max_limit: int, cursor_class=utils.Cursor):
+        limit = request.args.get('limit', default=default_limit, type=int)
+        limit = min(max(limit, 1), max_limit)
+
+        cursor = request.args.get('cursor')
+        after = None
+        if cursor:
+            after = cursor_class.decode(cursor)
+            if after is None:
+                abort(400)
+
+        return limit, after
+
+    @staticmethod
+    def _encode_cursor(next_key: tuple, cursor_class=utils.Cursor):
+        return cursor_class.encode(next_key) if next_key is not None else None
+
+    @staticmethod
+    def _not_modified(etag: str):
+        """
+        Empty 304 response if the client already has this version,
+        None otherwise.
+        """
+        if not request.if_none_match.contains(etag):
+            return None
+
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+
+class Post(PaginatedResource):
     URL_RULE_POST_ROOT = '/post'
     URL_RULE_ALL_POSTS = '/post/all'
+    URL_RULE_POSTS_BY_IDS = '/post/batch'
+    URL_RULE_SEARCH_POSTS = '/post/search'
     URL_RULE_SINGLE_POST_BY_ID = '/post/<int:post_id>'
     URL_RULE_POSTS_BY_USER_ID = '/post/user/<int:user_id>'
     URL_RULE_POSTS_BY_USERNAME = '/post/user/username/<string:username>'
@@ -85,43 +148,228 @@ class Post(Resource):
 
         if str(request.url_rule) == self.URL_RULE_ALL_POSTS:
             # TODO; Move to models
-            data_list = models.Post.query.join(
-                models.User, models.Post.user_id == models.User.id).all()
-            return self._return_data_list(data_list)
+            query = models.Post.feed_query().join(
+                models.User, models.Post.user_id == models.User.id)
+            return self._return_post_page(query, indexed=True)
+
+        elif str(request.url_rule) == self.URL_RULE_POSTS_BY_IDS:
+            return self._return_posts_by_ids()
+
+        elif str(request.url_rule) == self.URL_RULE_SEARCH_POSTS:
+            return self._return_search_page()
 
         elif str(request.url_rule) == self.URL_RULE_SINGLE_POST_BY_ID:
+            version_key = models.Post.version_key(post_id)
+            if version_key is None:
+                abort(400)
+
+            etag = utils.ETag.of(self._auth_user.id, post_id, *version_key)
+            not_modified = self._not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+
             # TODO; Move to models
             data = models.Post.query.filter_by(id=post_id).first()
-            return self._return_single_post(data)
+            response = self._return_single_post(data)
+            response.set_etag(etag)
+            return response
 
         elif str(request.url_rule) == self.URL_RULE_POSTS_BY_USER_ID:
             # TODO; Move to models
-            data_list = models.Post.query.filter_by(user_id=user_id).all()
-            return self._return_data_list(data_list)
+            query = models.Post.feed_query().filter_by(user_id=user_id)
+            return self._return_post_page(query)
 
         elif str(request.url_rule) == self.URL_RULE_POSTS_BY_USERNAME:
-            # TODO; Move to models
-            user = models.User.query.filter_by(username=username).first()
-            if user is None:
-                abort(400)
-            data_list = models.Post.query.filter_by(user_id=user.id).all()
-            return self._return_data_list(data_list)
+            return self._return_post_page(
+                models.Post.user_feed_query(username),
+                owner_exists=lambda: models.User.id_by_username(
+                    username) is not None)
 
         response_message = {
             'message': 'Invalid or not existing parameter'
         }
         return make_response(jsonify(response_message), 400)
 
-    def _return_data_list(self, post_list):
-        if post_list is None:
+    def _return_post_page(
+            self, query, indexed: bool = False, owner_exists=None):
+        """
+        indexed: the query is the global feed, whose pages can be read
+        from the feed index
+        owner_exists: tells whether the owner of the feed exists, only
+        called when the page is empty (400 if not)
+        """
+        stream = request.args.get('stream', '').lower() in ('1', 'true')
+
+        limit, after = self._get_page_args(
+            default_limit=app.config['POST_PAGE_DEFAULT_LIMIT'],
+            max_limit=app.config['POST_STREAM_MAX_LIMIT'] if stream
+            else app.config['POST_PAGE_MAX_LIMIT'])
+
+        # Only the row versions are read until we know the client needs
+        # the page
+        versions = None
+        if indexed and not stream:
+            post_ids = utils.feed_index.page(limit=limit, after=after)
+            if post_ids is not None:
+                # Only the posts of the page are loaded, by primary key
+                indexed_query = models.Post.feed_query().filter(
+                    models.Post.id.in_(post_ids))
+                versions = models.Post.page_versions(
+                    query=indexed_query, limit=limit, after=after)
+                stale_ids = set(post_ids) - {row[0] for row in versions}
+                if stale_ids:
+                    # Ids of deleted posts would shorten the page and end
+                    # the feed: it is read from the database instead
+                    utils.feed_index.remove(*stale_ids)
+                    versions = None
+                else:
+                    query = indexed_query
+        if versions is None:
+            versions = models.Post.page_versions(
+                query=query, limit=limit, after=after)
+        if not versions and owner_exists is not None and not owner_exists():
+            abort(400)
+
+        etag = utils.ETag.of(self._auth_user.id, stream, versions)
+        not_modified = self._not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+
+        if stream:
+            response = self._stream_post_page(query, limit, after)
+        else:
+            response = self._buffer_post_page(query, limit, after)
+        response.set_etag(etag)
+        return response
+
+    def _buffer_post_page(self, query, limit: int, after: tuple):
+        post_list, next_key = models.Post.keyset_page(
+            query=query, limit=limit, after=after)
+
+        serializer = serializers.FeedSerializer(self._auth_user)
+        serializer.add_pages(*models.Post.embedded_comment_pages(post_list))
+        response_message = {
+            'message': 'Success',
+            'post': [serializer.post(post) for post in post_list],
+            'next_cursor': self._encode_cursor(next_key)
+        }
+
+        return make_response(jsonify(response_message), 200)
+
+    def _stream_post_page(self, query, limit: int, after: tuple):
+        """
+        Same envelope as _buffer_post_page, but the posts are fetched in
+        batches and each one is encoded and sent as soon as it is
+        serialized, so memory stays flat regardless of the page size.
+        """
+        batch_size = app.config['POST_STREAM_BATCH_SIZE']
+        post_query = models.Post.keyset_query(
+            query=query, limit=limit, after=after).yield_per(batch_size)
+
+        def generate():
+            yield '{"message": "Success", "post": ['
+
+            posts = iter(post_query)
+            batches = iter(
+                lambda: list(itertools.islice(posts, batch_size)), [])
+            has_next = False
+            next_cursor = None
+            last_post = None
+            index = 0
+            for batch in batches:
+                if index + len(batch) > limit:
+                    # Drop the extra row selected by keyset_query
+                    batch = batch[:limit - index]
+                    has_next = True
+
+                # Embedded comment pages are loaded per batch, with the
+                # serializer (and its memoized users) scoped to it as well
+                serializer = serializers.FeedSerializer(self._auth_user)
+                serializer.add_pages(
+                    *models.Post.embedded_comment_pages(batch))
+                for post in batch:
+                    if index > 0:
+                        yield ', '
+                    yield json.dumps(serializer.post(post))
+                    last_post = post
+                    index += 1
+
+                if has_next:
+                    next_cursor = utils.Cursor.encode(
+                        (last_post.created, last_post.id))
+                    break
+
+            yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+        return Response(
+            stream_with_context(generate()), status=200,
+            mimetype='application/json')
+
+    @staticmethod
+    def _get_post_ids() -> list:
+        """
+        Unique post ids of the `ids` query parameter (1,2,3), in order.
+        """
+        try:
+            post_ids = [
+                int(post_id) for post_id in request.args.get('ids', '')
+                .split(',') if post_id.strip()]
+        except ValueError:
+            abort(400)
+
+        post_ids = list(dict.fromkeys(post_ids))
+        if not post_ids or \
+                len(post_ids) > app.config['POST_MULTI_GET_MAX_IDS']:
             abort(400)
 
+        return post_ids
+
+    def _return_posts_by_ids(self):
+        post_ids = self._get_post_ids()
+
+        posts = models.Post.by_ids(post_ids)
+        post_list = [posts[post_id] for post_id in post_ids
+                     if post_id in posts]
+
+        serializer = serializers.FeedSerializer(self._auth_user)
+        serializer.add_pages(*models.Post.embedded_comment_pages(post_list))
         response_message = {
             'message': 'Success',
+            # In request order, null for the missing ids
             'post': [
-                post.output_with_permissions_and_users(self._auth_user)
-                for post in post_list
-            ]
+                serializer.post(posts[post_id]) if post_id in posts
+                else None
+                for post_id in post_ids],
+            'missing': [
+                post_id for post_id in post_ids if post_id not in posts]
+        }
+
+        return make_response(jsonify(response_message), 200)
+
+    def _return_search_page(self):
+        terms = request.args.get('q', '').strip()
+        if not terms or len(terms) > app.config['SEARCH_QUERY_MAX_LENGTH']:
+            abort(400)
+
+        limit, after = self._get_page_args(
+            default_limit=app.config['POST_PAGE_DEFAULT_LIMIT'],
+            max_limit=app.config['POST_PAGE_MAX_LIMIT'],
+            cursor_class=utils.RankCursor)
+
+        post_ids, next_key = models.Post.search_page(
+            terms=terms, limit=limit, after=after)
+        posts = models.Post.by_ids(post_ids)
+        # Best match first; posts deleted since the search are skipped
+        post_list = [posts[post_id] for post_id in post_ids
+                     if post_id in posts]
+
+        serializer = serializers.FeedSerializer(self._auth_user)
+        serializer.add_pages(*models.Post.embedded_comment_pages(post_list))
+        response_message = {
+            'message': 'Success',
+            'post': [serializer.post(post) for post in post_list],
+            'next_cursor': self._encode_cursor(
+                next_key, cursor_class=utils.RankCursor)
         }
 
         return make_response(jsonify(response_message), 200)
@@ -171,7 +419,10 @@ class Post(Resource):
             'post': post.output()
         }
 
-        return make_response(jsonify(response_message), 201)
+        # Media still being uploaded in the background
+        status_code = 202 if post.is_media_pending() else 201
+
+        return make_response(jsonify(response_message), status_code)
 
     def patch(self, post_id: int):
         # TODO: Test wether is this check necessary or not
@@ -189,12 +440,15 @@ class Post(Resource):
         if (not form_data and not file) or not post_id:
             abort(400)
 
-        post = models.Post.query.filter_by(id=post_id).first()
-
-        if post is None:
-            abort(400)
-
-        post = post.update(form_data=form_data, file=file, user=user)
+        # A single UPDATE, checked against the revision the client edited
+        try:
+            post = models.Post.update(
+                post_id=post_id, form_data=form_data, file=file, user=user,
+                revision=_get_edited_version(form_data, 'revision'))
+        except models.VersionConflict:
+            return make_response(jsonify({
+                'message': 'Post was changed meanwhile, reload it'
+            }), 409)
 
         if post is None:
             abort(400)
@@ -204,7 +458,10 @@ class Post(Resource):
             'post': post.output()
         }
 
-        return make_response(jsonify(response_message), 200)
+        # Media still being uploaded in the background
+        status_code = 202 if post.is_media_pending() else 200
+
+        return make_response(jsonify(response_message), status_code)
 
     def delete(self, post_id: int):
         if str(request.url_rule) != self.URL_RULE_SINGLE_POST_BY_ID:
@@ -217,7 +474,7 @@ class Post(Resource):
 
         if not post_id:
             abort(400)
-        
+
         post = models.Post.query.filter_by(id=post_id).first()
 
         if post is None:
@@ -232,10 +489,43 @@ class Post(Resource):
         return make_response(jsonify(response_message), 200)
 
 
-class Comment(Resource):
+class Comment(PaginatedResource):
     URL_RULE_SINGLE_COMMENT = '/post/comment/<int:comment_id>'
     URL_RULE_POST_COMMENTS = '/post/<int:post_id>/comment'
 
+    def get(self, post_id: int):
+        if str(request.url_rule) != self.URL_RULE_POST_COMMENTS:
+            abort(404)
+
+        user = utils.Auth.verify_authorization(request=request)
+
+        if user is None:
+            abort(400)
+
+        limit, after = self._get_page_args(
+            default_limit=app.config['COMMENT_PAGE_DEFAULT_LIMIT'],
+            max_limit=app.config['COMMENT_PAGE_MAX_LIMIT'])
+
+        comment_list, next_key = models.Comment.keyset_page(
+            query=models.Comment.page_query().filter_by(post_id=post_id),
+            limit=limit, after=after)
+        # Only checked when empty, an empty page of a missing post is an
+        # error
+        if not comment_list and not models.Post.row_exists(post_id):
+            abort(400)
+
+        serializer = serializers.FeedSerializer(user)
+        serializer.add_pages(subcomment_pages=models.Comment
+                             .embedded_subcomment_pages(comment_list))
+        response_message = {
+            'message': 'Success',
+            'comment': [serializer.comment(comment)
+                        for comment in comment_list],
+            'next_cursor': self._encode_cursor(next_key)
+        }
+
+        return make_response(jsonify(response_message), 200)
+
     def post(self, post_id: int):
         if str(request.url_rule) != self.URL_RULE_POST_COMMENTS:
             abort(404)
@@ -279,11 +569,41 @@ class Comment(Resource):
         return make_response(jsonify(response_message), 200)
 
 
-class SubComment(Resource):
+class SubComment(PaginatedResource):
     URL_RULE_SUBCOMMENTS = '/post/comment/subcomment/<int:subcomment_id>'
     URL_RULE_COMMENT_SUBCOMMENTS = \
         '/post/comment/<int:comment_id>/subcomment'
 
+    def get(self, comment_id: int):
+        if str(request.url_rule) != self.URL_RULE_COMMENT_SUBCOMMENTS:
+            abort(404)
+
+        user = utils.Auth.verify_authorization(request=request)
+
+        if user is None:
+            abort(400)
+
+        limit, after = self._get_page_args(
+            default_limit=app.config['COMMENT_PAGE_DEFAULT_LIMIT'],
+            max_limit=app.config['COMMENT_PAGE_MAX_LIMIT'])
+
+        subcomment_list, next_key = models.SubComment.keyset_page(
+            query=models.SubComment.page_query().filter_by(
+                comment_id=comment_id),
+            limit=limit, after=after)
+        if not subcomment_list and not models.Comment.row_exists(comment_id):
+            abort(400)
+
+        serializer = serializers.FeedSerializer(user)
+        response_message = {
+            'message': 'Success',
+            'subcomment': [serializer.subcomment(subcomment)
+                           for subcomment in subcomment_list],
+            'next_cursor': self._encode_cursor(next_key)
+        }
+
+        return make_response(jsonify(response_message), 200)
+
     def post(self, comment_id: int):
         if str(request.url_rule) != self.URL_RULE_COMMENT_SUBCOMMENTS:
             abort(404)
@@ -328,6 +648,7 @@ class SubComment(Resource):
 
         return make_response(jsonify(response_message), 200)
 
+
 user_routes = [
     User.URL_RULE_USER,
     User.URL_RULE_USER_BY_ID
@@ -336,6 +657,8 @@ user_routes = [
 post_routes = [
     Post.URL_RULE_POST_ROOT,
     Post.URL_RULE_ALL_POSTS,
+    Post.URL_RULE_POSTS_BY_IDS,
+    Post.URL_RULE_SEARCH_POSTS,
     Post.URL_RULE_SINGLE_POST_BY_ID,
     Post.URL_RULE_POSTS_BY_USER_ID,
     Post.URL_RULE_POSTS_BY_USERNAME
@@ -0,0 +1,224 @@
+"""
+Bulk synthetic data for performance work, see `manage.py seed`.
+"""
+import array
+import csv
+import datetime
+import io
+import itertools
+import random
+import time
+import sqlalchemy
+from flask_init import db
+import models
+
+# Fixed end of the seeded timeline, so that a seed always gives the same rows
+SEED_EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Seeder():
+    """
+    Generates users, posts, comments and subcomments with a skew close to a
+    real social network and writes them in chunks with COPY (PostgreSQL) or
+    executemany inserts (other databases), one commit per chunk.
+
+    - Authors follow a power law: a few users write most of the posts,
+      comments and subcomments (Zipf weights over the users).
+    - Comments per post and subcomments per comment are Pareto distributed
+      around the given means, so a few posts go viral.
+    - Posts are spread over `days`, comments and subcomments come after
+      their parents.
+
+    The post and comment counters are computed while generating, ids
+    continue after the existing rows. The same random seed gives the same
+    rows.
+    """
+    USER_COLUMNS = (
+        'id', 'username', 'email', 'password_hash', 'profile_image',
+        'created')
+    POST_COLUMNS = (
+        'id', 'user_id', 'resource', 'description', 'created', 'media_state',
+        'comment_count', 'subcomment_count')
+    COMMENT_COLUMNS = (
+        'id', 'post_id', 'user_id', 'text', 'created', 'subcomment_count')
+    SUBCOMMENT_COLUMNS = ('id', 'comment_id', 'user_id', 'text', 'created')
+
+    def __init__(
+            self, seed: int = 0, chunk_size: int = 10000,
+            author_skew: float = 1.1, virality: float = 1.5,
+            days: int = 365, password: str = 'seed_password'):
+        self._random = random.Random(seed)
+        self._chunk_size = chunk_size
+        self._author_skew = author_skew
+        self._virality = virality
+        self._days = days
+        self._password_hash = models.pwd_context.hash(password)
+        self._rows = {}
+        self._seconds = {}
+
+    @property
+    def report(self) -> dict:
+        """
+        Table -> (rows written, rows per second).
+        """
+        return {
+            table: (rows, rows / self._seconds[table]
+                    if self._seconds[table] else 0.0)
+            for table, rows in self._rows.items()}
+
+    def _next_id(self, model) -> int:
+        return (db.session.query(
+            sqlalchemy.func.max(model.id)).scalar() or 0) + 1
+
+    def _write(self, model, columns: tuple, rows: list):
+        if not rows:
+            return
+
+        table = model.__tablename__
+        start = time.perf_counter()
+
+        connection = db.session.connection()
+        if connection.dialect.name == 'postgresql':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                [value.isoformat() if isinstance(
+                    value, datetime.datetime) else value
+                 for value in row] for row in rows)
+            buffer.seek(0)
+
+            column_list = ', '.join(columns)
+            connection.connection.cursor().copy_expert(
+                f'COPY "{table}" ({column_list}) FROM STDIN '
+                f'WITH (FORMAT csv)', buffer)
+        else:
+            connection.execute(
+                model.__table__.insert(),
+                [dict(zip(columns, row)) for row in rows])
+        db.session.commit()
+
+        self._rows[table] = self._rows.get(table, 0) + len(rows)
+        self._seconds[table] = self._seconds.get(table, 0.0) + \
+            time.perf_counter() - start
+
+    def _pareto_count(self, mean: float) -> int:
+        """
+        Heavy-tailed count with the given mean (randomly rounded, so that
+        the mean holds for small values too).
+        """
+        if mean <= 0:
+            return 0
+        scale = mean * (self._virality - 1) / self._virality
+        return int(
+            scale * self._random.paretovariate(self._virality) +
+            self._random.random())
+
+    def _after(self, moment: datetime.datetime) -> datetime.datetime:
+        # Replies mostly come within hours, never after the epoch
+        delay = datetime.timedelta(
+            seconds=self._random.expovariate(1 / 3600))
+        return min(moment + delay, SEED_EPOCH)
+
+    def seed_users(self, users: int) -> list:
+        """
+        Writes the users, returns their ids.
+        """
+        first_id = self._next_id(models.User)
+        user_ids = list(range(first_id, first_id + users))
+        start = SEED_EPOCH - datetime.timedelta(days=self._days)
+
+        for chunk in _chunks(user_ids, self._chunk_size):
+            self._write(models.User, self.USER_COLUMNS, [
+                (user_id, f'seed_user_{user_id}',
+                 f'seed_user_{user_id}@example.com', self._password_hash,
+                 'seed_profile.jpg', start)
+                for user_id in chunk])
+
+        return user_ids
+
+    def seed_posts(
+            self, user_ids: list, posts: int, comments_per_post: float,
+            subcomments_per_comment: float):
+        """
+        Writes the posts with their comments and subcomments, by users
+        picked with power-law weights.
+        """
+        # Zipf weights, the most active users being random ones
+        weights = [
+            1 / rank ** self._author_skew
+            for rank in range(1, len(user_ids) + 1)]
+        self._random.shuffle(weights)
+        cum_weights = array.array('d', itertools.accumulate(weights))
+
+        def authors(count: int) -> list:
+            return self._random.choices(
+                user_ids, cum_weights=cum_weights, k=count)
+
+        post_id = self._next_id(models.Post)
+        comment_id = self._next_id(models.Comment)
+        subcomment_id = self._next_id(models.SubComment)
+        span = self._days * 86400
+
+        post_rows, comment_rows, subcomment_rows = [], [], []
+        for author_id in authors(posts):
+            created = SEED_EPOCH - datetime.timedelta(
+                seconds=self._random.uniform(0, span))
+
+            post_subcomments = 0
+            comments = self._pareto_count(comments_per_post)
+            for commenter_id in authors(comments):
+                comment_created = self._after(created)
+                subcomments = self._pareto_count(subcomments_per_comment)
+                for subcommenter_id in authors(subcomments):
+                    subcomment_rows.append((
+                        subcomment_id, comment_id, subcommenter_id,
+                        'Seeded subcomment', self._after(comment_created)))
+                    subcomment_id += 1
+
+                comment_rows.append((
+                    comment_id, post_id, commenter_id, 'Seeded comment',
+                    comment_created, subcomments))
+                comment_id += 1
+                post_subcomments += subcomments
+
+            post_rows.append((
+                post_id, author_id, 'seed_post.jpg', 'Seeded post', created,
+                models.Post.MEDIA_STATE_READY, comments, post_subcomments))
+            post_id += 1
+
+            if len(post_rows) + len(comment_rows) + len(subcomment_rows) \
+                    >= self._chunk_size:
+                self._flush(post_rows, comment_rows, subcomment_rows)
+                post_rows, comment_rows, subcomment_rows = [], [], []
+
+        self._flush(post_rows, comment_rows, subcomment_rows)
+
+    def _flush(self, post_rows, comment_rows, subcomment_rows):
+        # Parents first, for the foreign keys
+        self._write(models.Post, self.POST_COLUMNS, post_rows)
+        self._write(models.Comment, self.COMMENT_COLUMNS, comment_rows)
+        self._write(
+            models.SubComment, self.SUBCOMMENT_COLUMNS, subcomment_rows)
+
+    def finish(self):
+        """
+        Moves the id sequences past the seeded rows and refreshes the
+        planner statistics (PostgreSQL).
+        """
+        if db.session.connection().dialect.name != 'postgresql':
+            return
+
+        for model in (
+                models.User, models.Post, models.Comment, models.SubComment):
+            table = model.__tablename__
+            db.session.execute(
+                f'SELECT setval(pg_get_serial_sequence(\'"{table}"\', '
+                f'\'id\'), (SELECT max(id) FROM "{table}"))')
+        db.session.commit()
+
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+
+def _chunks(values: list, size: int):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
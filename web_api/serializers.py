@@ -0,0 +1,149 @@
+import datetime
+import operator
+import sqlalchemy
+from flask_init import app
+import utils
+
+
+def isoformat(value):
+    if isinstance(value, datetime.date):  # datetime is a date subclass
+        return value.isoformat()
+    return value
+
+
+def media_variant_urls(file_name: str, stored_variants: str) -> dict:
+    """
+    URLs of the resized variants of an image, by variant. Variants not
+    stored (yet), as recorded in `stored_variants`, get the URL of the
+    original.
+    """
+    stored = stored_variants.split(',') if stored_variants else ()
+    return {
+        variant: app.config['MEDIA_BASE_URL'].format(
+            file_name=variant_name if variant in stored else file_name)
+        for variant, variant_name in utils.File.variant_names(
+            file_name).items()
+    }
+
+
+class ColumnSerializer():
+    """
+    Column name -> value serializer, compiled once per model class.
+    Column lookup is done at compile time, values are read with a single
+    attrgetter call and Date/DateTime columns are rendered as ISO 8601.
+    """
+    _compiled = {}
+
+    def __init__(self, model, exclude: frozenset = frozenset()):
+        columns = [
+            column for column in model.__table__.columns
+            if column.name not in exclude]
+
+        self._names = tuple(column.name for column in columns)
+        self._getter = operator.attrgetter(*self._names)
+        self._temporal_names = tuple(
+            column.name for column in columns
+            if isinstance(
+                column.type, (sqlalchemy.Date, sqlalchemy.DateTime)))
+
+    @classmethod
+    def for_model(cls, model, exclude: frozenset = frozenset()):
+        key = (model, exclude)
+        serializer = cls._compiled.get(key)
+        if serializer is None:
+            serializer = cls._compiled[key] = cls(model, exclude)
+        return serializer
+
+    def __call__(self, instance) -> dict:
+        output = dict(zip(self._names, self._getter(instance)))
+        for name in self._temporal_names:
+            output[name] = isoformat(output[name])
+        return output
+
+
+class FeedSerializer():
+    """
+    Serializes posts with their users, comments and subcomments into the
+    structure of Post.output_with_permissions_and_users, except that only
+    the first page of comments and subcomments is embedded, together with
+    the cursor of the next page.
+    Lives for a single request: the same users and media files show up
+    all over a feed, so their outputs are memoized.
+    """
+    def __init__(self, auth_user):
+        self._auth_user_id = auth_user.id
+        self._media_base_url = app.config['MEDIA_BASE_URL']
+        self._media_urls = {}
+        self._media_variant_urls = {}
+        self._users = {}
+        self._comment_pages = {}
+        self._subcomment_pages = {}
+
+    def add_pages(
+            self, comment_pages: dict = None, subcomment_pages: dict = None):
+        """
+        Registers the embedded first pages, see
+        Post.embedded_comment_pages.
+        """
+        self._comment_pages.update(comment_pages or {})
+        self._subcomment_pages.update(subcomment_pages or {})
+
+    @staticmethod
+    def _cursor(next_key: tuple):
+        return utils.Cursor.encode(next_key) if next_key is not None else None
+
+    def media_url(self, file_name: str) -> str:
+        url = self._media_urls.get(file_name)
+        if url is None:
+            url = self._media_urls[file_name] = \
+                self._media_base_url.format(file_name=file_name)
+        return url
+
+    def media_variant_urls(self, file_name: str, stored_variants: str) -> dict:
+        key = (file_name, stored_variants)
+        urls = self._media_variant_urls.get(key)
+        if urls is None:
+            urls = self._media_variant_urls[key] = \
+                media_variant_urls(file_name, stored_variants)
+        return urls
+
+    def user(self, user) -> dict:
+        output = self._users.get(user.id)
+        if output is None:
+            output = ColumnSerializer.for_model(
+                type(user), exclude=user._IGNORE_ATTRS_ON_OUTPUT)(user)
+            output['profile_image_variants'] = self.media_variant_urls(
+                output['profile_image'], user.profile_image_variant_names)
+            output['profile_image'] = self.media_url(output['profile_image'])
+            self._users[user.id] = output
+        return output
+
+    def subcomment(self, subcomment) -> dict:
+        output = ColumnSerializer.for_model(type(subcomment))(subcomment)
+        output['username'] = self.user(subcomment.user)['username']
+        output['edit_allowed'] = subcomment.user_id == self._auth_user_id
+        return output
+
+    def comment(self, comment) -> dict:
+        output = ColumnSerializer.for_model(type(comment))(comment)
+        output['username'] = self.user(comment.user)['username']
+        subcomments, next_key = self._subcomment_pages.get(
+            comment.id, ([], None))
+        output['subcomments'] = [
+            self.subcomment(subcomment) for subcomment in subcomments]
+        output['subcomments_next_cursor'] = self._cursor(next_key)
+        output['edit_allowed'] = comment.user_id == self._auth_user_id
+        return output
+
+    def post(self, post) -> dict:
+        output = ColumnSerializer.for_model(
+            type(post), exclude=post._IGNORE_ATTRS_ON_OUTPUT)(post)
+        output['resource_variants'] = self.media_variant_urls(
+            output['resource'], post.resource_variant_names)
+        output['resource'] = self.media_url(output['resource'])
+        output['edit_allowed'] = post.user_id == self._auth_user_id
+        output['user'] = self.user(post.user)
+        comments, next_key = self._comment_pages.get(post.id, ([], None))
+        output['comments'] = [self.comment(comment) for comment in comments]
+        output['comments_next_cursor'] = self._cursor(next_key)
+        return output
@@ -0,0 +1,57 @@
+import contextlib
+import pytest
+import sqlalchemy
+import flask_init
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+@contextlib.contextmanager
+def _app_database(database_uri: str):
+    """
+    db behind the app on database_uri, with the tables created, for the
+    duration of the block. Foreign keys are enforced on SQLite.
+    """
+    app = flask_init.app
+    db = flask_init.db
+    configured_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+
+    try:
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite' and not \
+                    sqlalchemy.event.contains(
+                        db.engine, 'connect', _enable_foreign_keys):
+                sqlalchemy.event.listen(
+                    db.engine, 'connect', _enable_foreign_keys)
+            db.create_all()
+            try:
+                yield db
+            finally:
+                db.session.remove()
+                db.drop_all()
+    finally:
+        app.config['SQLALCHEMY_DATABASE_URI'] = configured_uri
+
+
+@pytest.fixture(scope='session')
+def app_database():
+    """
+    Context manager putting the app on a database, for fixtures of any
+    scope:
+
+        with app_database('sqlite://') as db:
+            ...
+    """
+    return _app_database
+
+
+@pytest.fixture
+def sqlite_db(app_database):
+    """
+    In-memory SQLite database behind db.session for the duration of a test.
+    """
+    with app_database('sqlite://') as db:
+        yield db
@@ -0,0 +1,290 @@
+import json
+import os
+import re
+import pytest
+import sqlalchemy
+import flask_init
+import models
+import resources
+import utils
+
+# Tables bigger than this must not be scanned sequentially
+SEQ_SCAN_ROW_THRESHOLD = 1000
+
+SEEDED_ROWS = {
+    'USER': 50,
+    'POST': 5000,
+    'COMMENT': 10000,
+    'SUBCOMMENT': 10000,
+}
+
+POSTGRES_SCHEMA = 'explain_test'
+
+# Matches the description of a single post, and no comment
+SEARCH_TERMS = '4242'
+
+# Every query issued by these requests is EXPLAINed. Writes last, they
+# change the seeded data.
+REQUESTS = [
+    ('get', '/post/all'),
+    ('get', '/post/all?limit=5&cursor={cursor}'),
+    ('get', '/post/all?stream=1&limit=50'),
+    ('get', '/post/batch?ids=1,20,300'),
+    ('get', '/post/42'),
+    ('get', '/post/user/7'),
+    ('get', '/post/user/username/user_7'),
+    ('get', '/post/42/comment'),
+    ('get', '/post/comment/84/subcomment'),
+    ('post', '/post/42/comment'),
+    ('post', '/post/comment/84/subcomment'),
+    ('delete', '/post/comment/subcomment/168'),
+    ('delete', '/post/comment/85'),
+    ('delete', '/post/43'),
+    ('delete', '/user'),
+]
+
+
+def _database_uri() -> str:
+    """
+    EXPLAIN_DATABASE_URI, or the configured database. On PostgreSQL the
+    tables live in their own schema.
+    """
+    database_uri = os.environ.get(
+        'EXPLAIN_DATABASE_URI',
+        flask_init.app.config['SQLALCHEMY_DATABASE_URI'])
+
+    if database_uri.startswith('postgresql'):
+        separator = '&' if '?' in database_uri else '?'
+        database_uri += \
+            f'{separator}options=-csearch_path%3D{POSTGRES_SCHEMA}'
+
+    return database_uri
+
+
+def _seed(db):
+    users, posts, comments, subcomments = [
+        SEEDED_ROWS[table]
+        for table in ('USER', 'POST', 'COMMENT', 'SUBCOMMENT')]
+
+    db.session.execute(models.User.__table__.insert(), [
+        {'id': user_id, 'username': f'user_{user_id}',
+         'email': f'user_{user_id}@email.com', 'profile_image': 'img.jpg'}
+        for user_id in range(1, users + 1)])
+    db.session.execute(models.Post.__table__.insert(), [
+        {'id': post_id, 'user_id': post_id % users + 1,
+         'resource': 'img.jpg', 'description': f'Post {post_id}'}
+        for post_id in range(1, posts + 1)])
+    db.session.execute(models.Comment.__table__.insert(), [
+        {'id': comment_id, 'post_id': (comment_id + 1) // 2,
+         'user_id': comment_id % users + 1, 'text': 'Test text'}
+        for comment_id in range(1, comments + 1)])
+    db.session.execute(models.SubComment.__table__.insert(), [
+        {'id': subcomment_id, 'comment_id': (subcomment_id + 1) // 2,
+         'user_id': subcomment_id % users + 1, 'text': 'Test text'}
+        for subcomment_id in range(1, subcomments + 1)])
+    db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        _add_search_vectors(db)
+
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+
+def _add_search_vectors(db):
+    """
+    The search_vector columns and GIN indexes of migration 9c5b3e7a2d48,
+    which create_all does not know about.
+    """
+    text_config = flask_init.app.config['SEARCH_TEXT_CONFIG']
+    for model, column in ((models.Post, 'description'),
+                          (models.Comment, 'text')):
+        table = model.__tablename__
+        db.session.execute(
+            f'ALTER TABLE "{table}" ADD COLUMN search_vector tsvector')
+        db.session.execute(
+            f'UPDATE "{table}" SET search_vector = '
+            f'to_tsvector(\'{text_config}\', coalesce("{column}", \'\'))')
+        db.session.execute(
+            f'CREATE INDEX "ix_{table}_search_vector" ON "{table}" '
+            f'USING gin (search_vector)')
+    db.session.commit()
+
+
+@pytest.fixture(scope='module')
+def seeded_db(app_database):
+    database_uri = _database_uri()
+
+    try:
+        engine = sqlalchemy.create_engine(database_uri.split('?')[0])
+        with engine.connect() as connection:
+            if engine.dialect.name == 'postgresql':
+                connection.execute(
+                    f'CREATE SCHEMA IF NOT EXISTS {POSTGRES_SCHEMA}')
+    except sqlalchemy.exc.OperationalError as exception:
+        pytest.skip(f'No database to EXPLAIN against: {exception}')
+
+    with app_database(database_uri) as db:
+        _seed(db)
+        yield db
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute(f'DROP SCHEMA {POSTGRES_SCHEMA} CASCADE')
+
+
+def _postgresql_seq_scans(plan: dict):
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for child_plan in plan.get('Plans', []):
+        yield from _postgresql_seq_scans(child_plan)
+
+
+def _postgresql_indexes(plan: dict):
+    if 'Index Name' in plan:
+        yield plan['Index Name']
+    for child_plan in plan.get('Plans', []):
+        yield from _postgresql_indexes(child_plan)
+
+
+def _postgresql_plan(connection, statement: str, parameters) -> dict:
+    result = connection.execute(
+        f'EXPLAIN (FORMAT JSON) {statement}', parameters).scalar()
+    return (json.loads(result) if isinstance(result, str)
+            else result)[0]['Plan']
+
+
+# "SCAN POST", "SCAN TABLE POST AS p"; not "SCAN POST USING INDEX ..."
+_SQLITE_SEQ_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?(?: AS \w+)?$')
+
+
+def seq_scans(connection, statement: str, parameters) -> list:
+    """
+    Tables the statement scans sequentially, according to EXPLAIN.
+    """
+    if connection.dialect.name == 'postgresql':
+        return list(_postgresql_seq_scans(
+            _postgresql_plan(connection, statement, parameters)))
+
+    rows = connection.execute(
+        f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+    return [
+        match.group(1) for match in
+        (_SQLITE_SEQ_SCAN.match(row[-1]) for row in rows) if match]
+
+
+class TestExplain():
+    @pytest.mark.parametrize('method,url', REQUESTS)
+    def test_no_seq_scans(self, seeded_db, mocker, method, url):
+        # GIVEN
+        db = seeded_db
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = \
+            models.User.query.get(1)
+
+        post = models.Post.query.get(100)
+        url = url.format(
+            cursor=utils.Cursor.encode((post.created, post.id)))
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if not executemany and re.match(
+                    r'\s*(SELECT|UPDATE|DELETE)', statement):
+                statements.append((statement, parameters))
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+
+        # WHEN
+        try:
+            response = getattr(flask_init.app.test_client(), method)(
+                url, data={'text': 'Test text'})
+        finally:
+            sqlalchemy.event.remove(
+                db.engine, 'before_cursor_execute', capture)
+
+        # THEN
+        assert response.status_code < 400, response.data
+        assert statements
+
+        large_tables = {
+            table for table, rows in SEEDED_ROWS.items()
+            if rows > SEQ_SCAN_ROW_THRESHOLD}
+        with db.engine.connect() as connection:
+            for statement, parameters in statements:
+                scanned = set(seq_scans(connection, statement, parameters))
+                assert not scanned & large_tables, statement
+
+    def test_search_uses_gin_indexes(self, seeded_db, mocker):
+        # GIVEN
+        db = seeded_db
+        if db.engine.dialect.name != 'postgresql':
+            pytest.skip('Full-text search needs PostgreSQL')
+
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = \
+            models.User.query.get(1)
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if 'search_vector' in statement:
+                statements.append((statement, parameters))
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+
+        # WHEN
+        try:
+            response = flask_init.app.test_client().get(
+                f'/post/search?q={SEARCH_TERMS}')
+        finally:
+            sqlalchemy.event.remove(
+                db.engine, 'before_cursor_execute', capture)
+
+        # THEN
+        assert response.status_code == 200, response.data
+        assert [post['id'] for post in response.get_json()['post']] == \
+            [int(SEARCH_TERMS)]
+        assert len(statements) == 1
+
+        with db.engine.connect() as connection:
+            plan = _postgresql_plan(connection, *statements[0])
+        assert {'ix_POST_search_vector', 'ix_COMMENT_search_vector'} <= \
+            set(_postgresql_indexes(plan))
+        assert not set(_postgresql_seq_scans(plan)) & {'POST', 'COMMENT'}
+
+    def test_first_pages_use_parent_index(self, seeded_db):
+        # GIVEN
+        db = seeded_db
+        if db.engine.dialect.name != 'postgresql':
+            pytest.skip('LATERAL needs PostgreSQL')
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if 'LATERAL' in statement:
+                statements.append((statement, parameters))
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+
+        # WHEN
+        try:
+            pages = models.Comment.first_pages(
+                parent_column=models.Comment.post_id,
+                parent_ids=[42, 43], limit=2)
+        finally:
+            sqlalchemy.event.remove(
+                db.engine, 'before_cursor_execute', capture)
+
+        # THEN
+        assert all(len(comments) <= 2 for comments, _ in pages.values())
+        assert len(statements) == 1
+
+        with db.engine.connect() as connection:
+            plan = _postgresql_plan(connection, *statements[0])
+        assert 'ix_COMMENT_post_id_created_id' in \
+            set(_postgresql_indexes(plan))
+        assert 'COMMENT' not in set(_postgresql_seq_scans(plan))
@@ -0,0 +1,84 @@
+import flask
+import prometheus_client
+import sqlalchemy
+import flask_init
+import service_metrics
+import resources
+
+
+def sample(name: str, **labels) -> float:
+    return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics():
+    def setup(self):
+        self.app = flask_init.app.test_client()
+
+    def test_request_is_counted_by_route(self):
+        # GIVEN
+        labels = {'method': 'GET', 'route': '/post/<int:post_id>'}
+        requests_before = sample(
+            'http_requests_total', status='400', **labels)
+        latency_before = sample(
+            'http_request_duration_seconds_count', **labels)
+
+        # WHEN
+        response = self.app.get('/post/1')  # no Authorization header
+
+        # THEN
+        assert response.status_code == 400
+        assert sample('http_requests_total', status='400', **labels) == \
+            requests_before + 1
+        assert sample('http_request_duration_seconds_count', **labels) == \
+            latency_before + 1
+        assert sample('http_requests_in_progress') == 0
+
+    def test_unmatched_route(self):
+        # GIVEN
+        labels = {'method': 'GET', 'route': 'unmatched', 'status': '404'}
+        expected = sample('http_requests_total', **labels) + 1
+
+        # WHEN
+        self.app.get('/no/such/route')
+
+        # THEN
+        assert sample('http_requests_total', **labels) == expected
+
+    def test_sql_queries_are_counted_per_request(self):
+        # GIVEN
+        engine = sqlalchemy.create_engine('sqlite://')
+
+        # WHEN
+        with flask_init.app.test_request_context():
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            queries = flask.g.metrics_sql_queries
+            duration = flask.g.metrics_sql_duration
+
+        # THEN
+        assert queries == 2
+        assert duration > 0
+
+    def test_pool_checkout_wait(self):
+        # GIVEN
+        engine = sqlalchemy.create_engine(
+            'sqlite://', poolclass=service_metrics.TimedQueuePool)
+        expected = sample('sqlalchemy_pool_checkout_wait_seconds_count') + 1
+
+        # WHEN
+        with engine.connect():
+            pass
+
+        # THEN
+        assert sample('sqlalchemy_pool_checkout_wait_seconds_count') == \
+            expected
+
+    def test_metrics_endpoint(self):
+        # WHEN
+        response = self.app.get('/metrics')
+
+        # THEN
+        assert response.status_code == 200
+        assert response.content_type == prometheus_client.CONTENT_TYPE_LATEST
+        assert b'http_requests_total' in response.data
+        assert b'media_upload_duration_seconds' in response.data
@@ -1,5 +1,9 @@
 import copy
+import pytest
+import sqlalchemy
+import flask_init
 import models
+import utils
 
 
 class TestUser():
@@ -79,4 +83,372 @@ class TestPost():
 
         self.data = models.Post()
         self.data.user_id = user.id
-        self.data.user = user
\ No newline at end of file
+        self.data.user = user
+
+class TestComment():
+    def setup(self):
+        self.user = models.User(id = 1, username = 'test_username')
+        self.post = models.Post(id = 1, user_id = 1)
+
+    def test_save_increments_post_counter(self, mocker):
+        # GIVEN
+        db_session_mock = mocker.patch.object(flask_init.db, "session")
+        increment_mock = mocker.patch.object(
+            models.Post, "increment_counters")
+
+        # WHEN
+        comment = models.Comment().save(
+            form_data={'text': 'Test text'}, post=self.post, user=self.user)
+
+        # THEN
+        db_session_mock.add.assert_called_once_with(comment)
+        increment_mock.assert_called_once_with(post_id=1, comment_count=1)
+        db_session_mock.commit.assert_called_once_with()
+
+
+class TestSubComment():
+    def setup(self):
+        self.user = models.User(id = 1, username = 'test_username')
+        self.comment = models.Comment(id = 1, post_id = 1, user_id = 1)
+
+    def test_save_increments_comment_counters(self, mocker):
+        # GIVEN
+        db_session_mock = mocker.patch.object(flask_init.db, "session")
+        increment_mock = mocker.patch.object(
+            models.Comment, "increment_counters")
+
+        # WHEN
+        subcomment = models.SubComment().save(
+            form_data={'text': 'Test text'}, comment=self.comment,
+            user=self.user)
+
+        # THEN
+        db_session_mock.add.assert_called_once_with(subcomment)
+        increment_mock.assert_called_once_with(
+            comment_id=1, subcomment_count=1)
+        db_session_mock.commit.assert_called_once_with()
+
+    def test_delete_decrements_comment_counters(self, mocker):
+        # GIVEN
+        db_session_mock = mocker.patch.object(flask_init.db, "session")
+        increment_mock = mocker.patch.object(
+            models.Comment, "increment_counters")
+        subcomment = models.SubComment(id = 1, comment_id = 1, user_id = 1)
+
+        # WHEN
+        subcomment.delete()
+
+        # THEN
+        increment_mock.assert_called_once_with(
+            comment_id=1, subcomment_count=-1)
+        db_session_mock.delete.assert_called_once_with(subcomment)
+        db_session_mock.commit.assert_called_once_with()
+
+
+class TestUserDelete():
+    def _insert(self, db, model, rows: list):
+        db.session.execute(model.__table__.insert(), rows)
+
+    def test_delete_is_set_based(self, sqlite_db):
+        # GIVEN
+        db = sqlite_db
+        self._insert(db, models.User, [
+            {'id': 1, 'username': 'deleted'}, {'id': 2, 'username': 'kept'}])
+
+        # 10k children: 2000 posts, 4000 comments, 4000 subcomments
+        self._insert(db, models.Post, [
+            {'id': post_id, 'user_id': 1, 'resource': 'img.jpg'}
+            for post_id in range(1, 2001)])
+        self._insert(db, models.Comment, [
+            {'id': comment_id, 'post_id': (comment_id + 1) // 2,
+             'user_id': 1, 'text': 'Test text'}
+            for comment_id in range(1, 4001)])
+        self._insert(db, models.SubComment, [
+            {'id': subcomment_id, 'comment_id': subcomment_id,
+             'user_id': 1, 'text': 'Test text'}
+            for subcomment_id in range(1, 4001)])
+
+        # Other user's post, commented by both users
+        self._insert(db, models.Post, [
+            {'id': 5000, 'user_id': 2, 'resource': 'img.jpg',
+             'comment_count': 2, 'subcomment_count': 3}])
+        self._insert(db, models.Comment, [
+            {'id': 5000, 'post_id': 5000, 'user_id': 1, 'text': 'Test text',
+             'subcomment_count': 1},
+            {'id': 5001, 'post_id': 5000, 'user_id': 2, 'text': 'Test text',
+             'subcomment_count': 2}])
+        self._insert(db, models.SubComment, [
+            {'id': 5000, 'comment_id': 5000, 'user_id': 2,
+             'text': 'Test text'},
+            {'id': 5001, 'comment_id': 5001, 'user_id': 1,
+             'text': 'Test text'},
+            {'id': 5002, 'comment_id': 5001, 'user_id': 2,
+             'text': 'Test text'}])
+        db.session.commit()
+
+        user = models.User.query.get(1)
+        statements = []
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+        # WHEN
+        user.delete()
+
+        # THEN
+        assert len(statements) <= 5
+        assert models.Post.query.filter_by(user_id=1).count() == 0
+        assert models.Comment.query.filter_by(user_id=1).count() == 0
+        assert models.SubComment.query.filter_by(user_id=1).count() == 0
+        assert models.SubComment.query.count() == 1
+
+        post = models.Post.query.get(5000)
+        assert (post.comment_count, post.subcomment_count) == (1, 1)
+        assert models.Comment.query.get(5001).subcomment_count == 1
+
+
+class TestUsernameCache():
+    def setup(self):
+        utils.username_cache.clear()
+
+    def teardown(self):
+        utils.username_cache.clear()
+
+    def _insert_users(self, db):
+        db.session.execute(models.User.__table__.insert(), [
+            {'id': 1, 'username': 'user_1'}, {'id': 2, 'username': 'user_2'}])
+        db.session.execute(models.Post.__table__.insert(), [
+            {'id': post_id, 'user_id': post_id % 2 + 1, 'resource': 'img.jpg'}
+            for post_id in range(1, 5)])
+        db.session.commit()
+
+    def test_user_feed_query(self, sqlite_db):
+        # GIVEN
+        self._insert_users(sqlite_db)
+        joined = models.Post.user_feed_query('user_2').all()
+
+        # WHEN
+        cached = models.Post.user_feed_query('user_2').all()
+
+        # THEN
+        assert utils.username_cache.get('user_2') == 2
+        assert sorted(post.id for post in joined) == [1, 3]
+        assert sorted(post.id for post in cached) == [1, 3]
+
+    def test_id_by_username(self, sqlite_db):
+        # GIVEN
+        self._insert_users(sqlite_db)
+
+        # WHEN
+        actual = models.User.id_by_username('user_1')
+
+        # THEN
+        assert actual == 1
+        assert utils.username_cache.get('user_1') == 1
+        assert models.User.id_by_username('missing') is None
+
+    def test_update_invalidates_renamed(self, sqlite_db):
+        # GIVEN
+        self._insert_users(sqlite_db)
+        user = models.User.query.get(1)
+        assert utils.username_cache.get('user_1') == 1
+
+        # WHEN
+        user.update(data={'username': 'renamed'}, file=None)
+
+        # THEN
+        assert utils.username_cache.get('user_1') is None
+        assert models.User.id_by_username('user_1') is None
+        assert models.User.id_by_username('renamed') == 1
+
+    def test_update_bumps_commented_posts(self, sqlite_db):
+        # GIVEN
+        self._insert_users(sqlite_db)
+        sqlite_db.session.execute(models.Comment.__table__.insert(), [
+            {'id': 1, 'post_id': 1, 'user_id': 1, 'text': 'Comment'},
+            {'id': 2, 'post_id': 2, 'user_id': 2, 'text': 'Comment'}])
+        sqlite_db.session.execute(models.SubComment.__table__.insert(), [
+            {'id': 1, 'comment_id': 2, 'user_id': 1, 'text': 'Reply'}])
+        sqlite_db.session.commit()
+        user = models.User.query.get(1)
+
+        # WHEN
+        user.update(data={'username': 'renamed'}, file=None)
+
+        # THEN
+        # The pages of posts 1 and 2 embed the username of user 1
+        assert [
+            post.version
+            for post in models.Post.query.order_by(models.Post.id)] == \
+            [2, 2, 1, 1]
+
+        # WHEN the username is unchanged
+        models.User.query.get(1).update(
+            data={'first_name': 'First'}, file=None)
+
+        # THEN
+        assert models.Post.query.get(1).version == 2
+
+    def test_delete_invalidates(self, sqlite_db):
+        # GIVEN
+        self._insert_users(sqlite_db)
+        user = models.User.query.get(1)
+
+        # WHEN
+        user.delete()
+
+        # THEN
+        assert utils.username_cache.get('user_1') is None
+        assert models.User.id_by_username('user_1') is None
+
+
+class TestPostUpdate():
+    def _insert_post(self, db):
+        db.session.execute(
+            models.User.__table__.insert(), [{'id': 1, 'username': 'user'}])
+        db.session.execute(models.Post.__table__.insert(), [
+            {'id': 1, 'user_id': 1, 'resource': 'img.jpg',
+             'description': 'Old'}])
+        db.session.commit()
+
+    def test_update(self, sqlite_db):
+        # GIVEN
+        self._insert_post(sqlite_db)
+
+        # WHEN
+        post = models.Post.update(
+            post_id=1, form_data={'description': 'New', 'version': 9},
+            file=None, user=None, revision=1)
+
+        # THEN
+        assert (post.description, post.revision, post.version) == \
+            ('New', 2, 2)
+        assert post.output()['description'] == 'New'
+
+    def test_update_conflict(self, sqlite_db):
+        # GIVEN
+        self._insert_post(sqlite_db)
+        models.Post.update(
+            post_id=1, form_data={'description': 'First'}, file=None,
+            user=None, revision=1)
+
+        # WHEN
+        with pytest.raises(models.VersionConflict):
+            models.Post.update(
+                post_id=1, form_data={'description': 'Second'}, file=None,
+                user=None, revision=1)
+
+        # THEN
+        post = models.Post.query.get(1)
+        assert (post.description, post.revision) == ('First', 2)
+
+    def test_update_missing(self, sqlite_db):
+        # WHEN
+        post = models.Post.update(
+            post_id=1, form_data={'description': 'New'}, file=None,
+            user=None, revision=1)
+
+        # THEN
+        assert post is None
+
+    def test_comments_do_not_conflict(self, sqlite_db):
+        # GIVEN
+        self._insert_post(sqlite_db)
+        models.Post.increment_counters(post_id=1, comment_count=1)
+        sqlite_db.session.commit()
+
+        # WHEN
+        post = models.Post.update(
+            post_id=1, form_data={'description': 'New'}, file=None,
+            user=None, revision=1)
+
+        # THEN
+        assert (post.revision, post.version) == (2, 3)
+
+
+class TestResumeMediaUploads():
+    def test_resume_media_uploads(self, mocker, sqlite_db, tmpdir):
+        # GIVEN
+        sqlite_db.session.execute(
+            models.User.__table__.insert(), [{'id': 1, 'username': 'user'}])
+        sqlite_db.session.execute(models.Post.__table__.insert(), [
+            {'id': 1, 'user_id': 1, 'resource': 'spooled.jpg',
+             'media_state': 'pending'},
+            {'id': 2, 'user_id': 1, 'resource': 'gone.jpg',
+             'media_state': 'pending'},
+            {'id': 3, 'user_id': 1, 'resource': 'other.jpg',
+             'media_state': 'pending'}])
+        sqlite_db.session.commit()
+
+        tmpdir.join('spooled').write_binary(b'abcdef')
+        spooled = utils.SpooledUpload(
+            path=str(tmpdir.join('spooled')), filename='spooled.jpg',
+            content_type='image/jpeg')
+        gone = utils.SpooledUpload(
+            path=str(tmpdir.join('gone')), filename='gone.jpg',
+            content_type='image/jpeg')
+        upload_queue_mock = mocker.patch.object(utils, "upload_queue")
+        upload_queue_mock.left_over.return_value = [spooled, gone]
+
+        # WHEN
+        actual = models.Post.resume_media_uploads(spooled_before=1.0)
+
+        # THEN
+        assert actual == 2
+        upload_queue_mock.left_over.assert_called_once_with(1.0)
+        upload_queue_mock.submit.assert_called_once_with(
+            spooled_upload=spooled, on_done=mocker.ANY)
+        upload_queue_mock.discard.assert_called_once_with(gone)
+        assert [
+            post.media_state
+            for post in models.Post.query.order_by(models.Post.id)] == \
+            ['pending', 'failed', 'pending']
+
+        # WHEN the upload is done
+        upload_queue_mock.submit.call_args[1]['on_done'](True)
+
+        # THEN
+        assert models.Post.query.get(1).media_state == 'ready'
+
+
+class TestMediaVariants():
+    def test_record_media_variants(self, sqlite_db):
+        # GIVEN
+        sqlite_db.session.execute(models.User.__table__.insert(), [
+            {'id': 1, 'username': 'user_1', 'profile_image': 'img.jpg'},
+            {'id': 2, 'username': 'user_2', 'profile_image': 'other.jpg'}])
+        sqlite_db.session.execute(models.Post.__table__.insert(), [
+            {'id': 1, 'user_id': 1, 'resource': 'img.jpg'},
+            {'id': 2, 'user_id': 1, 'resource': 'other.jpg'}])
+        sqlite_db.session.commit()
+
+        # WHEN
+        models.record_media_variants('img.jpg', ['thumbnail', 'medium'])
+
+        # THEN
+        post, other_post = models.Post.query.order_by(models.Post.id)
+        assert (post.resource_variant_names, post.version) == \
+            ('medium,thumbnail', 2)
+        assert (other_post.resource_variant_names, other_post.version) == \
+            (None, 1)
+        user = models.User.query.get(1)
+        assert (user.profile_image_variant_names, user.version) == \
+            ('medium,thumbnail', 1)
+        assert models.stored_media_variants('img.jpg') == 'medium,thumbnail'
+        assert models.stored_media_variants('other.jpg') is None
+        assert post.output()['resource_variants']['thumbnail'] == \
+            flask_init.app.config['MEDIA_BASE_URL'].format(
+                file_name='img_thumbnail.jpg')
+        assert 'resource_variant_names' not in post.output()
+
+
+class TestRowExists():
+    def test_row_exists(self, sqlite_db):
+        # GIVEN
+        sqlite_db.session.execute(
+            models.User.__table__.insert(), [{'id': 1, 'username': 'user'}])
+        sqlite_db.session.commit()
+
+        # THEN
+        assert models.User.row_exists(1) is True
+        assert models.User.row_exists(2) is False
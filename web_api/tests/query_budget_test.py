@@ -0,0 +1,154 @@
+import functools
+import math
+import os
+import pytest
+import sqlalchemy
+import flask_init
+import manage_test_db
+import models
+import resources
+import utils
+
+# Every budgeted request runs at each of these page sizes
+PAGE_SIZES = (1, 5, 20)
+
+# Seeded by manage_test_db.populate, enough for full pages at every size
+USERS = 5
+POSTS_PER_USER = 10
+COMMENTS_PER_POST = 25
+SUBCOMMENTS_PER_COMMENT = 25
+
+# Small, so that the streamed pages take several batches
+STREAM_BATCH_SIZE = 4
+
+
+def _database_uri() -> str:
+    """
+    QUERY_BUDGET_DATABASE_URI, or an in-memory sqlite database: statement
+    counts do not depend on the backend.
+    """
+    return os.environ.get('QUERY_BUDGET_DATABASE_URI', 'sqlite://')
+
+
+@pytest.fixture(scope='module')
+def budget_db(app_database):
+    with app_database(_database_uri()) as db:
+        manage_test_db.populate(
+            users=USERS, posts_per_user=POSTS_PER_USER,
+            comments_per_post=COMMENTS_PER_POST,
+            subcomments_per_comment=SUBCOMMENTS_PER_COMMENT)
+        yield db
+
+
+@pytest.fixture
+def sql_statements(budget_db, mocker):
+    """
+    SQL statements issued from the start of the test on, against the
+    seeded database, with user_1 authorized.
+    """
+    db = budget_db
+    auth_user = db.session.query(models.User).get(1)
+    db.session.expunge(auth_user)
+    auth_user_mock = mocker.patch.object(utils, "Auth")
+    auth_user_mock.verify_authorization.return_value = auth_user
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+    yield statements
+    sqlalchemy.event.remove(db.engine, 'before_cursor_execute', capture)
+
+
+def query_budget(budget):
+    """
+    Runs the test at every page size in PAGE_SIZES (the `page_size`
+    argument) and fails it when it issues more than budget(page_size) SQL
+    statements. The test must take the `sql_statements` fixture.
+    """
+    def decorator(test):
+        @functools.wraps(test)
+        def wrapper(*args, page_size, sql_statements, **kwargs):
+            test(
+                *args, page_size=page_size, sql_statements=sql_statements,
+                **kwargs)
+
+            allowed = budget(page_size)
+            assert len(sql_statements) <= allowed, (
+                f'{len(sql_statements)} SQL statements at page size '
+                f'{page_size}, the budget is {allowed}:\n' +
+                '\n'.join(sql_statements))
+
+        return pytest.mark.parametrize('page_size', PAGE_SIZES)(wrapper)
+
+    return decorator
+
+
+class TestQueryBudget():
+    def setup(self):
+        self.app = flask_init.app.test_client()
+
+    def get(self, url: str):
+        response = self.app.get(url)
+        response.get_data()  # runs streamed bodies to the end
+        assert response.status_code == 200, response.data
+        return response
+
+    # Versions, posts, users, comments, their users, subcomments, theirs
+    @query_budget(lambda page_size: 7)
+    def test_get_all_posts(self, page_size, sql_statements):
+        self.get(f'/post/all?limit={page_size}')
+
+    @query_budget(lambda page_size: 7)
+    def test_get_all_posts_next_page(self, page_size, sql_statements):
+        post = models.Post.query.get(USERS * POSTS_PER_USER - 1)
+        cursor = utils.Cursor.encode((post.created, post.id))
+        sql_statements.clear()
+
+        self.get(f'/post/all?limit={page_size}&cursor={cursor}')
+
+    # Versions and posts, then users and embedded pages for every batch
+    # of the page (its extra row included)
+    @query_budget(lambda page_size: 2 + 5 * math.ceil(
+        (page_size + 1) / STREAM_BATCH_SIZE))
+    def test_stream_all_posts(self, page_size, sql_statements, mocker):
+        mocker.patch.dict(
+            flask_init.app.config,
+            {'POST_STREAM_BATCH_SIZE': STREAM_BATCH_SIZE})
+
+        self.get(f'/post/all?stream=1&limit={page_size}')
+
+    @query_budget(lambda page_size: 7)
+    def test_get_posts_by_user_id(self, page_size, sql_statements):
+        self.get(f'/post/user/2?limit={page_size}')
+
+    # Same as by user id, the user being joined instead of looked up
+    @query_budget(lambda page_size: 7)
+    def test_get_posts_by_username(self, page_size, sql_statements):
+        utils.username_cache.clear()
+
+        self.get(f'/post/user/username/user_2?limit={page_size}')
+
+    @query_budget(lambda page_size: 7)
+    def test_get_posts_by_cached_username(self, page_size, sql_statements):
+        self.get(f'/post/user/username/user_2?limit={page_size}')
+        assert utils.username_cache.get('user_2') == 2
+        sql_statements.clear()
+
+        self.get(f'/post/user/username/user_2?limit={page_size}')
+
+    @query_budget(lambda page_size: 6)
+    def test_get_posts_by_ids(self, page_size, sql_statements):
+        ids = ','.join(str(post_id) for post_id in range(1, page_size + 1))
+
+        self.get(f'/post/batch?ids={ids}')
+
+    @query_budget(lambda page_size: 4)
+    def test_get_comments(self, page_size, sql_statements):
+        self.get(f'/post/1/comment?limit={page_size}')
+
+    @query_budget(lambda page_size: 2)
+    def test_get_subcomments(self, page_size, sql_statements):
+        self.get(f'/post/comment/1/subcomment?limit={page_size}')
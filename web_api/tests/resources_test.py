@@ -1,5 +1,7 @@
+import datetime
 import io
 import json
+import time
 import flask_init
 import models
 import resources
@@ -69,11 +71,12 @@ class TestUser():
         auth_user_mock.verify_authorization.return_value = self.user
         
         file_upload_mock = mocker.patch.object(utils, "File")
-        file_upload_mock.upload.return_value = True
+        file_upload_mock.store.return_value = 'new_img1.jpg'
+
+        update_mock = mocker.patch.object(models.User, "update_returning")
+        update_mock.side_effect = lambda row_id, values, **kwargs: \
+            models.User(**{**self.user.snapshot(), **values})
 
-        db_session_mock = mocker.patch.object(flask_init.db, "session")
-        db_session_mock.commit.return_value = None
-        
         request_form_mock = {
             'id': 15,
             'email': 'new_test@email.com',
@@ -96,7 +99,10 @@ class TestUser():
 
         # THEN
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
-        file_upload_mock.upload.assert_called_once()
+        file_upload_mock.store.assert_called_once()
+        update_mock.assert_called_once_with(
+            row_id=1, values=mocker.ANY, edit_counter='version',
+            expected=None)
 
         assert actual_response.status_code == 200
 
@@ -166,7 +172,8 @@ class TestPost():
         auth_user_mock.verify_authorization.return_value = self.user
         
         data_mock = mocker.patch.object(models, "Post")
-        data_mock.query.join.return_value.all.return_value = [self.data]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
 
         # WHEN
         actual_response = self.app.get('/post/all')
@@ -174,7 +181,10 @@ class TestPost():
 
         # THEN
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
-        data_mock.query.join.return_value.all.assert_called_once_with()
+        data_mock.keyset_page.assert_called_once_with(
+            query=data_mock.feed_query.return_value.join.return_value,
+            limit=flask_init.app.config['POST_PAGE_DEFAULT_LIMIT'],
+            after=None)
 
         assert actual_response.status_code == 200
         assert actual_response_dict['message'] == 'Success'
@@ -183,6 +193,324 @@ class TestPost():
         assert 'user' in actual_response_dict['data'][0]
         assert 'comments' in actual_response_dict['data'][0]
 
+    def test_get_all_next_page_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        cursor_key = (datetime.datetime(2020, 2, 11, 10, 0), 7)
+        next_key = (datetime.datetime(2020, 2, 10, 9, 0), 3)
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.keyset_page.return_value = ([self.data], next_key)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/all',
+            query_string={
+                'limit': 1,
+                'cursor': utils.Cursor.encode(cursor_key)
+            })
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        data_mock.keyset_page.assert_called_once_with(
+            query=mocker.ANY, limit=1, after=cursor_key)
+
+        assert actual_response.status_code == 200
+        assert len(actual_response_dict['post']) == 1
+        assert utils.Cursor.decode(actual_response_dict['next_cursor']) == \
+            next_key
+
+    def test_get_all_invalid_cursor(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/all', query_string={'cursor': 'not-a-cursor'})
+
+        # THEN
+        data_mock.keyset_page.assert_not_called()
+
+        assert actual_response.status_code == 400
+
+    def test_get_all_stream_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        self.data.created = datetime.datetime(2020, 2, 11, 10, 0)
+        next_post = models.Post(
+            id = 2,
+            user_id = 1,
+            resource = 'test_image_2.jpg',
+            created = datetime.datetime(2020, 2, 10, 10, 0)
+        )
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.keyset_query.return_value.yield_per.return_value = \
+            [self.data, next_post]
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/all', query_string={'limit': 1, 'stream': 'true'})
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        data_mock.keyset_query.assert_called_once_with(
+            query=mocker.ANY, limit=1, after=None)
+        data_mock.keyset_page.assert_not_called()
+        data_mock.embedded_comment_pages.assert_called_once_with([self.data])
+
+        assert actual_response.status_code == 200
+        assert actual_response.mimetype == 'application/json'
+        assert actual_response_dict['message'] == 'Success'
+        assert len(actual_response_dict['post']) == 1
+        assert 'user' in actual_response_dict['post'][0]
+        assert 'comments' in actual_response_dict['post'][0]
+        assert utils.Cursor.decode(actual_response_dict['next_cursor']) == \
+            (self.data.created, self.data.id)
+
+    def test_get_all_feed_index_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        feed_index_mock = mocker.patch.object(utils, "feed_index")
+        feed_index_mock.page.return_value = [1]
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.page_versions.return_value = [(1, 1, 1)]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        # WHEN
+        actual_response = self.app.get('/post/all')
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        feed_index_mock.page.assert_called_once_with(
+            limit=flask_init.app.config['POST_PAGE_DEFAULT_LIMIT'],
+            after=None)
+        data_mock.id.in_.assert_called_once_with([1])
+        data_mock.keyset_page.assert_called_once_with(
+            query=data_mock.feed_query.return_value.filter.return_value,
+            limit=flask_init.app.config['POST_PAGE_DEFAULT_LIMIT'],
+            after=None)
+
+        assert actual_response.status_code == 200
+        assert len(actual_response_dict['post']) == 1
+
+    def test_get_all_feed_index_stale(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        feed_index_mock = mocker.patch.object(utils, "feed_index")
+        feed_index_mock.page.return_value = [3, 1]
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.page_versions.side_effect = [
+            [(1, 1, 1)], [(2, 1, 1), (1, 1, 1)]]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        # WHEN
+        actual_response = self.app.get('/post/all', query_string={'limit': 1})
+
+        # THEN
+        feed_index_mock.remove.assert_called_once_with(3)
+        data_mock.keyset_page.assert_called_once_with(
+            query=data_mock.feed_query.return_value.join.return_value,
+            limit=1, after=None)
+
+        assert actual_response.status_code == 200
+
+    def test_get_all_not_modified(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.page_versions.return_value = [(1, 1, 1)]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        first_response = self.app.get('/post/all')
+        etag = first_response.headers['ETag']
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/all', headers={'If-None-Match': etag})
+
+        # THEN
+        data_mock.keyset_page.assert_called_once()
+
+        assert first_response.status_code == 200
+        assert actual_response.status_code == 304
+        assert actual_response.data == b''
+        assert actual_response.headers['ETag'] == etag
+
+    def test_get_all_modified(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.page_versions.return_value = [(1, 1, 1)]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        etag = self.app.get('/post/all').headers['ETag']
+        data_mock.page_versions.return_value = [(1, 2, 1)]
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/all', headers={'If-None-Match': etag})
+
+        # THEN
+        assert data_mock.keyset_page.call_count == 2
+
+        assert actual_response.status_code == 200
+        assert actual_response.headers['ETag'] != etag
+
+    def test_get_by_ids_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        other_post = models.Post(
+            id = 2, user_id = 1, resource = 'test_image_2.jpg')
+        other_post.user = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.by_ids.return_value = {1: self.data, 2: other_post}
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/batch', query_string={'ids': '2,3,1,2'})
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
+        data_mock.by_ids.assert_called_once_with([2, 3, 1])
+        data_mock.embedded_comment_pages.assert_called_once_with(
+            [other_post, self.data])
+
+        assert actual_response.status_code == 200
+        assert [post and post['id'] for post in actual_response_dict['post']] \
+            == [2, None, 1]
+        assert actual_response_dict['missing'] == [3]
+
+    def test_get_by_ids_invalid(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        too_many_ids = ','.join(
+            str(post_id) for post_id in
+            range(flask_init.app.config['POST_MULTI_GET_MAX_IDS'] + 1))
+
+        # WHEN
+        responses = [
+            self.app.get('/post/batch'),
+            self.app.get('/post/batch', query_string={'ids': '1,a'}),
+            self.app.get('/post/batch', query_string={'ids': too_many_ids})
+        ]
+
+        # THEN
+        data_mock.by_ids.assert_not_called()
+
+        assert [response.status_code for response in responses] == \
+            [400, 400, 400]
+
+    def test_search_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        other_post = models.Post(
+            id = 2, user_id = 1, resource = 'test_image_2.jpg')
+        other_post.user = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.search_page.return_value = ([2, 3, 1], (0.25, 1))
+        data_mock.by_ids.return_value = {1: self.data, 2: other_post}
+        data_mock.embedded_comment_pages.return_value = ({}, {})
+
+        cursor = utils.RankCursor.encode((0.5, 7))
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/search',
+            query_string={'q': ' cute cats ', 'limit': 3, 'cursor': cursor})
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        data_mock.search_page.assert_called_once_with(
+            terms='cute cats', limit=3, after=(0.5, 7))
+        data_mock.by_ids.assert_called_once_with([2, 3, 1])
+
+        assert actual_response.status_code == 200
+        assert [post['id'] for post in actual_response_dict['post']] == [2, 1]
+        assert utils.RankCursor.decode(
+            actual_response_dict['next_cursor']) == (0.25, 1)
+
+    def test_search_invalid(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        too_long = 'a' * (
+            flask_init.app.config['SEARCH_QUERY_MAX_LENGTH'] + 1)
+        created_cursor = utils.Cursor.encode((datetime.datetime.now(), 1))
+
+        # WHEN
+        responses = [
+            self.app.get('/post/search'),
+            self.app.get('/post/search', query_string={'q': '  '}),
+            self.app.get('/post/search', query_string={'q': too_long}),
+            self.app.get(
+                '/post/search',
+                query_string={'q': 'cats', 'cursor': created_cursor})
+        ]
+
+        # THEN
+        data_mock.search_page.assert_not_called()
+        assert [response.status_code for response in responses] == \
+            [400, 400, 400, 400]
+
+    def test_get_single_data_by_id_not_modified(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.version_key.return_value = (3, 1)
+        data_mock.query.filter_by.return_value.first.return_value = self.data
+
+        etag = self.app.get('/post/1').headers['ETag']
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/1', headers={'If-None-Match': etag})
+
+        # THEN
+        data_mock.version_key.assert_called_with(1)
+        data_mock.query.filter_by.return_value.first.assert_called_once_with()
+
+        assert actual_response.status_code == 304
+        assert actual_response.data == b''
+
     def test_get_single_data_by_id_OK(self, mocker):
         # GIVEN
         auth_user_mock = mocker.patch.object(utils, "Auth")
@@ -210,7 +538,8 @@ class TestPost():
         auth_user_mock.verify_authorization.return_value = self.user
         
         data_mock = mocker.patch.object(models, "Post")
-        data_mock.query.filter_by.return_value.all.return_value = [self.data]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
 
         # WHEN
         actual_response = self.app.get('/post/user/1')
@@ -218,7 +547,10 @@ class TestPost():
 
         # THEN
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
-        data_mock.query.filter_by.return_value.all.assert_called_once_with()
+        data_mock.keyset_page.assert_called_once_with(
+            query=data_mock.feed_query.return_value.filter_by.return_value,
+            limit=flask_init.app.config['POST_PAGE_DEFAULT_LIMIT'],
+            after=None)
 
         assert actual_response.status_code == 200
         assert actual_response_dict['message'] == 'Success'
@@ -233,10 +565,11 @@ class TestPost():
         auth_user_mock.verify_authorization.return_value = self.user
         
         user_mock = mocker.patch.object(models, "User")
-        user_mock.query.filter_by.return_value.first.return_value = self.user
-        
+
         data_mock = mocker.patch.object(models, "Post")
-        data_mock.query.filter_by.return_value.all.return_value = [self.data]
+        data_mock.page_versions.return_value = [(1, 1, 1)]
+        data_mock.keyset_page.return_value = ([self.data], None)
+        data_mock.embedded_comment_pages.return_value = ({}, {})
 
         # WHEN
         actual_response = self.app.get('/post/user/username/test_username')
@@ -244,8 +577,12 @@ class TestPost():
 
         # THEN
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
-        user_mock.query.filter_by.return_value.first.assert_called_once_with()
-        data_mock.query.filter_by.return_value.all.assert_called_once_with()
+        user_mock.id_by_username.assert_not_called()
+        data_mock.user_feed_query.assert_called_once_with('test_username')
+        data_mock.keyset_page.assert_called_once_with(
+            query=data_mock.user_feed_query.return_value,
+            limit=flask_init.app.config['POST_PAGE_DEFAULT_LIMIT'],
+            after=None)
 
         assert actual_response.status_code == 200
         assert actual_response_dict['message'] == 'Success'
@@ -254,13 +591,57 @@ class TestPost():
         assert 'post' in actual_response_dict['post'][0]
         assert 'comments' in actual_response_dict['post'][0]
 
+    def test_get_data_by_unknown_username(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        user_mock = mocker.patch.object(models, "User")
+        user_mock.id_by_username.return_value = None
+
+        data_mock = mocker.patch.object(models, "Post")
+        data_mock.page_versions.return_value = []
+
+        # WHEN
+        actual_response = self.app.get('/post/user/username/unknown')
+
+        # THEN
+        user_mock.id_by_username.assert_called_once_with('unknown')
+        data_mock.keyset_page.assert_not_called()
+        assert actual_response.status_code == 400
+
+    def test_post_upload_failed(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        store_mock = mocker.patch.object(utils.File, "store")
+        store_mock.side_effect = utils.MediaUploadFailed()
+
+        db_session_mock = mocker.patch.object(flask_init.db, "session")
+
+        # WHEN
+        actual_response = self.app.post(
+            '/post',
+            data={
+                'description': 'New test image',
+                'file': (io.BytesIO(b"abcdef"), 'new_test_image.jpg')
+            },
+            content_type='multipart/form-data')
+
+        # THEN
+        store_mock.assert_called_once()
+        db_session_mock.add.assert_not_called()
+
+        assert actual_response.status_code == 502
+
     def test_post_OK(self, mocker):
         # GIVEN
         auth_user_mock = mocker.patch.object(utils, "Auth")
         auth_user_mock.verify_authorization.return_value = self.user
 
         file_upload_mock = mocker.patch.object(utils, "File")
-        file_upload_mock.upload.return_value = True
+        file_upload_mock.store.return_value = 'new_test_image.jpg'
 
         db_session_mock = mocker.patch.object(flask_init.db, "session")
         db_session_mock.add.return_value = None
@@ -284,7 +665,7 @@ class TestPost():
 
         # THEN
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
-        file_upload_mock.upload.assert_called_once()
+        file_upload_mock.store.assert_called_once()
 
         assert actual_response.status_code == 201
         assert 'message' in actual_response_dict
@@ -296,26 +677,72 @@ class TestPost():
             flask_init.app.config['MEDIA_BASE_URL'].format(
                 file_name=request_form_mock['resource'])
 
-    def test_patch_OK(self, mocker):
+    def test_post_async_upload_OK(self, mocker):
         # GIVEN
         auth_user_mock = mocker.patch.object(utils, "Auth")
         auth_user_mock.verify_authorization.return_value = self.user
 
         file_upload_mock = mocker.patch.object(utils, "File")
-        file_upload_mock.upload.return_value = True
+        file_upload_mock.is_allowed.return_value = True
 
-        data_mock = mocker.patch.object(models, "Post")
-        data_mock.query.filter_by.return_value.first.return_value = self.data
+        upload_queue_mock = mocker.patch.object(utils, "upload_queue")
+        upload_queue_mock.spool.return_value = utils.SpooledUpload(
+            path='/tmp/spooled_file', filename='0123abcd.jpg',
+            content_type='image/jpeg')
 
         db_session_mock = mocker.patch.object(flask_init.db, "session")
+        db_session_mock.add.return_value = None
         db_session_mock.commit.return_value = None
 
+        mocker.patch.dict(flask_init.app.config, {'MEDIA_UPLOAD_ASYNC': True})
+
+        request_form_mock = {
+            'description': 'New test image',
+            'file': (io.BytesIO(b"abcdef"), 'new_test_image.jpg')
+        }
+
+        # WHEN
+        actual_response = self.app.post(
+            '/post',
+            data=request_form_mock,
+            content_type='multipart/form-data')
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        file_upload_mock.store.assert_not_called()
+        upload_queue_mock.spool.assert_called_once_with(mocker.ANY)
+        upload_queue_mock.submit.assert_called_once_with(
+            spooled_upload=upload_queue_mock.spool.return_value,
+            on_done=mocker.ANY)
+
+        assert actual_response.status_code == 202
+        assert actual_response_dict['post']['media_state'] == \
+            models.Post.MEDIA_STATE_PENDING
+        assert actual_response_dict['post']['resource'] == \
+            flask_init.app.config['MEDIA_BASE_URL'].format(
+                file_name='0123abcd.jpg')
+
+    def test_patch_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        file_upload_mock = mocker.patch.object(utils, "File")
+        file_upload_mock.store.return_value = 'new_test_image.jpg'
+        mocker.patch.object(
+            models, "stored_media_variants", return_value='thumbnail')
+
+        update_mock = mocker.patch.object(models.Post, "update_returning")
+        update_mock.side_effect = lambda row_id, values, **kwargs: \
+            models.Post(**{**self.data.as_dict(), **values})
+
         request_form_mock = {
             'id': 1,
             'user_id': 6,
             'resource': 'new_test_image.jpg',
             'description': 'New test image',
             'created': '2020-02-15',
+            'revision': 3,
             'file': (io.BytesIO(b"abcdef"), 'new_test_image.jpg')
         }
 
@@ -328,7 +755,16 @@ class TestPost():
 
         # THEN
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
-        file_upload_mock.upload.assert_called_once()
+        file_upload_mock.store.assert_called_once()
+        update_mock.assert_called_once_with(
+            row_id=1,
+            values={
+                'description': request_form_mock['description'],
+                'resource': 'new_test_image.jpg',
+                'resource_variant_names': 'thumbnail',
+                'media_state': models.Post.MEDIA_STATE_READY
+            },
+            edit_counter='revision', expected=3)
 
         assert actual_response.status_code == 200
         assert 'message' in actual_response_dict
@@ -342,6 +778,44 @@ class TestPost():
             flask_init.app.config['MEDIA_BASE_URL'].format(
                 file_name=request_form_mock['resource'])
 
+    def test_patch_conflict(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        update_mock = mocker.patch.object(models.Post, "update_returning")
+        update_mock.return_value = None
+
+        query_mock = mocker.patch.object(models.Post, "query")
+        query_mock.filter_by.return_value.count.return_value = 1
+
+        # WHEN
+        actual_response = self.app.patch(
+            '/post/1',
+            data={'description': 'New test image', 'revision': 3},
+            content_type='multipart/form-data')
+
+        # THEN
+        query_mock.filter_by.assert_called_once_with(id=1)
+        assert actual_response.status_code == 409
+
+    def test_patch_invalid_revision(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        update_mock = mocker.patch.object(models.Post, "update_returning")
+
+        # WHEN
+        actual_response = self.app.patch(
+            '/post/1',
+            data={'description': 'New test image', 'revision': 'latest'},
+            content_type='multipart/form-data')
+
+        # THEN
+        update_mock.assert_not_called()
+        assert actual_response.status_code == 400
+
     def test_delete_OK(self, mocker):
         # GIVEN
         auth_user_mock = mocker.patch.object(utils, "Auth")
@@ -427,6 +901,74 @@ class TestComment():
         assert actual_response_dict['comment']['created'] == None
         assert actual_response_dict['comment']['text'] == request_form_mock['text']
 
+    def test_get_page_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        self.comment.id = 1
+        self.subcomment.id = 1
+        next_key = (datetime.datetime(2020, 1, 1, 10, 0), 1)
+
+        comment_mock = mocker.patch.object(models, "Comment")
+        comment_mock.keyset_page.return_value = ([self.comment], next_key)
+        comment_mock.embedded_subcomment_pages.return_value = {
+            1: ([self.subcomment], None)}
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/1/comment', query_string={'limit': 1})
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
+        comment_mock.page_query.return_value.filter_by.assert_called_once_with(
+            post_id=1)
+        comment_mock.keyset_page.assert_called_once_with(
+            query=comment_mock.page_query.return_value.filter_by.return_value,
+            limit=1, after=None)
+
+        assert actual_response.status_code == 200
+        assert actual_response_dict['message'] == 'Success'
+        assert len(actual_response_dict['comment']) == 1
+        assert len(actual_response_dict['comment'][0]['subcomments']) == 1
+        assert actual_response_dict['comment'][0]['edit_allowed'] is True
+        assert utils.Cursor.decode(actual_response_dict['next_cursor']) == \
+            next_key
+
+    def test_get_page_invalid_cursor(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        comment_mock = mocker.patch.object(models, "Comment")
+
+        # WHEN
+        actual_response = self.app.get(
+            '/post/1/comment', query_string={'cursor': 'not-a-cursor'})
+
+        # THEN
+        comment_mock.keyset_page.assert_not_called()
+
+        assert actual_response.status_code == 400
+
+    def test_get_page_missing_post(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        comment_mock = mocker.patch.object(models, "Comment")
+        comment_mock.keyset_page.return_value = ([], None)
+        row_exists_mock = mocker.patch.object(models.Post, "row_exists")
+        row_exists_mock.return_value = False
+
+        # WHEN
+        actual_response = self.app.get('/post/1/comment')
+
+        # THEN
+        row_exists_mock.assert_called_once_with(1)
+        assert actual_response.status_code == 400
+
     def test_delete_OK(self, mocker):
         # GIVEN
         auth_user_mock = mocker.patch.object(utils, "Auth")
@@ -512,6 +1054,51 @@ class TestSubComment():
         assert actual_response_dict['subcomment']['created'] == None
         assert actual_response_dict['subcomment']['text'] == request_form_mock['text']
 
+    def test_get_page_OK(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        subcomment_mock = mocker.patch.object(models, "SubComment")
+        subcomment_mock.keyset_page.return_value = ([self.subcomment], None)
+
+        # WHEN
+        actual_response = self.app.get('/post/comment/1/subcomment')
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
+        subcomment_mock.page_query.return_value.filter_by \
+            .assert_called_once_with(comment_id=1)
+        subcomment_mock.keyset_page.assert_called_once_with(
+            query=mocker.ANY,
+            limit=flask_init.app.config['COMMENT_PAGE_DEFAULT_LIMIT'],
+            after=None)
+
+        assert actual_response.status_code == 200
+        assert actual_response_dict['message'] == 'Success'
+        assert len(actual_response_dict['subcomment']) == 1
+        assert actual_response_dict['subcomment'][0]['username'] == \
+            'test_username'
+        assert actual_response_dict['next_cursor'] is None
+
+    def test_get_page_missing_comment(self, mocker):
+        # GIVEN
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = self.user
+
+        subcomment_mock = mocker.patch.object(models, "SubComment")
+        subcomment_mock.keyset_page.return_value = ([], None)
+        row_exists_mock = mocker.patch.object(models.Comment, "row_exists")
+        row_exists_mock.return_value = False
+
+        # WHEN
+        actual_response = self.app.get('/post/comment/1/subcomment')
+
+        # THEN
+        row_exists_mock.assert_called_once_with(1)
+        assert actual_response.status_code == 400
+
     def test_delete_OK(self, mocker):
         # GIVEN
         auth_user_mock = mocker.patch.object(utils, "Auth")
@@ -532,4 +1119,81 @@ class TestSubComment():
         auth_user_mock.verify_authorization.assert_called_once_with(request=mocker.ANY)
 
         assert actual_response.status_code == 200
-        assert 'message' in actual_response_dict
\ No newline at end of file
+        assert 'message' in actual_response_dict
+
+class TestCachedToken():
+    def setup(self):
+        self.app = flask_init.app.test_client()
+        utils.Auth.token_cache.clear()
+
+    def teardown(self):
+        utils.Auth.token_cache.clear()
+
+    def test_post_deleted_user(self, mocker, sqlite_db):
+        # GIVEN
+        sqlite_db.session.execute(
+            models.User.__table__.insert(),
+            [{'id': 1, 'username': 'test_username'}])
+        sqlite_db.session.commit()
+
+        verify_mock = mocker.patch.object(models.User, "verify_auth_token")
+        verify_mock.return_value = (
+            {'user_id': 1}, {'exp': time.time() + 30})
+        headers = {'Authorization': 'token'}
+        assert self.app.get('/user', headers=headers).status_code == 200
+
+        # Deleted through another process, this one still caches the token
+        sqlite_db.session.execute(models.User.__table__.delete())
+        sqlite_db.session.commit()
+
+        # WHEN
+        actual_response = self.app.post(
+            '/post', headers=headers,
+            data={'file': (io.BytesIO(b'abcdef'), 'test_image.jpg')})
+
+        # THEN
+        verify_mock.assert_called_once_with('token', return_header=True)
+        assert actual_response.status_code == 400
+        assert utils.Auth.token_cache.get('token') is None
+
+
+class TestFeedIndexFailure():
+    def setup(self):
+        self.app = flask_init.app.test_client()
+
+    def test_get_all_after_failed_add(self, mocker, sqlite_db):
+        # GIVEN
+        sqlite_db.session.execute(
+            models.User.__table__.insert(),
+            [{'id': 1, 'username': 'test_username'}])
+        sqlite_db.session.execute(models.Post.__table__.insert(), [
+            {'id': 1, 'user_id': 1, 'resource': 'old.jpg',
+             'created': datetime.datetime(2020, 1, 1, 10, 0)},
+            {'id': 2, 'user_id': 1, 'resource': 'new.jpg',
+             'created': datetime.datetime(2020, 1, 2, 10, 0)}])
+        sqlite_db.session.commit()
+
+        auth_user_mock = mocker.patch.object(utils, "Auth")
+        auth_user_mock.verify_authorization.return_value = \
+            models.User.query.get(1)
+
+        feed_index = utils.FeedIndex(
+            enabled=True, host='localhost', port=6379, db_index=1,
+            key='feed:posts', timeout=0.5)
+        mocker.patch.object(utils, "feed_index", feed_index)
+        client_mock = mocker.patch.object(utils.redis, "Redis").return_value
+        # Built before post 2 was saved
+        client_mock.pipeline.return_value.execute.return_value = [
+            b'1.0', [b'000000000001']]
+        client_mock.register_script.return_value.side_effect = \
+            utils.redis.ConnectionError()
+
+        # WHEN
+        feed_index.add(models.Post.query.get(2))
+        actual_response = self.app.get('/post/all')
+        actual_response_dict = json.loads(actual_response.data.decode("utf-8"))
+
+        # THEN
+        client_mock.delete.assert_called_once_with('feed:posts:built')
+        assert actual_response.status_code == 200
+        assert [post['id'] for post in actual_response_dict['post']] == [2, 1]
@@ -0,0 +1,81 @@
+import collections
+import models
+import seeder
+
+
+def _seed(seed: int = 0) -> seeder.Seeder:
+    data_seeder = seeder.Seeder(seed=seed, chunk_size=500)
+    user_ids = data_seeder.seed_users(100)
+    data_seeder.seed_posts(
+        user_ids, posts=1000, comments_per_post=4,
+        subcomments_per_comment=1)
+    data_seeder.finish()
+    return data_seeder
+
+
+def _rows(model) -> list:
+    return model.query.with_entities(*model.__table__.columns) \
+        .order_by(model.id).all()
+
+
+class TestSeeder():
+    def test_seed_keeps_counters_consistent(self, sqlite_db):
+        # WHEN
+        data_seeder = _seed()
+
+        # THEN
+        report = data_seeder.report
+        assert report['USER'][0] == 100
+        assert report['POST'][0] == 1000
+        assert report['COMMENT'][0] == models.Comment.query.count() > 1000
+        assert report['SUBCOMMENT'][0] == models.SubComment.query.count()
+
+        assert models.Comment.reconcile_counters() == 0
+        assert models.Post.reconcile_counters() == 0
+
+    def test_seed_is_skewed(self, sqlite_db):
+        # WHEN
+        _seed()
+
+        # THEN
+        posts_by_user = collections.Counter(
+            user_id for user_id, in models.Post.query.with_entities(
+                models.Post.user_id))
+        assert posts_by_user.most_common(1)[0][1] > 5 * 1000 / 100
+
+        comment_counts = sorted(
+            comment_count for comment_count, in
+            models.Post.query.with_entities(models.Post.comment_count))
+        assert comment_counts[-1] > 10 * comment_counts[500]
+
+    def test_seed_is_deterministic(self, sqlite_db):
+        # GIVEN
+        db = sqlite_db
+        _seed(seed=42)
+        expected = [
+            _rows(model) for model in (
+                models.Post, models.Comment, models.SubComment)]
+        db.drop_all()
+        db.create_all()
+
+        # WHEN
+        _seed(seed=42)
+
+        # THEN
+        assert [
+            _rows(model) for model in (
+                models.Post, models.Comment, models.SubComment)] == expected
+
+    def test_seed_continues_after_existing_rows(self, sqlite_db):
+        # GIVEN
+        _seed()
+        users = models.User.query.count()
+        posts = models.Post.query.count()
+
+        # WHEN
+        _seed(seed=1)
+
+        # THEN
+        assert models.User.query.count() == 2 * users
+        assert models.Post.query.count() == 2 * posts
+        assert models.Post.reconcile_counters() == 0
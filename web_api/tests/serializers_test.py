@@ -0,0 +1,166 @@
+import datetime
+import flask_init
+import models
+import serializers
+import utils
+
+
+class TestColumnSerializer():
+    def test_output(self):
+        # GIVEN
+        post = models.Post(
+            id = 1,
+            user_id = 1,
+            resource = 'test_image.jpg',
+            description = 'Test image',
+            created = datetime.datetime(
+                2020, 2, 11, 10, 30, tzinfo=datetime.timezone.utc),
+            media_state = 'ready',
+            comment_count = 2,
+            subcomment_count = 3,
+            version = 4,
+            revision = 2
+        )
+
+        # WHEN
+        actual = serializers.ColumnSerializer.for_model(models.Post)(post)
+
+        # THEN
+        assert actual == {
+            'id': 1,
+            'user_id': 1,
+            'resource': 'test_image.jpg',
+            'description': 'Test image',
+            'created': '2020-02-11T10:30:00+00:00',
+            'media_state': 'ready',
+            'comment_count': 2,
+            'subcomment_count': 3,
+            'version': 4,
+            'revision': 2,
+            'resource_variant_names': None
+        }
+
+    def test_compiled_once_per_model(self):
+        assert serializers.ColumnSerializer.for_model(models.Post) is \
+            serializers.ColumnSerializer.for_model(models.Post)
+        assert serializers.ColumnSerializer.for_model(models.Post) is not \
+            serializers.ColumnSerializer.for_model(models.Comment)
+
+    def test_exclude(self):
+        # GIVEN
+        user = models.User(id = 1, username = 'test_username')
+
+        # WHEN
+        actual = serializers.ColumnSerializer.for_model(
+            models.User, exclude=models.User._IGNORE_ATTRS_ON_OUTPUT)(user)
+
+        # THEN
+        assert 'id' not in actual
+        assert 'password_hash' not in actual
+        assert actual['username'] == 'test_username'
+
+
+class TestMediaVariantUrls():
+    def test_stored_variants(self):
+        # WHEN
+        actual = serializers.media_variant_urls(
+            '0123abcd.jpg', 'thumbnail')
+
+        # THEN
+        base_url = flask_init.app.config['MEDIA_BASE_URL']
+        assert actual == {
+            'thumbnail': base_url.format(file_name='0123abcd_thumbnail.jpg'),
+            'small': base_url.format(file_name='0123abcd.jpg'),
+            'medium': base_url.format(file_name='0123abcd.jpg')
+        }
+
+    def test_nothing_stored(self):
+        # WHEN
+        actual = serializers.media_variant_urls('0123abcd.jpg', None)
+
+        # THEN
+        assert set(actual.values()) == {
+            flask_init.app.config['MEDIA_BASE_URL'].format(
+                file_name='0123abcd.jpg')}
+        assert serializers.media_variant_urls('0123abcd.pdf', None) == {}
+
+
+class TestFeedSerializer():
+    def setup(self):
+        created = datetime.datetime(2020, 2, 11, 10, 30)
+
+        self.user = models.User(
+            id = 1,
+            email = 'test@email.com',
+            username = 'test_username',
+            birthday = datetime.date(1991, 5, 5),
+            profile_image = 'img1.jpg',
+            created = created)
+        self.other_user = models.User(
+            id = 2, username = 'other_username', profile_image = 'img2.jpg')
+
+        self.subcomment = models.SubComment(
+            id = 1, comment_id = 1, user_id = 1, text = 'Test text',
+            created = created)
+        self.subcomment.user = self.user
+
+        self.comment = models.Comment(
+            id = 1, post_id = 1, user_id = 2, text = 'Test text',
+            created = created)
+        self.comment.user = self.other_user
+        self.comment.subcomments = [self.subcomment]
+
+        self.post = models.Post(
+            id = 1, user_id = 1, resource = 'test_image.jpg',
+            description = 'Test image', created = created,
+            resource_variant_names = 'thumbnail')
+        self.post.user = self.user
+        self.post.comments = [self.comment]
+
+    def test_post_matches_output_methods(self):
+        # GIVEN
+        expected = self.post.output_with_permissions_and_users(self.user)
+        expected['comments_next_cursor'] = None
+        expected['comments'][0]['subcomments_next_cursor'] = None
+        serializer = serializers.FeedSerializer(self.user)
+        serializer.add_pages(
+            comment_pages={1: ([self.comment], None)},
+            subcomment_pages={1: ([self.subcomment], None)})
+
+        # WHEN
+        actual = serializer.post(self.post)
+
+        # THEN
+        assert actual == expected
+        assert actual['edit_allowed'] is True
+        assert actual['comments'][0]['edit_allowed'] is False
+        assert actual['comments'][0]['subcomments'][0]['edit_allowed'] is True
+
+    def test_post_embedded_page_cursor(self):
+        # GIVEN
+        next_key = (self.comment.created, self.comment.id)
+        serializer = serializers.FeedSerializer(self.user)
+        serializer.add_pages(comment_pages={1: ([self.comment], next_key)})
+
+        # WHEN
+        actual = serializer.post(self.post)
+
+        # THEN
+        assert len(actual['comments']) == 1
+        assert actual['comments_next_cursor'] == utils.Cursor.encode(next_key)
+        assert actual['comments'][0]['subcomments'] == []
+        assert actual['comments'][0]['subcomments_next_cursor'] is None
+
+    def test_user_memoized(self):
+        # GIVEN
+        serializer = serializers.FeedSerializer(self.user)
+
+        # WHEN
+        first = serializer.user(self.user)
+        second = serializer.user(self.user)
+
+        # THEN
+        assert first is second
+        assert first['profile_image'] == \
+            flask_init.app.config['MEDIA_BASE_URL'].format(
+                file_name='img1.jpg')
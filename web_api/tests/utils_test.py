@@ -1,7 +1,20 @@
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import json
+import os
 import flask
+import PIL.Image
+import pytest
+import requests
+import werkzeug
+import flask_init
+import media
 import utils
 import models
 import sqlalchemy
+import time
 
 
 class TestAuth():
@@ -31,4 +44,773 @@ class TestAuth():
         
         assert actual == expected
 
-        
\ No newline at end of file
+        
+
+
+class TestFile():
+    def setup(self):
+        self.content = b'abcdef' * 50000
+        self.file = werkzeug.datastructures.FileStorage(
+            stream=io.BytesIO(self.content), filename='test_image.jpg',
+            content_type='image/jpeg')
+
+    def test_upload_streams_multipart_body(self, mocker):
+        # GIVEN
+        post_mock = mocker.patch.object(utils.File._session, "post")
+
+        # WHEN
+        utils.File.upload(file=self.file, filename='test_image.jpg')
+
+        # THEN
+        post_mock.assert_called_once_with(
+            flask_init.app.config['MEDIA_UPLOAD_URL'],
+            data=mocker.ANY, headers=mocker.ANY,
+            timeout=flask_init.app.config['MEDIA_UPLOAD_TIMEOUT'])
+
+        _, kwargs = post_mock.call_args
+        chunks = list(kwargs['data'])
+        assert len(chunks) > 3  # header, several file chunks, closing
+
+        _, _, files = werkzeug.formparser.parse_form_data({
+            'wsgi.input': io.BytesIO(b''.join(chunks)),
+            'CONTENT_LENGTH': str(len(b''.join(chunks))),
+            'CONTENT_TYPE': kwargs['headers']['Content-Type'],
+            'REQUEST_METHOD': 'POST'
+        })
+        assert files['file'].filename == 'test_image.jpg'
+        assert files['file'].read() == self.content
+
+    def test_hash(self):
+        # WHEN
+        actual = utils.File.hash(self.file)
+
+        # THEN
+        assert actual == hashlib.sha256(self.content).hexdigest() + '.jpg'
+        assert self.file.stream.tell() == 0
+
+    def test_store_skips_existing(self, mocker):
+        # GIVEN
+        exists_mock = mocker.patch.object(utils.File, "exists")
+        exists_mock.return_value = True
+        upload_mock = mocker.patch.object(utils.File, "upload")
+
+        # WHEN
+        actual = utils.File.store(self.file)
+
+        # THEN
+        exists_mock.assert_called_once_with(actual)
+        upload_mock.assert_not_called()
+
+    def test_store_uploads_missing(self, mocker):
+        # GIVEN
+        exists_mock = mocker.patch.object(utils.File, "exists")
+        exists_mock.return_value = False
+        upload_mock = mocker.patch.object(utils.File, "upload")
+
+        # WHEN
+        actual = utils.File.store(self.file)
+
+        # THEN
+        upload_mock.assert_called_once_with(file=self.file, filename=actual)
+
+    def test_upload_error_status(self, mocker):
+        # GIVEN
+        post_mock = mocker.patch.object(utils.File._session, "post")
+        post_mock.return_value.raise_for_status.side_effect = \
+            requests.HTTPError('500 Server Error')
+
+        # WHEN
+        with pytest.raises(requests.HTTPError):
+            utils.File.upload(file=self.file, filename='test_image.jpg')
+
+    def test_store_upload_failed(self, mocker):
+        # GIVEN
+        mocker.patch.object(utils.File, "exists").return_value = False
+        upload_mock = mocker.patch.object(utils.File, "upload")
+        upload_mock.side_effect = requests.Timeout()
+        pipeline_mock = mocker.patch.object(utils, "derivative_pipeline")
+
+        # WHEN
+        with pytest.raises(utils.MediaUploadFailed) as failed:
+            utils.File.store(self.file)
+
+        # THEN
+        assert failed.value.code == 502
+        pipeline_mock.submit_file.assert_not_called()
+
+    def test_exists_unreachable_server(self, mocker):
+        # GIVEN
+        head_mock = mocker.patch.object(utils.File._session, "head")
+        head_mock.side_effect = requests.ConnectionError()
+
+        # THEN
+        assert not utils.File.exists('test_image.jpg')
+
+    def test_is_allowed(self):
+        assert utils.File.is_allowed(self.file)
+
+    def test_is_allowed_extension(self):
+        self.file.filename = 'test_script.sh'
+        assert not utils.File.is_allowed(self.file)
+
+    def test_is_allowed_size(self, mocker):
+        mocker.patch.dict(
+            flask_init.app.config,
+            {'MAX_CONTENT_LENGTH': len(self.content) - 1})
+        assert not utils.File.is_allowed(self.file)
+        assert self.file.stream.tell() == 0
+
+
+class TestUploadQueue():
+    def setup(self):
+        self.queue = utils.UploadQueue(
+            spool_folder='/tmp', workers=1, retries=1, backoff=1)
+
+    def test_spool(self, tmpdir):
+        # GIVEN
+        queue = utils.UploadQueue(
+            spool_folder=str(tmpdir), workers=1, retries=1, backoff=1)
+        file = werkzeug.datastructures.FileStorage(
+            stream=io.BytesIO(b'abcdef'), filename='test_image.jpg',
+            content_type='image/jpeg')
+
+        # WHEN
+        actual = queue.spool(file)
+
+        # THEN
+        assert actual.filename == \
+            hashlib.sha256(b'abcdef').hexdigest() + '.jpg'
+        assert actual.content_type == 'image/jpeg'
+        with open(actual.path, 'rb') as spooled_file:
+            assert spooled_file.read() == b'abcdef'
+        with open(actual.path + '.json') as manifest:
+            assert utils.SpooledUpload(**json.load(manifest)) == actual
+
+    def test_discard(self, tmpdir):
+        # GIVEN
+        queue = utils.UploadQueue(
+            spool_folder=str(tmpdir), workers=1, retries=1, backoff=1)
+        spooled_upload = queue.spool(werkzeug.datastructures.FileStorage(
+            stream=io.BytesIO(b'abcdef'), filename='test_image.jpg'))
+
+        # WHEN
+        queue.discard(spooled_upload)
+
+        # THEN
+        assert tmpdir.listdir() == []
+
+    def test_left_over(self, tmpdir):
+        # GIVEN
+        queue = utils.UploadQueue(
+            spool_folder=str(tmpdir), workers=1, retries=1, backoff=1)
+        spooled_upload = queue.spool(werkzeug.datastructures.FileStorage(
+            stream=io.BytesIO(b'abcdef'), filename='test_image.jpg'))
+        tmpdir.join('derivative').write_binary(b'abcdef')
+        tmpdir.join('gone.json').write(json.dumps({
+            'path': str(tmpdir.join('gone')), 'filename': 'gone.jpg',
+            'content_type': 'image/jpeg'}))
+        before = time.time() + 1
+        recent_upload = queue.spool(werkzeug.datastructures.FileStorage(
+            stream=io.BytesIO(b'ghijkl'), filename='test_image.jpg'))
+        for path in (recent_upload.path, recent_upload.path + '.json'):
+            os.utime(path, (before, before))
+
+        # WHEN
+        actual = queue.left_over(before)
+
+        # THEN
+        assert sorted(actual, key=lambda upload: upload.path) == [
+            spooled_upload,
+            utils.SpooledUpload(
+                path=str(tmpdir.join('gone')), filename='gone.jpg',
+                content_type='image/jpeg')]
+        assert not tmpdir.join('derivative').exists()
+        assert os.path.exists(spooled_upload.path)
+        assert os.path.exists(recent_upload.path)
+
+    def test_upload_OK(self, mocker, tmpdir):
+        # GIVEN
+        path = tmpdir.join('test_image.jpg')
+        path.write_binary(b'abcdef')
+        spooled_upload = utils.SpooledUpload(
+            path=str(path), filename='test_image.jpg',
+            content_type='image/jpeg')
+
+        mocker.patch.object(utils.File, "exists").return_value = False
+        file_upload_mock = mocker.patch.object(utils.File, "upload")
+        pipeline_mock = mocker.patch.object(utils, "derivative_pipeline")
+        on_done_mock = mocker.MagicMock()
+
+        # WHEN
+        self.queue._upload(spooled_upload, on_done_mock, 0)
+
+        # THEN
+        file_upload_mock.assert_called_once()
+        pipeline_mock.submit.assert_called_once_with(spooled_upload)
+        on_done_mock.assert_called_once_with(True)
+
+    def test_upload_derivative_OK(self, mocker, tmpdir):
+        # GIVEN
+        path = tmpdir.join('test_image_thumbnail.jpg')
+        path.write_binary(b'abcdef')
+        spooled_upload = utils.SpooledUpload(
+            path=str(path), filename='test_image_thumbnail.jpg',
+            content_type='image/jpeg')
+
+        mocker.patch.object(utils.File, "exists").return_value = False
+        mocker.patch.object(utils.File, "upload")
+        pipeline_mock = mocker.patch.object(utils, "derivative_pipeline")
+        on_done_mock = mocker.MagicMock()
+
+        # WHEN
+        self.queue._upload(spooled_upload, on_done_mock, 0, derive=False)
+
+        # THEN
+        pipeline_mock.submit.assert_not_called()
+        on_done_mock.assert_called_once_with(True)
+        assert not path.exists()
+
+    def test_upload_skips_existing(self, mocker, tmpdir):
+        # GIVEN
+        path = tmpdir.join('test_image.jpg')
+        path.write_binary(b'abcdef')
+        spooled_upload = utils.SpooledUpload(
+            path=str(path), filename='test_image.jpg',
+            content_type='image/jpeg')
+
+        mocker.patch.object(utils.File, "exists").return_value = True
+        file_upload_mock = mocker.patch.object(utils.File, "upload")
+        on_done_mock = mocker.MagicMock()
+
+        # WHEN
+        self.queue._upload(spooled_upload, on_done_mock, 0)
+
+        # THEN
+        file_upload_mock.assert_not_called()
+        on_done_mock.assert_called_once_with(True)
+        assert not path.exists()
+
+    def test_upload_retried_with_backoff(self, mocker, tmpdir):
+        # GIVEN
+        path = tmpdir.join('test_image.jpg')
+        path.write_binary(b'abcdef')
+        spooled_upload = utils.SpooledUpload(
+            path=str(path), filename='test_image.jpg',
+            content_type='image/jpeg')
+
+        mocker.patch.object(utils.File, "exists").return_value = False
+        file_upload_mock = mocker.patch.object(utils.File, "upload")
+        file_upload_mock.side_effect = requests.ConnectionError()
+        timer_mock = mocker.patch.object(utils.threading, "Timer")
+        on_done_mock = mocker.MagicMock()
+
+        # WHEN
+        self.queue._upload(spooled_upload, on_done_mock, 0)
+
+        # THEN
+        timer_mock.assert_called_once_with(
+            1, self.queue.submit,
+            args=(spooled_upload, on_done_mock, 1, True))
+        on_done_mock.assert_not_called()
+
+        # WHEN retries are exhausted
+        self.queue._upload(spooled_upload, on_done_mock, 1)
+
+        # THEN
+        on_done_mock.assert_called_once_with(False)
+        assert not path.exists()
+
+
+class TestDerivativePipeline():
+    def setup(self):
+        self.image = io.BytesIO()
+        PIL.Image.new('RGB', (2000, 1000)).save(self.image, format='JPEG')
+
+    def test_variant_names(self):
+        # WHEN
+        actual = utils.File.variant_names('0123abcd.jpg')
+
+        # THEN
+        assert actual == {
+            variant: f'0123abcd_{variant}.jpg'
+            for variant in flask_init.app.config['MEDIA_DERIVATIVES']
+        }
+        assert utils.File.variant_names('0123abcd.pdf') == {}
+        assert utils.File.variant_names(None) == {}
+
+    def test_render_derivatives(self, tmpdir):
+        # GIVEN
+        path = tmpdir.join('0123abcd.jpg')
+        path.write_binary(self.image.getvalue())
+        spooled_upload = utils.SpooledUpload(
+            path=str(path), filename='0123abcd.jpg',
+            content_type='image/jpeg')
+
+        # WHEN
+        actual = media.render_derivatives(
+            spooled_upload, {'thumbnail': 160, 'medium': 1080}, str(tmpdir))
+
+        # THEN
+        assert [derivative.filename for derivative in actual] == \
+            ['0123abcd_thumbnail.jpg', '0123abcd_medium.jpg']
+        with PIL.Image.open(actual[0].path) as thumbnail:
+            assert thumbnail.size == (160, 80)
+        with PIL.Image.open(actual[1].path) as medium:
+            assert medium.size == (1080, 540)
+
+    def test_queue_derivatives(self, mocker, tmpdir):
+        # GIVEN
+        path = tmpdir.join('0123abcd.jpg')
+        path.write_binary(self.image.getvalue())
+        spooled_upload = utils.SpooledUpload(
+            path=str(path), filename='0123abcd.jpg',
+            content_type='image/jpeg')
+        derivative = utils.SpooledUpload(
+            path=str(tmpdir.join('derivative')),
+            filename='0123abcd_thumbnail.jpg', content_type='image/jpeg')
+
+        future = concurrent.futures.Future()
+        future.set_result([derivative])
+
+        upload_queue_mock = mocker.patch.object(utils, "upload_queue")
+
+        # WHEN
+        utils.DerivativePipeline._queue_derivatives(
+            spooled_upload, ['thumbnail'], future)
+
+        # THEN
+        upload_queue_mock.submit.assert_called_once_with(
+            spooled_upload=derivative, on_done=mocker.ANY, derive=False)
+        assert not path.exists()
+
+    def test_stored_variants(self, mocker):
+        # GIVEN
+        record_mock = mocker.patch.object(models, "record_media_variants")
+        stored_variants = utils.StoredVariants(
+            filename='0123abcd.jpg', pending=3)
+
+        # WHEN
+        stored_variants.done('thumbnail', uploaded=True)
+        stored_variants.done('medium', uploaded=False)
+
+        # THEN
+        record_mock.assert_not_called()
+
+        # WHEN the last upload is done
+        stored_variants.done('large', uploaded=True)
+
+        # THEN
+        record_mock.assert_called_once_with(
+            '0123abcd.jpg', ['thumbnail', 'large'])
+
+
+class TestTokenCache():
+    def setup(self):
+        self.cache = utils.TokenCache(max_size=2, ttl=60)
+        self.expires_at = time.time() + 30
+
+    def test_get_set(self):
+        # GIVEN
+        self.cache.set(
+            'token', payload={'user_id': 1}, snapshot={'id': 1},
+            expires_at=self.expires_at)
+
+        # WHEN
+        actual = self.cache.get('token')
+
+        # THEN
+        assert actual == ({'user_id': 1}, {'id': 1})
+        assert self.cache.get('other_token') is None
+
+    def test_expired_token(self):
+        # GIVEN
+        self.cache.set(
+            'token', payload={'user_id': 1}, snapshot={'id': 1},
+            expires_at=time.time() - 1)
+
+        # WHEN
+        actual = self.cache.get('token')
+
+        # THEN
+        assert actual is None
+
+    def test_ttl_caps_expiration(self, mocker):
+        # GIVEN
+        now = time.time()
+        self.cache.set(
+            'token', payload={'user_id': 1}, snapshot={'id': 1},
+            expires_at=now + 3600)
+
+        time_mock = mocker.patch.object(utils.time, "time")
+        time_mock.return_value = now + 61
+
+        # WHEN
+        actual = self.cache.get('token')
+
+        # THEN
+        assert actual is None
+
+    def test_least_recently_used_evicted(self):
+        # GIVEN
+        for token in ('token_1', 'token_2'):
+            self.cache.set(
+                token, payload={'user_id': 1}, snapshot={'id': 1},
+                expires_at=self.expires_at)
+        self.cache.get('token_1')
+
+        # WHEN
+        self.cache.set(
+            'token_3', payload={'user_id': 1}, snapshot={'id': 1},
+            expires_at=self.expires_at)
+
+        # THEN
+        assert self.cache.get('token_1') is not None
+        assert self.cache.get('token_2') is None
+        assert self.cache.get('token_3') is not None
+
+    def test_evict_user(self):
+        # GIVEN
+        self.cache.set(
+            'token_1', payload={'user_id': 1}, snapshot={'id': 1},
+            expires_at=self.expires_at)
+        self.cache.set(
+            'token_2', payload={'user_id': 2}, snapshot={'id': 2},
+            expires_at=self.expires_at)
+
+        # WHEN
+        self.cache.evict_user(1)
+
+        # THEN
+        assert self.cache.get('token_1') is None
+        assert self.cache.get('token_2') is not None
+
+
+class TestUsernameCache():
+    def setup(self):
+        self.cache = utils.UsernameCache(max_size=2, ttl=60)
+
+    def test_get_set(self):
+        # GIVEN
+        self.cache.set('user_1', 1)
+
+        # WHEN
+        actual = self.cache.get('user_1')
+
+        # THEN
+        assert actual == 1
+        assert self.cache.get('user_2') is None
+
+    def test_expired(self, mocker):
+        # GIVEN
+        now = time.time()
+        self.cache.set('user_1', 1)
+
+        time_mock = mocker.patch.object(utils.time, "time")
+        time_mock.return_value = now + 61
+
+        # WHEN
+        actual = self.cache.get('user_1')
+
+        # THEN
+        assert actual is None
+
+    def test_least_recently_used_evicted(self):
+        # GIVEN
+        self.cache.set('user_1', 1)
+        self.cache.set('user_2', 2)
+        self.cache.get('user_1')
+
+        # WHEN
+        self.cache.set('user_3', 3)
+
+        # THEN
+        assert self.cache.get('user_1') == 1
+        assert self.cache.get('user_2') is None
+        assert self.cache.get('user_3') == 3
+
+    def test_invalidate(self):
+        # GIVEN
+        self.cache.set('user_1', 1)
+        self.cache.set('user_2', 2)
+
+        # WHEN
+        self.cache.invalidate('user_1')
+        self.cache.invalidate('missing')
+
+        # THEN
+        assert self.cache.get('user_1') is None
+        assert self.cache.get('user_2') == 2
+
+
+class TestAuthTokenCache():
+    def setup(self):
+        utils.Auth.token_cache.clear()
+
+    def teardown(self):
+        utils.Auth.token_cache.clear()
+
+    def test_verify_authorization_cached(self, mocker):
+        # GIVEN
+        user = models.User(id = 1, username = 'test_username')
+
+        request_mock = mocker.MagicMock()
+        request_mock.headers.get.return_value = 'token'
+
+        verify_mock = mocker.patch.object(models.User, "verify_auth_token")
+        verify_mock.return_value = (
+            {'user_id': 1}, {'exp': time.time() + 30})
+
+        query_mock = mocker.patch.object(models.User, "query")
+        query_mock.filter_by.return_value.first.return_value = user
+
+        from_snapshot_mock = mocker.patch.object(
+            models.User, "from_snapshot")
+        from_snapshot_mock.return_value = user
+
+        # WHEN
+        first = utils.Auth.verify_authorization(request_mock)
+        second = utils.Auth.verify_authorization(request_mock)
+
+        # THEN
+        verify_mock.assert_called_once_with('token', return_header=True)
+        query_mock.filter_by.return_value.first.assert_called_once_with()
+        from_snapshot_mock.assert_called_once_with(user.snapshot())
+
+        assert first is user
+        assert second is user
+
+    def test_verify_authorization_invalid_token_not_cached(self, mocker):
+        # GIVEN
+        request_mock = mocker.MagicMock()
+        request_mock.headers.get.return_value = 'token'
+
+        verify_mock = mocker.patch.object(models.User, "verify_auth_token")
+        verify_mock.return_value = None
+
+        # WHEN
+        first = utils.Auth.verify_authorization(request_mock)
+        second = utils.Auth.verify_authorization(request_mock)
+
+        # THEN
+        assert first is None
+        assert second is None
+        assert verify_mock.call_count == 2
+
+
+class TestCursor():
+    def test_encode_decode(self):
+        # GIVEN
+        key = (
+            datetime.datetime(
+                2020, 2, 11, 10, 30, 5, 123, tzinfo=datetime.timezone.utc),
+            42)
+
+        # WHEN
+        actual = utils.Cursor.decode(utils.Cursor.encode(key))
+
+        # THEN
+        assert actual == key
+
+    def test_decode_invalid(self):
+        assert utils.Cursor.decode('not-a-cursor') is None
+        assert utils.Cursor.decode('') is None
+
+
+class TestRankCursor():
+    def test_encode_decode(self):
+        # GIVEN
+        key = (0.0607927106320858, 42)
+
+        # WHEN
+        actual = utils.RankCursor.decode(utils.RankCursor.encode(key))
+
+        # THEN
+        assert actual == key
+
+    def test_decode_invalid(self):
+        assert utils.RankCursor.decode('not-a-cursor') is None
+        assert utils.RankCursor.decode(
+            utils.Cursor.encode((datetime.datetime.now(), 1))) is None
+
+
+class TestFeedIndex():
+    def setup(self):
+        self.feed_index = utils.FeedIndex(
+            enabled=True, host='localhost', port=6379, db_index=1,
+            key='feed:posts', timeout=0.5)
+        self.created = datetime.datetime(
+            2020, 2, 11, 10, 30, 0, 123456, tzinfo=datetime.timezone.utc)
+
+    def test_add(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        post = models.Post(id = 7, created = self.created)
+
+        # WHEN
+        self.feed_index.add(post)
+
+        # THEN
+        script_mock = redis_mock.return_value.register_script.return_value
+        script_mock.assert_called_once_with(
+            keys=[
+                'feed:posts', 'feed:posts:rebuilding', 'feed:posts:building'],
+            args=[1581417000123456, '000000000007'])
+
+    def test_remove(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+
+        # WHEN
+        self.feed_index.remove(7, 8)
+
+        # THEN
+        script_mock = redis_mock.return_value.register_script.return_value
+        script_mock.assert_called_once_with(
+            keys=[
+                'feed:posts', 'feed:posts:rebuilding', 'feed:posts:building',
+                'feed:posts:building:removed'],
+            args=['000000000007', '000000000008'])
+
+    def test_remove_query(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        query_mock = mocker.MagicMock()
+        query_mock.yield_per.return_value = [(7,), (8,), (9,)]
+
+        # WHEN
+        self.feed_index.remove_query(query_mock, batch_size=2)
+
+        # THEN
+        query_mock.yield_per.assert_called_once_with(2)
+        script_mock = redis_mock.return_value.register_script.return_value
+        assert [
+            call[1]['args'] for call in script_mock.call_args_list] == [
+                ['000000000007', '000000000008'], ['000000000009']]
+
+    def test_first_page(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        pipeline_mock = redis_mock.return_value.pipeline.return_value
+        pipeline_mock.execute.return_value = [
+            b'1.0', [b'000000000009', b'000000000008', b'000000000005']]
+
+        # WHEN
+        actual = self.feed_index.page(limit=2)
+
+        # THEN
+        pipeline_mock.zrevrange.assert_called_once_with('feed:posts', 0, 2)
+        assert actual == [9, 8, 5]
+
+    def test_next_page(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        pipeline_mock = redis_mock.return_value.pipeline.return_value
+        pipeline_mock.execute.return_value = [
+            b'1.0',
+            [b'000000000009', b'000000000008', b'000000000006'],
+            [b'000000000005', b'000000000004', b'000000000003']]
+
+        # WHEN
+        actual = self.feed_index.page(limit=2, after=(self.created, 8))
+
+        # THEN
+        pipeline_mock.zrevrangebyscore.assert_any_call(
+            'feed:posts', 1581417000123456, 1581417000123456)
+        pipeline_mock.zrevrangebyscore.assert_any_call(
+            'feed:posts', '(1581417000123456', '-inf', start=0, num=3)
+        assert actual == [6, 5, 4]
+
+    def test_page_not_built(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        pipeline_mock = redis_mock.return_value.pipeline.return_value
+        pipeline_mock.execute.return_value = [None, []]
+
+        # WHEN
+        actual = self.feed_index.page(limit=2)
+
+        # THEN
+        assert actual is None
+
+    def test_page_redis_unavailable(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        pipeline_mock = redis_mock.return_value.pipeline.return_value
+        pipeline_mock.execute.side_effect = utils.redis.ConnectionError()
+
+        # WHEN
+        actual = self.feed_index.page(limit=2)
+
+        # THEN
+        assert actual is None
+
+    def test_rebuild(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        client_mock = redis_mock.return_value
+        query_mock = mocker.patch.object(utils.db.session, "query")
+        query_mock.return_value.yield_per.return_value = [
+            (7, self.created), (8, self.created)]
+        calls = mocker.Mock()
+        calls.attach_mock(client_mock.set, 'set')
+        calls.attach_mock(client_mock.pipeline.return_value.zadd, 'zadd')
+        calls.attach_mock(client_mock.register_script.return_value, 'replace')
+
+        # WHEN
+        actual = self.feed_index.rebuild()
+
+        # THEN
+        assert actual == 2
+        client_mock.delete.assert_called_once_with(
+            'feed:posts:building', 'feed:posts:building:removed')
+        # Writes are diverted before the posts are read, and until the new
+        # index replaces the current one
+        assert [call[0] for call in calls.mock_calls] == [
+            'set', 'zadd', 'zadd', 'replace']
+        client_mock.set.assert_called_once_with(
+            'feed:posts:rebuilding', 1, ex=mocker.ANY)
+        client_mock.register_script.return_value.assert_called_once_with(
+            keys=[
+                'feed:posts:building', 'feed:posts:building:removed',
+                'feed:posts', 'feed:posts:rebuilding', 'feed:posts:built'],
+            args=[mocker.ANY])
+
+    def test_failed_write_until_rebuild(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        client_mock = redis_mock.return_value
+        client_mock.register_script.return_value.side_effect = \
+            utils.redis.ConnectionError()
+        pipeline_mock = client_mock.pipeline.return_value
+        built_before = repr(time.time() - 1).encode()
+        pipeline_mock.execute.return_value = [
+            built_before, [b'000000000009']]
+
+        # WHEN
+        self.feed_index.add(models.Post(id = 10, created = self.created))
+
+        # THEN
+        client_mock.delete.assert_called_once_with('feed:posts:built')
+        assert self.feed_index.page(limit=2) is None
+
+        # WHEN rebuilt since
+        pipeline_mock.execute.return_value = [
+            repr(time.time() + 1).encode(), [b'000000000010']]
+
+        # THEN
+        assert self.feed_index.page(limit=2) == [10]
+
+    def test_disabled(self, mocker):
+        # GIVEN
+        redis_mock = mocker.patch.object(utils.redis, "Redis")
+        feed_index = utils.FeedIndex(
+            enabled=False, host='localhost', port=6379, db_index=1,
+            key='feed:posts', timeout=0.5)
+
+        # WHEN
+        actual = feed_index.page(limit=2)
+        feed_index.add(models.Post(id = 7, created = self.created))
+
+        # THEN
+        assert actual is None
+        redis_mock.assert_not_called()
@@ -1,24 +1,558 @@
+import base64
+import collections
+import concurrent.futures
 import datetime
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+import redis
 import requests
+import requests.adapters
 import werkzeug
+import werkzeug.exceptions
+from flask_init import app, db
+import media
+import metrics
 import models
 
 
+def _create_upload_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=app.config['MEDIA_UPLOAD_POOL_SIZE'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class MediaUploadFailed(werkzeug.exceptions.BadGateway):
+    description = 'The media could not be stored, retry later'
+
+
 class File():
+    # Keep-alive connections to the static file server, shared by threads
+    _session = _create_upload_session()
 
     @staticmethod
-    def upload(file: werkzeug.datastructures.FileStorage, filename: str):
-        files = {
-            'file': (filename, file.read(), file.content_type)
+    def size(file: werkzeug.datastructures.FileStorage) -> int:
+        stream = file.stream
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(position)
+        return size
+
+    @staticmethod
+    def is_allowed(file: werkzeug.datastructures.FileStorage) -> bool:
+        """
+        Checks the extension and the size of the file without reading it.
+        """
+        filename = file.filename or ''
+        if '.' not in filename or filename.rsplit('.', 1)[1].lower() \
+                not in app.config['MEDIA_ALLOWED_EXTENSIONS']:
+            return False
+
+        return File.size(file) <= app.config['MAX_CONTENT_LENGTH']
+
+    @staticmethod
+    def extension(file: werkzeug.datastructures.FileStorage) -> str:
+        filename = werkzeug.utils.secure_filename(file.filename or '')
+        return os.path.splitext(filename)[1].lower()
+
+    @staticmethod
+    def content_key(digest: str, extension: str) -> str:
+        """
+        Content-addressed storage name: the same bytes always get the same
+        name, so media URLs never change content and can be cached forever.
+        """
+        return f'{digest}{extension}'
+
+    @staticmethod
+    def hash(file: werkzeug.datastructures.FileStorage) -> str:
+        """
+        Storage name of the file, hashed chunk by chunk from its stream.
+        """
+        digest = hashlib.sha256()
+        stream = file.stream
+        position = stream.tell()
+        for chunk in iter(
+                lambda: stream.read(app.config['MEDIA_UPLOAD_CHUNK_SIZE']),
+                b''):
+            digest.update(chunk)
+        stream.seek(position)
+        return File.content_key(digest.hexdigest(), File.extension(file))
+
+    @staticmethod
+    def variant_names(filename: str) -> dict:
+        """
+        Storage names of the resized variants of an image, by variant.
+        """
+        if not filename:
+            return {}
+        extension = os.path.splitext(filename)[1]
+        if extension[1:].lower() \
+                not in app.config['MEDIA_DERIVATIVE_EXTENSIONS']:
+            return {}
+        return {
+            variant: media.variant_name(filename, variant)
+            for variant in app.config['MEDIA_DERIVATIVES']
         }
-        url = (
-            'http://static-file-server:25478/'
-            'upload?token=f9403fc5f537b4ab332d'
-        )
-        return requests.post(url, files=files)
+
+    @staticmethod
+    def exists(filename: str) -> bool:
+        try:
+            response = File._session.head(
+                app.config['MEDIA_EXISTS_URL'].format(file_name=filename),
+                timeout=app.config['MEDIA_UPLOAD_TIMEOUT'])
+        except requests.RequestException:
+            return False    # unknown, upload to be on the safe side
+        return response.status_code == 200
+
+    @staticmethod
+    def store(file: werkzeug.datastructures.FileStorage) -> str:
+        """
+        Uploads the file under its content hash, unless the static file
+        server already has it. Returns the storage name.
+        """
+        filename = File.hash(file)
+        if not File.exists(filename):
+            try:
+                File.upload(file=file, filename=filename)
+            except requests.RequestException as exception:
+                # Nothing may refer to the name of a file which is not there
+                app.logger.error(f'Upload of {filename} failed: {exception}')
+                raise MediaUploadFailed()
+            derivative_pipeline.submit_file(file=file, filename=filename)
+        return filename
+
+    @staticmethod
+    def _multipart_body(
+            file: werkzeug.datastructures.FileStorage, filename: str,
+            boundary: str, chunk_size: int):
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="file"; '
+            f'filename="{filename}"\r\n'
+            f'Content-Type: {file.content_type or "application/octet-stream"}'
+            '\r\n\r\n').encode('utf-8')
+
+        while True:
+            chunk = file.stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+        yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    @staticmethod
+    @metrics.MEDIA_UPLOAD_DURATION.time()
+    def upload(file: werkzeug.datastructures.FileStorage, filename: str):
+        """
+        Streams the file to the static file server as a chunked multipart
+        body, without loading it into memory. Raises requests.HTTPError on
+        an error status.
+        """
+        boundary = uuid.uuid4().hex
+        body = File._multipart_body(
+            file=file, filename=filename, boundary=boundary,
+            chunk_size=app.config['MEDIA_UPLOAD_CHUNK_SIZE'])
+
+        response = File._session.post(
+            app.config['MEDIA_UPLOAD_URL'],
+            data=body,
+            headers={
+                'Content-Type': f'multipart/form-data; boundary={boundary}'
+            },
+            timeout=app.config['MEDIA_UPLOAD_TIMEOUT'])
+        response.raise_for_status()
+        return response
+
+
+SpooledUpload = media.SpooledUpload
+
+
+class UploadQueue():
+    """
+    Ships spooled media files to the static file server on a thread pool.
+    Failed uploads are retried with exponential backoff, `on_done` is
+    called with the outcome inside an application context.
+    A manifest next to every spooled file records it until its upload is
+    done, see `left_over`.
+    """
+    def __init__(
+            self, spool_folder: str, workers: int, retries: int,
+            backoff: float):
+        self._spool_folder = spool_folder
+        self._workers = workers
+        self._retries = retries
+        self._backoff = backoff
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # Created on first use, so that forked workers get their own threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._workers,
+                    thread_name_prefix='media-upload')
+            return self._executor
+
+    def spool(self, file: werkzeug.datastructures.FileStorage) \
+            -> SpooledUpload:
+        """
+        Copies the file to the spool folder, hashing it on the way to get
+        its content-addressed storage name.
+        """
+        os.makedirs(self._spool_folder, exist_ok=True)
+        path = os.path.join(self._spool_folder, uuid.uuid4().hex)
+
+        digest = hashlib.sha256()
+        with open(path, 'wb') as spooled_file:
+            for chunk in iter(
+                    lambda: file.stream.read(
+                        app.config['MEDIA_UPLOAD_CHUNK_SIZE']),
+                    b''):
+                digest.update(chunk)
+                spooled_file.write(chunk)
+
+        spooled_upload = SpooledUpload(
+            path=path,
+            filename=File.content_key(
+                digest.hexdigest(), File.extension(file)),
+            content_type=file.content_type)
+        with open(UploadQueue._manifest_path(path), 'w') as manifest:
+            json.dump(spooled_upload._asdict(), manifest)
+        return spooled_upload
+
+    @staticmethod
+    def _manifest_path(path: str) -> str:
+        return f'{path}.json'
+
+    @staticmethod
+    def _forget(spooled_upload: SpooledUpload):
+        # Derivatives have no manifest
+        try:
+            os.remove(UploadQueue._manifest_path(spooled_upload.path))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def discard(spooled_upload: SpooledUpload):
+        """
+        Removes a spooled file which is not going to be uploaded.
+        """
+        UploadQueue._forget(spooled_upload)
+        try:
+            os.remove(spooled_upload.path)
+        except FileNotFoundError:
+            pass
+
+    def left_over(self, before: float) -> list:
+        """
+        Spooled uploads whose manifest was written before the `before`
+        timestamp, by a previous run of the app (their file may be gone).
+        The other files spooled by then (derivatives, files without
+        manifest) are removed. Not to be called while another process may
+        be using those files.
+        """
+        try:
+            names = os.listdir(self._spool_folder)
+        except FileNotFoundError:
+            return []
+
+        spooled_uploads = []
+        for name in names:
+            path = os.path.join(self._spool_folder, name)
+            try:
+                if os.path.getmtime(path) >= before:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if not name.endswith('.json'):
+                if not os.path.exists(self._manifest_path(path)):
+                    os.remove(path)
+                continue
+
+            try:
+                with open(path) as manifest:
+                    spooled_uploads.append(
+                        SpooledUpload(**json.load(manifest)))
+            except (OSError, ValueError, TypeError) as exception:
+                app.logger.error(
+                    f'Unreadable spool manifest {path}: {exception}')
+                os.remove(path)
+        return spooled_uploads
+
+    def submit(
+            self, spooled_upload: SpooledUpload, on_done, attempt: int = 0,
+            derive: bool = True):
+        self._get_executor().submit(
+            self._upload, spooled_upload, on_done, attempt, derive)
+
+    def _upload(
+            self, spooled_upload: SpooledUpload, on_done, attempt: int,
+            derive: bool = True):
+        uploaded = False
+        try:
+            if not File.exists(spooled_upload.filename):
+                with open(spooled_upload.path, 'rb') as stream:
+                    File.upload(
+                        file=werkzeug.datastructures.FileStorage(
+                            stream=stream, filename=spooled_upload.filename,
+                            content_type=spooled_upload.content_type),
+                        filename=spooled_upload.filename)
+                uploaded = True
+        except (requests.RequestException, OSError) as exception:
+            if attempt < self._retries:
+                delay = self._backoff * 2 ** attempt
+                app.logger.warning(
+                    f'Upload of {spooled_upload.filename} failed '
+                    f'({exception}), retrying in {delay} s')
+                timer = threading.Timer(
+                    delay, self.submit,
+                    args=(spooled_upload, on_done, attempt + 1, derive))
+                timer.daemon = True
+                timer.start()
+                return
+            app.logger.error(
+                f'Upload of {spooled_upload.filename} failed after '
+                f'{attempt + 1} attempts: {exception}')
+            self.discard(spooled_upload)
+            self._finish(on_done, uploaded=False)
+            return
+
+        self._forget(spooled_upload)
+        if uploaded and derive:
+            # The pipeline takes over the spooled file
+            derivative_pipeline.submit(spooled_upload)
+        else:
+            os.remove(spooled_upload.path)
+        self._finish(on_done, uploaded=True)
+
+    @staticmethod
+    def _finish(on_done, uploaded: bool):
+        with app.app_context():
+            try:
+                on_done(uploaded)
+            finally:
+                db.session.remove()
+
+
+upload_queue = UploadQueue(
+    spool_folder=app.config['MEDIA_SPOOL_FOLDER'],
+    workers=app.config['MEDIA_UPLOAD_WORKERS'],
+    retries=app.config['MEDIA_UPLOAD_RETRIES'],
+    backoff=app.config['MEDIA_UPLOAD_BACKOFF'])
+
+
+class DerivativePipeline():
+    """
+    Renders the resized variants of uploaded images on a process pool and
+    hands them to the upload queue.
+    """
+    def __init__(self, spool_folder: str, variants: dict, workers: int):
+        self._spool_folder = spool_folder
+        self._variants = variants
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Created on first use, so that forked workers get their own pool.
+        # Spawned: forking a process running threads can deadlock the child
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit_file(
+            self, file: werkzeug.datastructures.FileStorage, filename: str):
+        if not File.variant_names(filename):
+            return
+        os.makedirs(self._spool_folder, exist_ok=True)
+        path = os.path.join(self._spool_folder, uuid.uuid4().hex)
+        file.stream.seek(0)
+        file.save(path)
+        self.submit(SpooledUpload(
+            path=path, filename=filename, content_type=file.content_type))
+
+    def submit(self, spooled_upload: SpooledUpload):
+        """
+        Takes over the spooled file, which is removed once rendered.
+        """
+        if not File.variant_names(spooled_upload.filename):
+            os.remove(spooled_upload.path)
+            return
+        future = self._get_executor().submit(
+            media.render_derivatives, spooled_upload, self._variants,
+            self._spool_folder)
+        future.add_done_callback(functools.partial(
+            self._queue_derivatives, spooled_upload, list(self._variants)))
+
+    @staticmethod
+    def _queue_derivatives(
+            spooled_upload: SpooledUpload, variants: list, future):
+        os.remove(spooled_upload.path)
+        try:
+            derivatives = future.result()
+        except Exception as exception:
+            app.logger.error(
+                'Rendering derivatives of '
+                f'{spooled_upload.filename} failed: {exception}')
+            return
+
+        stored_variants = StoredVariants(
+            filename=spooled_upload.filename, pending=len(derivatives))
+        # Rendered in the order of the variants
+        for variant, derivative in zip(variants, derivatives):
+            upload_queue.submit(
+                spooled_upload=derivative,
+                on_done=functools.partial(stored_variants.done, variant),
+                derive=False)
+
+
+class StoredVariants():
+    """
+    Collects the outcome of the uploads of the variants of an image, and
+    records the stored ones once all are done, see
+    models.record_media_variants.
+    """
+    def __init__(self, filename: str, pending: int):
+        self._filename = filename
+        self._pending = pending
+        self._stored = []
+        self._lock = threading.Lock()
+
+    def done(self, variant: str, uploaded: bool):
+        with self._lock:
+            self._pending -= 1
+            if uploaded:
+                self._stored.append(variant)
+            if self._pending:
+                return
+        if self._stored:
+            models.record_media_variants(self._filename, self._stored)
+
+
+derivative_pipeline = DerivativePipeline(
+    spool_folder=app.config['MEDIA_SPOOL_FOLDER'],
+    variants=app.config['MEDIA_DERIVATIVES'],
+    workers=app.config['MEDIA_DERIVATIVE_WORKERS'])
+
+
+class TokenCache():
+    """
+    Bounded LRU of verified access tokens, keyed by token digest.
+    An entry holds the token payload and a snapshot of the user and lives
+    until the token expires or for at most `ttl` seconds.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token) -> bytes:
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+    def get(self, token):
+        key = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload, snapshot = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload, snapshot
+
+    def set(self, token, payload: dict, snapshot: dict, expires_at: float):
+        expires_at = min(expires_at, time.time() + self._ttl)
+        key = self._digest(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload, snapshot)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def evict_user(self, user_id: int):
+        with self._lock:
+            stale_keys = [
+                key for key, (_, payload, _) in self._entries.items()
+                if payload.get('user_id') == user_id]
+            for key in stale_keys:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class UsernameCache():
+    """
+    Bounded LRU of username -> user id, per process. An entry lives for at
+    most `ttl` seconds, invalidated on rename and delete in this process.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            expires_at, user_id = entry
+            if expires_at <= time.time():
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return user_id
+
+    def set(self, username: str, user_id: int):
+        with self._lock:
+            self._entries[username] = (time.time() + self._ttl, user_id)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+username_cache = UsernameCache(
+    max_size=app.config['USERNAME_CACHE_SIZE'],
+    ttl=app.config['USERNAME_CACHE_TTL'])
 
 
 class Auth():
+    token_cache = TokenCache(
+        max_size=app.config['AUTH_TOKEN_CACHE_SIZE'],
+        ttl=app.config['AUTH_TOKEN_CACHE_TTL'])
+    _WRITE_METHODS = frozenset({'POST', 'PUT', 'PATCH', 'DELETE'})
+
     @staticmethod
     def verify_authorization(request):
         auth_header = request.headers.get('Authorization')
@@ -26,14 +560,319 @@ class Auth():
         if auth_header is None:
             return None
 
-        auth_payload = models.User.verify_auth_token(auth_header)
+        cached = Auth.token_cache.get(auth_header)
+        if cached is not None:
+            auth_payload, user_snapshot = cached
+            if request.method not in Auth._WRITE_METHODS:
+                return models.User.from_snapshot(user_snapshot)
+
+            # Writes read the user row again: the user may have been
+            # deleted through another process, whose eviction this one
+            # does not see
+            user = models.User.query.filter_by(
+                id=auth_payload['user_id']).first()
+            if user is None:
+                Auth.token_cache.evict_user(auth_payload['user_id'])
+            return user
+
+        verified = models.User.verify_auth_token(
+            auth_header, return_header=True)
+
+        if not verified:
+            return None
+
+        auth_payload, token_header = verified
 
         if not auth_payload or not auth_payload.get('user_id'):
             return None
 
-        return models.User.query.filter_by(
+        user = models.User.query.filter_by(
             id=auth_payload['user_id']).first()
 
+        if user is not None:
+            Auth.token_cache.set(
+                auth_header, payload=auth_payload,
+                snapshot=user.snapshot(),
+                expires_at=token_header['exp'])
+
+        return user
+
+class Cursor():
+    """
+    Opaque pagination cursor wrapping a (created, id) keyset key.
+    """
+    @staticmethod
+    def encode(key: tuple) -> str:
+        created, row_id = key
+        raw = json.dumps([created.isoformat(), row_id])
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            created, row_id = json.loads(raw.decode('utf-8'))
+            return datetime.datetime.fromisoformat(created), int(row_id)
+        except (ValueError, TypeError):
+            return None    # malformed cursor
+
+
+class RankCursor():
+    """
+    Opaque pagination cursor wrapping a (rank, id) keyset key of ranked
+    results.
+    """
+    @staticmethod
+    def encode(key: tuple) -> str:
+        rank, row_id = key
+        raw = json.dumps([rank, row_id])
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            rank, row_id = json.loads(raw.decode('utf-8'))
+            return float(rank), int(row_id)
+        except (ValueError, TypeError):
+            return None    # malformed cursor
+
+
+class FeedIndex():
+    """
+    Global feed index: a Redis sorted set of post ids scored by their
+    creation time, so feed pages are read from Redis and only the posts
+    of the page are loaded from the database, by primary key.
+    Reads return None (database fallback) while Redis is unavailable or
+    the index has not been built yet, see `manage.py rebuild_feed_index`.
+    A failed write leaves the index incomplete: it is then not read until
+    a rebuild started after the failure replaced it.
+    """
+    _EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+    # While a rebuild runs, writes also go to the index being built (and
+    # removals are recorded, for posts the rebuild read before they were
+    # deleted), so that none is lost when it replaces the current one
+    _ADD_SCRIPT = """
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+        if redis.call('EXISTS', KEYS[2]) == 1 then
+            redis.call('ZADD', KEYS[3], ARGV[1], ARGV[2])
+        end
+    """
+    _REMOVE_SCRIPT = """
+        redis.call('ZREM', KEYS[1], unpack(ARGV))
+        if redis.call('EXISTS', KEYS[2]) == 1 then
+            redis.call('ZREM', KEYS[3], unpack(ARGV))
+            redis.call('SADD', KEYS[4], unpack(ARGV))
+        end
+    """
+    _REPLACE_SCRIPT = """
+        local removed = redis.call('SMEMBERS', KEYS[2])
+        for i = 1, #removed, 1000 do
+            local last = math.min(i + 999, #removed)
+            redis.call('ZREM', KEYS[1], unpack(removed, i, last))
+        end
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('RENAME', KEYS[1], KEYS[3])
+        else
+            redis.call('DEL', KEYS[3])
+        end
+        redis.call('DEL', KEYS[2], KEYS[4])
+        redis.call('SET', KEYS[5], ARGV[1])
+    """
+    # A rebuild which died stops diverting writes after that long
+    _REBUILD_TIMEOUT = 3600
+
+    def __init__(
+            self, enabled: bool, host: str, port: int, db_index: int,
+            key: str, timeout: float):
+        self._enabled = enabled
+        self._host = host
+        self._port = port
+        self._db_index = db_index
+        self._key = key
+        self._built_key = f'{key}:built'
+        self._building_key = f'{key}:building'
+        self._rebuilding_key = f'{key}:rebuilding'
+        self._removed_key = f'{key}:building:removed'
+        self._timeout = timeout
+        self._client = None
+        self._scripts = {}
+        # Time of the last failed write of this process, older builds are
+        # not read
+        self._failed_at = 0.0
+
+    def _get_client(self) -> redis.Redis:
+        if self._client is None:
+            self._client = redis.Redis(
+                host=self._host, port=self._port, db=self._db_index,
+                socket_timeout=self._timeout,
+                socket_connect_timeout=self._timeout)
+        return self._client
+
+    def _get_script(self, source: str):
+        scripts = self._scripts
+        if source not in scripts:
+            scripts[source] = self._get_client().register_script(source)
+        return scripts[source]
+
+    @staticmethod
+    def _member(post_id: int) -> str:
+        # Zero padded, so posts created at the same time are ordered by id
+        return f'{post_id:012d}'
+
+    @staticmethod
+    def _score(created: datetime.datetime) -> int:
+        # Microseconds since the epoch, exact as a Redis (double) score
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=datetime.timezone.utc)
+        return (created - FeedIndex._EPOCH) // \
+            datetime.timedelta(microseconds=1)
+
+    def add(self, post):
+        if not self._enabled:
+            return
+        try:
+            self._get_script(self._ADD_SCRIPT)(
+                keys=[self._key, self._rebuilding_key, self._building_key],
+                args=[self._score(post.created), self._member(post.id)])
+        except redis.RedisError as exception:
+            app.logger.error(f'Feed index: cannot add {post.id}: {exception}')
+            self._invalidate()
+
+    def remove(self, *post_ids: int):
+        if not self._enabled or not post_ids:
+            return
+        try:
+            self._get_script(self._REMOVE_SCRIPT)(
+                keys=[
+                    self._key, self._rebuilding_key, self._building_key,
+                    self._removed_key],
+                args=[self._member(post_id) for post_id in post_ids])
+        except redis.RedisError as exception:
+            app.logger.error(
+                f'Feed index: cannot remove {post_ids}: {exception}')
+            self._invalidate()
+
+    def _invalidate(self):
+        """
+        Stops reading the index, in every process if Redis can still be
+        told (the built marker is removed), until it is rebuilt.
+        """
+        self._failed_at = time.time()
+        app.logger.error(
+            'Feed index: out of date, run rebuild_feed_index to use it again')
+        try:
+            self._get_client().delete(self._built_key)
+        except redis.RedisError as exception:
+            app.logger.error(f'Feed index unavailable: {exception}')
+
+    def remove_query(self, query, batch_size: int = 1000):
+        """
+        Removes the post ids selected by the query (a single id column),
+        streamed from the database and removed in batches. The query does
+        not run when the index is disabled.
+        """
+        if not self._enabled:
+            return
+        rows = iter(query.yield_per(batch_size))
+        for batch in iter(
+                lambda: list(itertools.islice(rows, batch_size)), []):
+            self.remove(*[post_id for post_id, in batch])
+
+    def page(self, limit: int, after: tuple = None):
+        """
+        Ids of the keyset page after the (created, id) key, newest first,
+        with one extra id like Base.keyset_query. None if the index cannot
+        be used.
+        """
+        if not self._enabled:
+            return None
+
+        try:
+            pipeline = self._get_client().pipeline(transaction=False)
+            pipeline.get(self._built_key)
+            if after is None:
+                pipeline.zrevrange(self._key, 0, limit)
+            else:
+                score = self._score(after[0])
+                # Posts created at the same time as the cursor post, and
+                # the older ones
+                pipeline.zrevrangebyscore(self._key, score, score)
+                pipeline.zrevrangebyscore(
+                    self._key, f'({score}', '-inf', start=0, num=limit + 1)
+            built, *members = pipeline.execute()
+        except redis.RedisError as exception:
+            app.logger.error(f'Feed index unavailable: {exception}')
+            return None
+
+        # The marker holds the time the rebuild started
+        if not built or float(built) <= self._failed_at:
+            return None
+
+        if after is None:
+            post_ids = [int(member) for member in members[0]]
+        else:
+            ties, older = members
+            post_ids = [
+                int(member) for member in ties if int(member) < after[1]]
+            post_ids += [int(member) for member in older]
+
+        return post_ids[:limit + 1]
+
+    def rebuild(self, batch_size: int = 1000) -> int:
+        """
+        Reindexes all the posts into a new sorted set which then replaces
+        the current one, along with the posts added or removed meanwhile.
+        Returns the number of indexed posts.
+        """
+        started = time.time()
+        client = self._get_client()
+        client.delete(self._building_key, self._removed_key)
+        client.set(self._rebuilding_key, 1, ex=self._REBUILD_TIMEOUT)
+
+        count = 0
+        pipeline = client.pipeline(transaction=False)
+        rows = db.session.query(models.Post.id, models.Post.created) \
+            .yield_per(batch_size)
+        for post_id, created in rows:
+            pipeline.zadd(
+                self._building_key,
+                {self._member(post_id): self._score(created)})
+            count += 1
+            if count % batch_size == 0:
+                pipeline.execute()
+        pipeline.execute()
+
+        self._get_script(self._REPLACE_SCRIPT)(
+            keys=[
+                self._building_key, self._removed_key, self._key,
+                self._rebuilding_key, self._built_key],
+            args=[repr(started)])
+
+        return count
+
+
+feed_index = FeedIndex(
+    enabled=app.config['FEED_INDEX_ENABLED'],
+    host=app.config['REDIS_HOST'],
+    port=app.config['REDIS_PORT'],
+    db_index=app.config['FEED_INDEX_REDIS_DB'],
+    key=app.config['FEED_INDEX_KEY'],
+    timeout=app.config['FEED_INDEX_TIMEOUT'])
+
+
+class ETag():
+    """
+    Strong entity tag of a response, derived from whatever its content
+    depends on (row versions, authenticated user, ...).
+    """
+    @staticmethod
+    def of(*parts) -> str:
+        raw = json.dumps(parts, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
 class DateTimeUtil():
     @staticmethod
     def format(input_datetime: str,